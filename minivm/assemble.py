@@ -1,38 +1,74 @@
+import bisect
 import unittest
 import argparse
 from pathlib import Path
 import sys
 
-from .program import Param, PARAMS, Op, HEADER
+from .program import (
+    Param, PARAMS, PARAM_SIZES, Op, HEADER, Program, ProgramError, ProgramWriter,
+    FORMAT_VERSION, WIDE, WIDE_OPS, MAX_STRING, encode_instr, fits,
+)
 from .tokens import ParseError, Scanner, TIdent, TLabel, TString, TInteger
 
 
+# Size of parts written out by Assembler.stream()
+CHUNK_SIZE = 0x10000
+
+
 class Assembler:
-    def __init__(self, code):
-        self.lines = code.splitlines()
-        self.data = bytearray(HEADER)
+    """
+    Assembles a program from a string, or from any iterable of lines (such
+    as a file). Use assemble() to get the whole program, or stream() to get
+    it in parts, without keeping it in memory.
+
+    With object_file=True, the result is an object file, to be combined with
+    others by the linker (see link.py).
+    """
+
+    def __init__(self, code, *, optimize=False, object_file=False):
+        self.optimize = optimize
+        if isinstance(code, str):
+            code = code.splitlines()
+        self.lines = code
+        self.writer = ProgramWriter(object_file=object_file)
+        self.data = self.writer.data
         self.targets = {}
+        # Jumps to labels that are not written out yet. Position of jump
+        # instruction -> (op, token, label, source line)
         self.sources = {}
+        # Labels used in self.sources, but not defined yet
+        self.unresolved = set()
+        # Positions of jumps that need the WIDE prefix
+        self.wide_jumps = set()
+        # Source line being assembled
+        self.line = None
         self.errors = []
+        # Line number -> source line, for lines with errors
+        self.error_lines = {}
+
+    def parse_param(self, token, param, wide=False):
+        """
+        Parse a parameter. If wide is true, the value can be as big as allowed
+        with the WIDE prefix (the prefix is added when encoding, if needed).
+        """
 
-    def parse_param(self, token, param):
         if param == Param.STRING:
             if not isinstance(token, TString):
                 raise ParseError(token.lineno, token.col, "expected a string")
-            if len(token.value) > 256:
+            if len(token.value) > MAX_STRING:
                 raise ParseError(token.lineno, token.col, "string literal too long")
-
-            token_bytes = token.value.encode('ascii')
-            return bytes([len(token_bytes)]) + token_bytes
+            return token.value
 
         if not isinstance(token, TInteger):
             raise ParseError(token.lineno, token.col, "expected a number")
 
-        min_val, max_val = {
-            Param.UINT: (0, 0xFF),
-            Param.INT: (-0x80, 0x7F),
-            Param.INT_BIG: (-0x8000, 0x7FFF),
-        }[param]
+        size, signed = PARAM_SIZES[param]
+        if wide:
+            size *= 2
+        if signed:
+            min_val, max_val = -(1 << (size * 8 - 1)), (1 << (size * 8 - 1)) - 1
+        else:
+            min_val, max_val = 0, (1 << (size * 8)) - 1
 
         value = token.value
 
@@ -41,22 +77,7 @@ class Assembler:
                 token.lineno, token.col,
                 f"number should be between {min_val} and {max_val}: {value}"
             )
-
-        if param == Param.UINT:
-            return bytes([value])
-        elif param == Param.INT:
-            if value < 0:
-                value += 0x100
-            return bytes([value])
-        elif param == Param.INT_BIG:
-            if value < 0:
-                value += 0x10000
-            return bytes(
-                [
-                    value & 0xFF,
-                    (value >> 8) & 0xFF,
-                ]
-            )
+        return value
 
     def parse_line(self, tokens, program_pos):
         if not tokens:
@@ -67,6 +88,7 @@ class Assembler:
             if label in self.targets:
                 raise ParseError(tokens[0].lineno, tokens[0].col, f'duplicate label: {label}')
             self.targets[label] = program_pos
+            self.unresolved.discard(label)
             tokens.pop(0)
 
         if not tokens:
@@ -91,62 +113,153 @@ class Assembler:
 
         if op in [Op.JUMP, Op.JUMP_IF] and isinstance(tokens[1], TIdent):
             label = tokens[1].value.upper()
-            self.sources[program_pos + 1] = tokens[1], label
-            return bytes([op.value, 0, 0])
-
-        result = bytearray()
-        result.append(op.value)
-        for token, param in zip(tokens[1:], params):
-            result.extend(self.parse_param(token, param))
-        return result
+            self.sources[program_pos] = op, tokens[1], label, self.line
+            if label not in self.targets:
+                self.unresolved.add(label)
+            return encode_instr(op, [0], wide=False)
+
+        wide = op in WIDE_OPS
+        args = [
+            self.parse_param(token, param, wide)
+            for token, param in zip(tokens[1:], params)
+        ]
+        if op == Op.FUNC:
+            self.writer.add_function(program_pos, args[0])
+        return self.writer.encode(op, args)
+
+    def widen_jumps(self, positions):
+        """
+        Add the WIDE prefix to jumps at given positions, moving the code after
+        them.
+        """
+
+        positions = sorted(positions)
+        narrow_size = len(encode_instr(Op.JUMP, [0]))
+        extra = len(encode_instr(Op.JUMP, [0], wide=True)) - narrow_size
+
+        def move(pos):
+            # Code at a widened jump itself stays in place.
+            return pos + extra * bisect.bisect_left(positions, pos)
+
+        # Only the code that is not written out yet can change.
+        base = self.writer.written
+        data = bytearray()
+        prev = 0
+        for pos in positions:
+            data.extend(self.data[prev:pos - base])
+            data.extend(encode_instr(Op(self.data[pos - base]), [0], wide=True))
+            prev = pos - base + narrow_size
+        data.extend(self.data[prev:])
+        self.data[:] = data
+
+        self.targets = {label: move(pos) for label, pos in self.targets.items()}
+        self.sources = {move(pos): source for pos, source in self.sources.items()}
+        self.wide_jumps = {move(pos) for pos in self.wide_jumps | set(positions)}
+        self.writer.functions[:] = [
+            (name, move(pos)) for name, pos in self.writer.functions
+        ]
 
     def update_locations(self):
-        for source, (token, label) in self.sources.items():
+        """
+        Fill in the jumps in self.sources, once their labels are known (or at
+        the end of the program).
+        """
+
+        # Jumps to labels are assembled in the short form first. The ones
+        # that are too long are widened, which moves the code after them, so
+        # this is repeated until all jumps fit.
+        while True:
+            too_long = [
+                source
+                for source, (op, token, label, line) in self.sources.items()
+                if label in self.targets and source not in self.wide_jumps
+                and not fits(self.targets[label] - source, 2, True)
+            ]
+            if not too_long:
+                break
+            self.widen_jumps(too_long)
+
+        base = self.writer.written
+        for source, (op, token, label, line) in self.sources.items():
             if label not in self.targets:
-                self.errors.append(
-                    ParseError(token.lineno, token.col, f'unknown label: {label}'))
+                error = ParseError(token.lineno, token.col, f'unknown label: {label}')
+                self.add_error(error, line)
                 continue
 
-            target = self.targets[label]
-            delta = target - source + 1
-            if not (-0x8000 <= delta <= 0x7FFF):
-                self.errors.append(
+            delta = self.targets[label] - source
+            if not fits(delta, 4, True):
+                self.add_error(
                     ParseError(
                         token.lineno, token.col,
                         f'jump too big ({delta} bytes)'
-                    )
+                    ),
+                    line,
                 )
+                continue
 
-            if delta < 0:
-                delta += 0x10000
-            self.data[source] = delta & 0xFF
-            self.data[source + 1] = (delta >> 8) & 0xFF
+            encoded = encode_instr(op, [delta], wide=source in self.wide_jumps)
+            self.data[source - base:source - base + len(encoded)] = encoded
 
-    def assemble(self):
-        for lineno, line in enumerate(self.lines):
-            # tokenize
-            scanner = Scanner(line, lineno)
+        self.sources.clear()
+        self.wide_jumps.clear()
+
+    def add_error(self, error, line):
+        self.errors.append(error)
+        self.error_lines[error.lineno] = line
+
+    def stream(self):
+        """
+        Assemble the program, and yield the bytecode in parts, as soon as
+        they cannot change anymore: only the code after the first jump to a
+        label that is not defined yet is kept in memory.
 
+        If self.errors is not empty at the end, the output is incomplete.
+        """
+
+        writer = self.writer
+        for lineno, line in enumerate(self.lines):
+            line = line.rstrip('\n')
+            self.line = line
             try:
-                tokens = list(scanner.iter())
-                compiled = self.parse_line(tokens, len(self.data))
+                tokens = list(Scanner(line, lineno).iter())
+                compiled = self.parse_line(tokens, writer.pos())
             except ParseError as e:
-                self.errors.append(e)
+                self.add_error(e, line)
             else:
                 self.data.extend(compiled)
 
+            if self.sources and not self.unresolved:
+                self.update_locations()
+            if not self.sources and len(self.data) >= CHUNK_SIZE:
+                data = writer.flush()
+                if not self.errors:
+                    yield data
+
         self.update_locations()
+        data = writer.finish()
+        if not self.errors:
+            yield data
 
+    def assemble(self):
+        data = b''.join(self.stream())
         if self.errors:
             return None
 
-        return self.data
+        if self.optimize:
+            from .optimize import Optimizer
+            try:
+                return Optimizer(Program(data)).optimize()
+            except ProgramError as e:
+                # Jump to an unaligned offset; keep the program as written.
+                print(f'warning: not optimizing: {e}', file=sys.stderr)
+
+        return data
 
     def describe_errors(self):
         prefix = ' ' * 2
         for error in self.errors:
             yield f'{error.lineno}:{error.col}: error: {error.message}'
-            yield prefix + self.lines[error.lineno]
+            yield prefix + self.error_lines[error.lineno]
             yield prefix + ' ' * error.col + '^'
 
 
@@ -158,30 +271,121 @@ class AssemblerTest(unittest.TestCase):
     CONST_INT 2
     CONST_INT 3
 L2: OP_ADD
-    JUMP L1  # +9, 001F
-    JUMP L2  # -4, 0015
-    JUMP -1  # -1, 001B (unknown)
+    JUMP L1  # +9, 001D
+    JUMP L2  # -4, 0013
+    JUMP -1  # -1, 0019 (unknown)
 L1: CALL "print" 1
     RET
 '''
         asm = Assembler(code)
         data = asm.assemble()
-        self.assertListEqual(list(data), [
-            *HEADER,
-            Op.FUNC.value, 5, *b'hello', 0, 2,
+        self.assertListEqual(list(data[:34]), [
+            *HEADER, 0, FORMAT_VERSION,
+            Op.FUNC.value, 0, 0, 0, 2,
             Op.CONST_INT.value, 2,
             Op.CONST_INT.value, 3,
             Op.OP_ADD.value,
             Op.JUMP.value, 9, 0,
             Op.JUMP.value, 0x100-4, 0xFF,
             Op.JUMP.value, 0x100-1, 0xFF,
-            Op.CALL.value, 5, *b'print', 1,
+            Op.CALL.value, 1, 0, 1,
             Op.RET.value,
         ])
+        program = Program(data)
+        self.assertEqual(program.code_end, 34)
+        self.assertEqual(program.functions(), [(10, 5, ['hello', 0, 2])])
+        self.assertEqual([program.string(i) for i in range(2)], ['hello', 'print'])
+
+    def test_wide(self):
+        from .run import ENGINES, Machine
+
+        filler = '    CONST_NULL\n    DROP\n'
+        args = '    CONST_INT 1\n' * 256
+        code = f'''\
+FUNC "main" 0 300
+    JUMP MID  # 0x7FFF bytes, until the next jump is widened
+    JUMP END
+TOP:
+    CONST_INT 0
+    DROP
+{filler * 16379}\
+MID:
+    CONST_STRING "{'x' * 300}"
+    STORE_LOCAL 299
+{filler * 10}\
+END:
+    LOAD_LOCAL 298
+    JUMP_IF DONE
+    CONST_TRUE
+    STORE_LOCAL 298
+    JUMP TOP
+DONE:
+{args}\
+    CALL "f" 256
+    LOAD_LOCAL 299
+    CALL "length" 1
+    OP_ADD
+    RET
 
+FUNC "f" 256 0
+    LOAD_LOCAL 255
+    RET
+'''
+        program = Program(Assembler(code).assemble())
+        instrs = list(program.iter())
+        self.assertEqual(instrs[0], (10, 10, Op.FUNC, ['main', 0, 300]))
+        # Both jumps are wide: widening the second one moves the target of
+        # the first one too far.
+        self.assertEqual(instrs[1], (20, 6, Op.JUMP, [6 + 6 + 3 + 16379 * 2]))
+        self.assertEqual(instrs[2][:3], (26, 6, Op.JUMP))
+        self.assertEqual(program.buf[20:22], bytes([WIDE, Op.JUMP.value]))
+        for engine in ENGINES.values():
+            machine = Machine(program)
+            machine.use_io = False
+            self.assertEqual(engine(machine), 301)
+
+        asm = Assembler('FUNC "main" 0 0\nCONST_INT_BIG 32768\nLOAD_LOCAL 65536\n')
+        self.assertIsNone(asm.assemble())
+        self.assertEqual([e.message for e in asm.errors], [
+            'number should be between -32768 and 32767: 32768',
+            'number should be between 0 and 65535: 65536',
+        ])
 
-def run_assembler(code):
-    asm = Assembler(code)
+    def test_stream(self):
+        import io
+
+        code = ''.join(f'''\
+FUNC "f{i}" 1 0
+F{i}_LOOP:
+    LOAD_LOCAL 0
+    JUMP_IF F{i}_END
+    CONST_STRING "f{i}"
+    CALL_VOID "println" 1
+    JUMP F{i}_LOOP
+F{i}_END:
+    RET
+''' for i in range(5000))
+        asm = Assembler(io.StringIO(code))
+        chunks = list(asm.stream())
+        self.assertEqual(asm.errors, [])
+        self.assertGreater(len(chunks), 1)
+        # The code is written out as soon as it's big enough (the last part
+        # has the function table and the strings).
+        for data in chunks[:-1]:
+            self.assertLess(len(data), CHUNK_SIZE + 100)
+        self.assertEqual(b''.join(chunks), Assembler(code).assemble())
+
+        asm = Assembler(io.StringIO(code + '    JUMP NOWHERE\n'))
+        list(asm.stream())
+        self.assertEqual(list(asm.describe_errors()), [
+            '45000:9: error: unknown label: NOWHERE',
+            '      JUMP NOWHERE',
+            '           ^',
+        ])
+
+
+def run_assembler(code, *, optimize=False, object_file=False):
+    asm = Assembler(code, optimize=optimize, object_file=object_file)
     bytecode = asm.assemble()
 
     if bytecode is None:
@@ -201,20 +405,50 @@ def main():
         'output_file', metavar='OUTPUT_FILE',
         help='output file, or - for stdout',
     )
+    parser.add_argument(
+        '-O', '--optimize', action='store_true',
+        help='optimize the program (see: mini opt)',
+    )
+    parser.add_argument(
+        '-c', '--object', action='store_true',
+        help='write an object file, to be linked with others (see: mini link)',
+    )
 
     args = parser.parse_args()
-
-    if args.input_file == '-':
-        code = sys.stdin.read()
-    else:
-        code = Path(args.input_file).read_text()
-
-    bytecode = run_assembler(code)
-
-    if args.output_file == '-':
-        sys.stdout.buffer.write(bytecode)
-    else:
-        Path(args.output_file).write_bytes(bytecode)
+    if args.optimize and args.object:
+        parser.error('--optimize cannot be used with --object')
+
+    if args.optimize:
+        # The optimizer needs the whole program.
+        if args.input_file == '-':
+            code = sys.stdin.read()
+        else:
+            code = Path(args.input_file).read_text()
+        bytecode = run_assembler(code, optimize=True)
+        if args.output_file == '-':
+            sys.stdout.buffer.write(bytecode)
+        else:
+            Path(args.output_file).write_bytes(bytecode)
+        return
+
+    source = sys.stdin if args.input_file == '-' else open(args.input_file)
+    out = sys.stdout.buffer if args.output_file == '-' else open(args.output_file, 'wb')
+    try:
+        asm = Assembler(source, object_file=args.object)
+        for data in asm.stream():
+            out.write(data)
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if out is not sys.stdout.buffer:
+            out.close()
+
+    if asm.errors:
+        for error_line in asm.describe_errors():
+            print(error_line, file=sys.stderr)
+        if args.output_file != '-':
+            Path(args.output_file).unlink()
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,209 @@
+import argparse
+import json
+import multiprocessing
+import sys
+import unittest
+from pathlib import Path
+
+from .assemble import Assembler
+from .output import Output
+from .program import Program
+from .run import ENGINES, Machine, MachineError, read_bytecode
+
+# Program loaded by each worker process (see init_worker).
+_worker = None
+
+
+class EndOfInput(Exception):
+    def __str__(self):
+        return 'end of input'
+
+
+class Runner:
+    """
+    Runs a program on many inputs. The program is loaded and decoded once,
+    and the same Machine is used for all cases: it is restored to its initial
+    state before each case, so that the program is linked (and translated by
+    the fast and compiled engines) only once.
+    """
+
+    def __init__(self, bytecode, engine='step'):
+        self.program = Program(bytecode)
+        self.program.decode()
+        self.engine = ENGINES[engine]
+        self.machine = Machine(self.program, output=Output(None))
+        self.initial = self.machine.snapshot()
+
+    def run_case(self, case):
+        name, lines = case
+        lines = iter(lines)
+
+        def on_input():
+            try:
+                return next(lines)
+            except StopIteration:
+                raise EndOfInput()
+
+        machine = self.machine
+        machine.restore(self.initial)
+        machine.on_input = on_input
+        result = {'case': name, 'result': None, 'output': '', 'error': None}
+        try:
+            result['result'] = self.engine(machine)
+        except MachineError as e:
+            result['error'] = str(e)
+            result['traceback'] = list(machine.traceback(color=False))
+        result['output'] = machine.output
+        return result
+
+
+def init_worker(bytecode, engine):
+    global _worker
+    _worker = Runner(bytecode, engine)
+
+
+def run_in_worker(case):
+    return _worker.run_case(case)
+
+
+def run_batch(bytecode, cases, *, engine='step', jobs=1):
+    """
+    Run all cases, yielding results in the same order. Each case is a pair
+    (name, input lines).
+    """
+
+    if jobs == 1:
+        runner = Runner(bytecode, engine)
+        for case in cases:
+            yield runner.run_case(case)
+        return
+
+    cases = list(cases)
+    chunksize = max(1, len(cases) // (jobs * 8))
+    with multiprocessing.Pool(jobs, init_worker, (bytes(bytecode), engine)) as pool:
+        yield from pool.imap(run_in_worker, cases, chunksize)
+
+
+def read_cases(path):
+    """
+    Read test cases from a directory (one file per case, one input line per
+    line), or a JSONL file with one case per line: either an object with
+    "input" (list of lines, or a string) and optional "case" name, or just
+    the input.
+    """
+
+    path = Path(path)
+    if path.is_dir():
+        for case_path in sorted(path.iterdir()):
+            if case_path.is_file():
+                yield case_path.name, case_path.read_text().splitlines()
+        return
+
+    with open(path) as f:
+        for i, line in enumerate(f):
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            name = i
+            if isinstance(data, dict):
+                name = data.get('case', i)
+                data = data.get('input', [])
+            if isinstance(data, str):
+                data = data.splitlines()
+            yield name, data
+
+
+class BatchTest(unittest.TestCase):
+    code = '''\
+FUNC "main" 0 0
+    CALL "input" 0
+    CALL "to_int" 1
+    DUP
+    OP_MUL
+    CALL_VOID "println" 1
+    CALL "input" 0
+    RET
+'''
+
+    def test_batch(self):
+        bytecode = Assembler(self.code).assemble()
+        cases = [('a', ['3', 'x']), ('b', ['5']), ('c', ['y', 'z'])]
+        for jobs in [1, 2]:
+            results = list(run_batch(bytecode, cases, engine='fast', jobs=jobs))
+            self.assertEqual([r['case'] for r in results], ['a', 'b', 'c'])
+            self.assertEqual(results[0]['result'], 'x')
+            self.assertEqual(results[0]['output'], '3\n9\nx\n')
+            self.assertEqual(results[1]['error'],
+                             'Error running native function input: end of input')
+            self.assertEqual(results[2]['error'],
+                             'expecting an integer, got null')
+
+    def test_isolation(self):
+        # Cases share a machine, but not globals or output.
+        code = '''\
+FUNC "main" 0 0
+    CALL "input" 0
+    CONST_STRING "set"
+    CMP_EQ
+    JUMP_IF SET
+    LOAD_GLOBAL "g"
+    RET
+SET:
+    CONST_INT 1
+    STORE_GLOBAL "g"
+    CONST_NULL
+    RET
+'''
+        bytecode = Assembler(code).assemble()
+        cases = [('a', ['set']), ('b', ['get']), ('c', ['set'])]
+        for engine in ENGINES:
+            results = list(run_batch(bytecode, cases, engine=engine))
+            self.assertEqual([r['error'] for r in results],
+                             [None, 'Undefined global name: g', None], engine)
+            self.assertEqual([r['output'] for r in results],
+                             ['set\n', 'get\n', 'set\n'], engine)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'input_file', metavar='PROGRAM',
+        help='program (bytecode or assembly)',
+    )
+    parser.add_argument(
+        '--inputs', metavar='DIR|JSONL', required=True,
+        help='directory with one input file per case, or a JSONL file',
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+        help='number of worker processes (default: number of CPUs)',
+    )
+    parser.add_argument(
+        '-o', '--output', metavar='OUTPUT_FILE', default='-',
+        help='output file for results (JSONL), or - for stdout',
+    )
+    parser.add_argument(
+        '--engine', choices=ENGINES, default='fast',
+        help='execution engine (default: fast)',
+    )
+
+    args = parser.parse_args()
+
+    bytecode = read_bytecode(args.input_file)
+    cases = read_cases(args.inputs)
+
+    if args.output == '-':
+        out = sys.stdout
+    else:
+        out = open(args.output, 'w')
+    try:
+        for result in run_batch(bytecode, cases, engine=args.engine, jobs=args.jobs):
+            # Ropes (see rope.py) are saved as plain strings.
+            out.write(json.dumps(result, default=str) + '\n')
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,524 @@
+import argparse
+import io
+import json
+import multiprocessing
+import subprocess
+import sys
+import time
+import unittest
+from pathlib import Path
+
+from .assemble import Assembler, run_assembler
+from .output import Output
+from .program import Op, Program
+from .run import ENGINES, Machine, MachineError
+
+# Benchmarks: each workload is run in a new process for each engine, so that
+# peak memory is measured separately. Instruction and call counts are the same
+# for all engines, and are counted once with Machine.step(). The assembler is
+# measured separately, on a big generated source.
+
+EXAMPLES_DIR = Path(__file__).parent.parent / 'examples'
+
+# Default size of synthetic workloads.
+DEFAULT_SCALE = 5
+
+# Default allowed slowdown when comparing with a baseline, in percent.
+THRESHOLD = 10
+
+
+def calls_workload(scale):
+    n = 18 + scale
+    return f'''\
+FUNC "main" 0 0
+    CONST_INT {n}
+    CALL "fib" 1
+    RET
+
+FUNC "fib" 1 0
+    LOAD_LOCAL 0
+    CONST_INT 2
+    CMP_LT
+    JUMP_IF SMALL
+    LOAD_LOCAL 0
+    CONST_INT 1
+    OP_SUB
+    CALL "fib" 1
+    LOAD_LOCAL 0
+    CONST_INT 2
+    OP_SUB
+    CALL "fib" 1
+    OP_ADD
+    RET
+SMALL:
+    LOAD_LOCAL 0
+    RET
+'''
+
+
+def loops_workload(scale):
+    n = 100 * scale
+    return f'''\
+FUNC "main" 0 3
+    CONST_INT_BIG {n}
+    STORE_LOCAL 0
+    CONST_INT 0
+    STORE_LOCAL 2
+OUTER:
+    LOAD_LOCAL 0
+    CONST_INT 0
+    CMP_LTE
+    JUMP_IF END
+    CONST_INT 100
+    STORE_LOCAL 1
+INNER:
+    LOAD_LOCAL 2
+    LOAD_LOCAL 1
+    OP_ADD
+    STORE_LOCAL 2
+    LOAD_LOCAL 1
+    CONST_INT 1
+    OP_SUB
+    DUP
+    STORE_LOCAL 1
+    JUMP_IF INNER
+    LOAD_LOCAL 0
+    CONST_INT 1
+    OP_SUB
+    STORE_LOCAL 0
+    JUMP OUTER
+END:
+    LOAD_LOCAL 2
+    RET
+'''
+
+
+def strings_workload(scale):
+    n = 1000 * scale
+    return f'''\
+FUNC "main" 0 2
+    CONST_INT_BIG {n}
+    STORE_LOCAL 0
+    CONST_STRING ""
+    STORE_LOCAL 1
+LOOP:
+    LOAD_LOCAL 0
+    CONST_INT 0
+    CMP_LTE
+    JUMP_IF END
+    LOAD_LOCAL 1
+    LOAD_LOCAL 0
+    CALL "to_string" 1
+    CALL "concat" 2
+    STORE_LOCAL 1
+    LOAD_LOCAL 0
+    CONST_INT 1
+    OP_SUB
+    STORE_LOCAL 0
+    JUMP LOOP
+END:
+    LOAD_LOCAL 1
+    CALL "length" 1
+    RET
+'''
+
+
+def globals_workload(scale):
+    return f'''\
+FUNC "main" 0 1
+    CONST_INT_BIG {scale}
+    STORE_LOCAL 0
+    CONST_INT 0
+    STORE_GLOBAL "total"
+OUTER:
+    LOAD_LOCAL 0
+    CONST_INT 0
+    CMP_LTE
+    JUMP_IF END
+    CONST_INT_BIG 10000
+    STORE_GLOBAL "counter"
+LOOP:
+    LOAD_GLOBAL "counter"
+    CONST_INT 0
+    CMP_LTE
+    JUMP_IF NEXT
+    CALL_VOID "step" 0
+    JUMP LOOP
+NEXT:
+    LOAD_LOCAL 0
+    CONST_INT 1
+    OP_SUB
+    STORE_LOCAL 0
+    JUMP OUTER
+END:
+    LOAD_GLOBAL "total"
+    RET
+
+FUNC "step" 0 0
+    LOAD_GLOBAL "total"
+    LOAD_GLOBAL "counter"
+    OP_ADD
+    STORE_GLOBAL "total"
+    LOAD_GLOBAL "counter"
+    CONST_INT 1
+    OP_SUB
+    STORE_GLOBAL "counter"
+    RET
+'''
+
+
+SYNTHETIC = {
+    'calls': calls_workload,
+    'loops': loops_workload,
+    'strings': strings_workload,
+    'globals': globals_workload,
+}
+
+
+def assembler_source(scale):
+    """
+    A big assembly program, similar to generated code: many small functions
+    with loops, strings, globals and calls.
+    """
+
+    parts = []
+    for i in range(1000 * scale):
+        parts.append(f'''\
+FUNC "f{i}" 1 2
+    CONST_STRING "function {i}\\n"
+    STORE_LOCAL 1
+F{i}_LOOP:
+    LOAD_LOCAL 0
+    CONST_INT 0
+    CMP_LTE
+    JUMP_IF F{i}_END  # exit the loop
+    LOAD_LOCAL 0
+    CONST_INT_BIG 1000
+    OP_SUB
+    STORE_LOCAL 0
+    LOAD_LOCAL 1
+    CALL_VOID "print" 1
+    JUMP F{i}_LOOP
+F{i}_END:
+    LOAD_GLOBAL "counter"
+    CALL "f{i + 1}" 1
+    RET
+
+''')
+    return ''.join(parts)
+
+
+def measure_assembler(scale, repeat):
+    """
+    Measure assembling a program with Assembler.stream() (as "mini as" does).
+    """
+
+    source = assembler_source(scale)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        asm = Assembler(io.StringIO(source))
+        size = sum(len(data) for data in asm.stream())
+        elapsed = time.perf_counter() - start
+        assert not asm.errors
+        if best is None or elapsed < best:
+            best = elapsed
+    n_lines = source.count('\n')
+    return {
+        'lines': n_lines,
+        'bytes': size,
+        'time': best,
+        'lines_per_sec': n_lines / best,
+    }
+
+
+def workloads(scale):
+    """
+    Yield (name, bytecode) for all workloads.
+    """
+
+    for path in sorted(EXAMPLES_DIR.glob('*.asm')):
+        yield path.stem, run_assembler(path.read_text())
+    for name, make in SYNTHETIC.items():
+        yield name, run_assembler(make(scale))
+
+
+def make_machine(bytecode):
+    machine = Machine(Program(bytecode), output=Output(None, capture=False))
+    machine.on_input = lambda: 'bench'
+    return machine
+
+
+def count(bytecode):
+    """
+    Count instructions and calls (including native ones) executed by a
+    program.
+    """
+
+    machine = make_machine(bytecode)
+    machine.start()
+    n_instrs = n_calls = 0
+    try:
+        while machine.running():
+            instr = machine.instr_at(machine.ip)
+            if instr.op in [Op.CALL, Op.CALL_VOID]:
+                n_calls += 1
+            machine.step()
+            n_instrs += 1
+    except MachineError:
+        pass
+    return n_instrs, n_calls
+
+
+def measure(bytecode, engine, repeat):
+    """
+    Run a program a number of times, and return the best time and the
+    error (if any).
+    """
+
+    best = None
+    error = None
+    for _ in range(repeat):
+        machine = make_machine(bytecode)
+        start = time.perf_counter()
+        try:
+            ENGINES[engine](machine)
+        except MachineError as e:
+            error = str(e)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, error
+
+
+def measure_in_process(conn, bytecode, engine, repeat):
+    import resource
+
+    result = measure(bytecode, engine, repeat)
+    # Maximum resident set size, in kilobytes (on Linux)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    conn.send(result + (peak,))
+    conn.close()
+
+
+def measure_isolated(bytecode, engine, repeat):
+    ctx = multiprocessing.get_context('spawn')
+    parent_conn, child_conn = ctx.Pipe()
+    process = ctx.Process(
+        target=measure_in_process, args=(child_conn, bytes(bytecode), engine, repeat))
+    process.start()
+    result = parent_conn.recv()
+    process.join()
+    return result
+
+
+def startup_time(engine, repeat):
+    """
+    Time to run an empty program with "mini run", including starting Python.
+    """
+
+    with_engine = ['--engine', engine]
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, '-m', 'minivm.run', *with_engine, '-'],
+            input=b'FUNC "main" 0 0\nRET\n',
+            stdout=subprocess.DEVNULL, check=True,
+            cwd=Path(__file__).parent.parent,
+        )
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def run_benchmarks(engines, *, scale=1, repeat=3, only=None, isolate=True, log=None):
+    results = {'engines': {}, 'workloads': {}, 'assembler': None}
+    for engine in engines:
+        results['engines'][engine] = {
+            'startup': startup_time(engine, repeat) if isolate else None,
+        }
+
+    if not only or 'assembler' in only:
+        results['assembler'] = measure_assembler(scale, repeat)
+
+    for name, bytecode in workloads(scale):
+        if only and name not in only:
+            continue
+        n_instrs, n_calls = count(bytecode)
+        runs = {}
+        for engine in engines:
+            if isolate:
+                elapsed, error, peak = measure_isolated(bytecode, engine, repeat)
+            else:
+                (elapsed, error), peak = measure(bytecode, engine, repeat), None
+            elapsed = max(elapsed, 1e-9)
+            runs[engine] = {
+                'time': elapsed,
+                'instrs_per_sec': n_instrs / elapsed,
+                'calls_per_sec': n_calls / elapsed,
+                'peak_kb': peak,
+                'error': error,
+            }
+            if log:
+                log(name, engine, runs[engine])
+        results['workloads'][name] = {
+            'instrs': n_instrs,
+            'calls': n_calls,
+            'runs': runs,
+        }
+    return results
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """
+    Compare results with a baseline. Returns a list of regressions: slower
+    execution (instructions/sec), startup or assembler (lines/sec) by more
+    than threshold percent.
+    """
+
+    regressions = []
+    limit = 1 - threshold / 100
+
+    asm, old = results.get('assembler'), baseline.get('assembler')
+    if asm and old and asm['lines_per_sec'] / old['lines_per_sec'] < limit:
+        regressions.append(
+            f'assembler: {old["lines_per_sec"]:.0f} -> '
+            f'{asm["lines_per_sec"]:.0f} lines/sec')
+
+    for engine, data in results['engines'].items():
+        old = baseline.get('engines', {}).get(engine)
+        if old and old.get('startup') and data.get('startup'):
+            if old['startup'] / data['startup'] < limit:
+                regressions.append(
+                    f'{engine} startup: {old["startup"] * 1000:.1f} ms -> '
+                    f'{data["startup"] * 1000:.1f} ms')
+
+    for name, workload in results['workloads'].items():
+        old_workload = baseline.get('workloads', {}).get(name)
+        if not old_workload:
+            continue
+        for engine, run in workload['runs'].items():
+            old = old_workload['runs'].get(engine)
+            if not old:
+                continue
+            if run['instrs_per_sec'] / old['instrs_per_sec'] < limit:
+                regressions.append(
+                    f'{name} ({engine}): {old["instrs_per_sec"]:.0f} -> '
+                    f'{run["instrs_per_sec"]:.0f} instructions/sec')
+    return regressions
+
+
+def format_run(name, engine, run):
+    peak = f'{run["peak_kb"] / 1024:.1f} MB' if run['peak_kb'] else '-'
+    line = (
+        f'{name:12} {engine:9} {run["time"]:9.3f}s '
+        f'{run["instrs_per_sec"]:14,.0f} {run["calls_per_sec"]:12,.0f} {peak:>9}'
+    )
+    if run['error']:
+        line += f'  (error: {run["error"]})'
+    return line
+
+
+class BenchTest(unittest.TestCase):
+    def test_bench(self):
+        results = run_benchmarks(['step', 'fast'], scale=1, repeat=1,
+                                 only=['calls', 'globals'], isolate=False)
+        calls = results['workloads']['calls']
+        self.assertEqual(calls['calls'], 13529)
+        self.assertEqual(calls['runs']['fast']['error'], None)
+        self.assertGreater(calls['runs']['fast']['instrs_per_sec'], 0)
+        self.assertEqual(compare(results, results), [])
+
+        slower = json.loads(json.dumps(results))
+        slower['workloads']['calls']['runs']['step']['instrs_per_sec'] /= 2
+        self.assertEqual(len(compare(slower, results)), 1)
+        self.assertEqual(compare(results, slower), [])
+
+    def test_workloads(self):
+        # Synthetic workloads have to fit in the program limits (such as
+        # CONST_INT_BIG) at the default scale.
+        for name, make in SYNTHETIC.items():
+            asm = Assembler(make(DEFAULT_SCALE))
+            self.assertIsNotNone(asm.assemble(), (name, list(asm.describe_errors())))
+
+    def test_assembler(self):
+        asm = measure_assembler(1, 1)
+        self.assertEqual(asm['lines'], 20000)
+        self.assertGreater(asm['lines_per_sec'], 0)
+        results = {'engines': {}, 'workloads': {}, 'assembler': asm}
+        slower = json.loads(json.dumps(results))
+        slower['assembler']['lines_per_sec'] /= 2
+        self.assertEqual(len(compare(slower, results)), 1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--engine', choices=ENGINES, action='append',
+        help='engine to benchmark (can be repeated; default: all)',
+    )
+    parser.add_argument(
+        '--workload', action='append',
+        help='workload to run, or "assembler" (can be repeated; default: all)',
+    )
+    parser.add_argument(
+        '--scale', type=int, default=DEFAULT_SCALE,
+        help=f'size of synthetic workloads (default: {DEFAULT_SCALE})',
+    )
+    parser.add_argument(
+        '--repeat', type=int, default=3,
+        help='number of runs; the best time is used (default: 3)',
+    )
+    parser.add_argument(
+        '-o', '--output', metavar='FILE',
+        help='save results to a JSON file',
+    )
+    parser.add_argument(
+        '--baseline', metavar='FILE',
+        help='compare with saved results, and fail on regressions',
+    )
+    parser.add_argument(
+        '--threshold', type=float, default=THRESHOLD,
+        help=f'allowed slowdown in percent (default: {THRESHOLD})',
+    )
+
+    args = parser.parse_args()
+    engines = args.engine or list(ENGINES)
+
+    print(
+        f'{"workload":12} {"engine":9} {"time":>10} {"instrs/sec":>14} '
+        f'{"calls/sec":>12} {"peak mem":>9}'
+    )
+    results = run_benchmarks(
+        engines, scale=args.scale, repeat=args.repeat, only=args.workload,
+        log=lambda *a: print(format_run(*a), flush=True),
+    )
+    print()
+    for engine, data in results['engines'].items():
+        print(f'startup ({engine}): {data["startup"] * 1000:.1f} ms')
+    asm = results['assembler']
+    if asm:
+        print(
+            f'assembler: {asm["lines"]} lines in {asm["time"]:.3f}s, '
+            f'{asm["lines_per_sec"]:,.0f} lines/sec'
+        )
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2) + '\n')
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(file=sys.stderr)
+            print(f'Regressions (more than {args.threshold}% slower):', file=sys.stderr)
+            for regression in regressions:
+                print(f'  {regression}', file=sys.stderr)
+            sys.exit(1)
+        print('No regressions.')
+
+
+if __name__ == '__main__':
+    main()
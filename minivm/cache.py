@@ -0,0 +1,234 @@
+import hashlib
+import os
+from pathlib import Path
+import tempfile
+import time
+import unittest
+
+from .assemble import run_assembler
+from .program import HEADER, OBJECT_HEADER, FORMAT_VERSION, map_file
+
+# Cache of assembled programs, so that running an unchanged source file
+# again does not assemble it again.
+#
+# Each entry is a bytecode (or object) file, named after a hash of the
+# source, the kind of output and the assembler version. Entries are written
+# to a temporary file first, and then renamed, so a process never sees a
+# partially written entry, and processes using the same cache at the same
+# time at worst assemble the same source twice. When the cache grows over
+# its size, least recently used entries (by modification time, updated on
+# every hit) are removed.
+
+# Increase when the assembler produces different bytecode for the same
+# source, so that old entries are not used.
+ASSEMBLER_VERSION = 1
+
+# Default maximum total size of entries, in bytes.
+CACHE_SIZE = 64 * 1024 * 1024
+
+# Temporary files older than that (in seconds) were left by a process that
+# crashed, and are removed on eviction.
+STALE_TIME = 3600
+
+
+def default_cache_dir():
+    path = os.environ.get('MINIVM_CACHE_DIR')
+    if path:
+        return Path(path)
+    base = os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache'
+    return Path(base) / 'minivm'
+
+
+class BytecodeCache:
+    def __init__(self, path=None, size=CACHE_SIZE):
+        self.path = Path(path) if path is not None else default_cache_dir()
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, source, object_file=False):
+        kind = 'object' if object_file else 'program'
+        h = hashlib.sha256(
+            f'minivm {ASSEMBLER_VERSION} {FORMAT_VERSION} {kind}\n'.encode())
+        h.update(source)
+        return h.hexdigest()
+
+    def entry_path(self, key):
+        return self.path / f'{key}.bc'
+
+    def get(self, source, object_file=False):
+        """
+        Return cached bytecode for source (as bytes), or None.
+        """
+
+        path = self.entry_path(self.key(source, object_file))
+        try:
+            data = map_file(path)
+            os.utime(path)
+        except OSError:
+            self.misses += 1
+            return None
+        header = OBJECT_HEADER if object_file else HEADER
+        if data[:len(header)] != header:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def put(self, source, bytecode, object_file=False):
+        """
+        Store bytecode for source. Errors (such as a read-only cache
+        directory) are ignored: the cache is only an optimization.
+        """
+
+        try:
+            self.path.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.tmp-', suffix='.bc')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(bytecode)
+                os.replace(tmp_path, self.entry_path(self.key(source, object_file)))
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            self.evict()
+        except OSError:
+            pass
+
+    def assemble(self, source, object_file=False):
+        """
+        Return bytecode for source (bytes), assembling it if it's not in the
+        cache.
+        """
+
+        bytecode = self.get(source, object_file)
+        if bytecode is None:
+            bytecode = run_assembler(str(source, 'ascii'), object_file=object_file)
+            self.put(source, bytecode, object_file)
+        return bytecode
+
+    def entries(self):
+        """
+        Return (mtime, size, path) for each entry.
+        """
+
+        result = []
+        try:
+            paths = list(self.path.iterdir())
+        except FileNotFoundError:
+            return result
+        now = time.time()
+        for path in paths:
+            try:
+                st = path.stat()
+                if path.name.startswith('.tmp-'):
+                    if st.st_mtime < now - STALE_TIME:
+                        path.unlink()
+                elif path.suffix == '.bc':
+                    result.append((st.st_mtime, st.st_size, path))
+            except OSError:
+                # Removed by another process in the meantime
+                pass
+        return result
+
+    def evict(self):
+        entries = sorted(self.entries(), key=lambda entry: entry[0])
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.size:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        for _, _, path in self.entries():
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+
+def add_cache_arguments(parser):
+    parser.add_argument(
+        '--no-cache', action='store_true',
+        help='always assemble the source, and do not store it in the cache',
+    )
+    parser.add_argument(
+        '--clear-cache', action='store_true',
+        help='remove all assembled programs from the cache first',
+    )
+
+
+def cache_from_args(args):
+    """
+    Return the BytecodeCache to use, according to add_cache_arguments() flags
+    (or None).
+    """
+
+    cache = BytecodeCache()
+    if args.clear_cache:
+        cache.clear()
+    if args.no_cache:
+        return None
+    return cache
+
+
+class CacheTest(unittest.TestCase):
+    code = b'''\
+FUNC "main" 0 0
+    CONST_STRING "hello"
+    RET
+'''
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = BytecodeCache(tmp)
+            self.assertIsNone(cache.get(self.code))
+            bytecode = cache.assemble(self.code)
+            self.assertEqual(bytecode[:len(HEADER)], HEADER)
+            self.assertEqual((cache.hits, cache.misses), (0, 2))
+
+            # Hit, also in another process
+            cache = BytecodeCache(tmp)
+            self.assertEqual(bytes(cache.assemble(self.code)), bytecode)
+            self.assertEqual((cache.hits, cache.misses), (1, 0))
+            self.assertIsNone(cache.get(self.code.replace(b'hello', b'world')))
+            self.assertIsNone(cache.get(self.code, object_file=True))
+
+            # No temporary files are left
+            self.assertEqual([path.name for path in Path(tmp).iterdir()],
+                             [f'{cache.key(self.code)}.bc'])
+
+            # Broken entries are not used
+            cache.entry_path(cache.key(self.code)).write_bytes(b'garbage')
+            self.assertIsNone(cache.get(self.code))
+            self.assertEqual(bytes(cache.assemble(self.code)), bytecode)
+
+            cache.clear()
+            self.assertEqual(list(Path(tmp).iterdir()), [])
+
+    def test_evict(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            sources = [
+                self.code.replace(b'hello', f'hello {i}'.encode()) for i in range(4)
+            ]
+            size = len(run_assembler(str(sources[0], 'ascii')))
+            cache = BytecodeCache(tmp, size=size * 3)
+            for i, source in enumerate(sources[:3]):
+                cache.assemble(source)
+                os.utime(cache.entry_path(cache.key(source)), (i, i))
+            # Using an entry makes it the most recent one.
+            cache.assemble(sources[0])
+
+            stale = Path(tmp) / '.tmp-stale.bc'
+            stale.write_bytes(b'')
+            os.utime(stale, (0, 0))
+
+            cache.assemble(sources[3])
+            self.assertEqual(
+                sorted(path.name for path in Path(tmp).iterdir()),
+                sorted(f'{cache.key(sources[i])}.bc' for i in [0, 2, 3]),
+            )
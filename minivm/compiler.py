@@ -0,0 +1,478 @@
+import unittest
+import weakref
+
+from .assemble import Assembler
+from .program import Op, Program
+from .run import (
+    Frame, Machine, MachineError, NATIVE_FUNCTIONS, STACK_LIMIT, UNDEFINED, check_int,
+)
+from .infer import infer_types, int_operands
+from .memo import pure_functions
+from .rope import both_strings
+from .tokens import dump_value
+from .verify import stack_effect
+
+# The compiled engine translates each FUNC body into a Python function, and
+# runs it with exec(). Basic blocks become branches of a "while True" loop,
+# and the stack slots and locals become Python local variables (s0, s1, ...
+# and l0, l1, ...).
+#
+# A compiled function is called as F(machine, *args). It pushes its own Frame
+# (without stack or locals), so that tracebacks and the fallback to
+# Machine.step() work as usual. Functions that cannot be compiled, and calls
+# that go too deep for the Python stack, are run by Machine.step().
+
+# Maximum number of frames for entering compiled code (deeper calls are
+# interpreted, to stay well within Python's recursion limit).
+DEPTH_LIMIT = 200
+
+# Namespaces of compiled functions, per program.
+_namespaces = weakref.WeakKeyDictionary()
+
+
+class CompileError(Exception):
+    pass
+
+
+def incompatible(a, b):
+    raise MachineError(
+        'incompatible types for comparison: '
+        f'{dump_value(a)} and {dump_value(b)}')
+
+
+def interpret(machine, func, args):
+    frames = machine.frames
+    depth = len(frames)
+    machine.values.extend(args)
+    machine.push_frame(func, void=False)
+    while len(frames) > depth:
+        machine.step()
+    if frames:
+        return machine.values.pop()
+    return machine.result
+
+
+def get_namespace(machine):
+    program = machine.program
+    ns = _namespaces.get(program)
+    if ns is None:
+        ns = {
+            'Frame': Frame,
+            'MachineError': MachineError,
+            'UNDEFINED': UNDEFINED,
+            'check_int': check_int,
+            'incompatible': incompatible,
+            'both_strings': both_strings,
+            'interpret': interpret,
+            'DEPTH_LIMIT': DEPTH_LIMIT,
+        }
+        for i, (name, func) in enumerate(machine.functions.items()):
+            ident = f'F{i}'
+            ns[ident] = make_stub(ns, ident, machine, func)
+            ns[f'FUNC{i}'] = func
+        for i, (name, (n_params, native_func)) in enumerate(NATIVE_FUNCTIONS.items()):
+            ns[f'N{i}'] = native_func
+        _namespaces[program] = ns
+    return ns
+
+
+def make_stub(ns, ident, machine, func):
+    # Compile the function on first call, and replace the stub.
+    def stub(machine, *args):
+        try:
+            source = FunctionCompiler(machine, func).compile()
+        except CompileError:
+            def compiled(machine, *args):
+                return interpret(machine, func, args)
+            compiled.source = None
+        else:
+            exec(source, ns)
+            compiled = ns[ident]
+            compiled.source = source
+        ns[ident] = compiled
+        return compiled(machine, *args)
+
+    return stub
+
+
+def get_function(machine, name):
+    ns = get_namespace(machine)
+    i = list(machine.functions).index(name)
+    return ns[f'F{i}']
+
+
+class FunctionCompiler:
+    def __init__(self, machine, func):
+        self.machine = machine
+        self.func = func
+        self.function_ids = {name: i for i, name in enumerate(machine.functions)}
+        self.native_ids = {name: i for i, name in enumerate(NATIVE_FUNCTIONS)}
+        self.n_vars = func.n_params + func.n_locals
+        self.types = infer_types(machine.program)
+
+        self.instrs = {}
+        self.order = []
+        self.depths = {}
+        self.leaders = set()
+
+    def compile(self):
+        self.collect()
+        self.analyze()
+        return '\n'.join(self.generate()) + '\n'
+
+    def collect(self):
+        # Collect the function body, up to the next FUNC.
+        code = self.machine.code
+        pos = self.func.entry
+        while True:
+            if pos not in code:
+                break
+            instr = code[pos]
+            self.instrs[pos] = instr
+            self.order.append(pos)
+            if instr.op == Op.FUNC:
+                break
+            pos += instr.length
+
+    def successors(self, pos):
+        length, op, args = self.instrs[pos]
+        if op in [Op.RET, Op.FUNC]:
+            return []
+        if op == Op.JUMP:
+            return [pos + args[0]]
+        if op == Op.JUMP_IF:
+            return [pos + length, pos + args[0]]
+        return [pos + length]
+
+    def effect(self, pos):
+        # Returns (number of values popped, number of values pushed).
+        length, op, args = self.instrs[pos]
+        return stack_effect(op, args)
+
+    def analyze(self):
+        # Compute stack depth at each instruction, and find basic blocks.
+        entry = self.func.entry
+        self.depths[entry] = 0
+        self.leaders.add(entry)
+        todo = [entry]
+        while todo:
+            pos = todo.pop()
+            depth = self.depths[pos]
+            n_pop, n_push = self.effect(pos)
+            if depth < n_pop:
+                # Will raise stack underflow
+                continue
+            depth = depth - n_pop + n_push
+            if depth > STACK_LIMIT:
+                # Will raise stack overflow
+                continue
+
+            succ = self.successors(pos)
+            op = self.instrs[pos].op
+            for target in succ:
+                if target not in self.instrs:
+                    raise CompileError(f'control leaves the function: {target:04X}')
+                if op in [Op.JUMP, Op.JUMP_IF]:
+                    self.leaders.add(target)
+                if target in self.depths:
+                    if self.depths[target] != depth:
+                        raise CompileError(f'inconsistent stack depth at {target:04X}')
+                else:
+                    self.depths[target] = depth
+                    todo.append(target)
+
+    def generate(self):
+        func = self.func
+        i = self.function_ids[func.name]
+        params = ''.join(f', l{n}' for n in range(func.n_params))
+        args = ''.join(f'l{n}, ' for n in range(func.n_params))
+        yield f'def F{i}(machine{params}):'
+        yield '    frames = machine.frames'
+        yield '    if len(frames) >= DEPTH_LIMIT:'
+        yield f'        return interpret(machine, FUNC{i}, ({args}))'
+        yield '    values = machine.values'
+        yield (f'    frame = Frame({func.name!r}, {func.entry}, values, len(values), '
+               '0, void=False)')
+        yield '    frames.append(frame)'
+        yield '    g = machine.global_values'
+        for n in range(func.n_params, self.n_vars):
+            yield f'    l{n} = None'
+        yield f'    pc = block = {func.entry}'
+        yield '    try:'
+        yield '        while True:'
+
+        for pos in self.order:
+            if pos not in self.depths:
+                # unreachable
+                continue
+            if pos in self.leaders:
+                yield f'            if block == {pos}:'
+            for line in self.generate_instr(pos):
+                yield ' ' * 16 + line
+
+        yield '    except MachineError:'
+        yield '        frame.prev_ip = pc'
+        yield '        raise'
+
+    def generate_instr(self, pos):
+        length, op, args = self.instrs[pos]
+        depth = self.depths[pos]
+        n_pop, n_push = self.effect(pos)
+        next_pos = pos + length
+
+        if op == Op.FUNC:
+            yield f'pc = {pos}'
+            yield "raise MachineError('trying to execute FUNC')"
+            return
+        # Same order of checks as in Machine.step(): the local number comes
+        # before the stack.
+        if op in [Op.LOAD_LOCAL, Op.STORE_LOCAL] and args[0] >= self.n_vars:
+            yield f'pc = {pos}'
+            yield f'raise MachineError({f"Invalid local number: {args[0]}"!r})'
+            return
+        if depth < n_pop:
+            yield f'pc = {pos}'
+            yield "raise MachineError('stack underflow')"
+            return
+
+        top = f's{depth - 1}'
+        new = f's{depth}'
+        a, b = f's{depth - 2}', f's{depth - 1}'
+        overflows = depth - n_pop + n_push > STACK_LIMIT
+        if overflows and op not in [Op.CALL, Op.CALL_VOID]:
+            yield f'pc = {pos}'
+            yield "raise MachineError('stack overflow')"
+            return
+
+        if op == Op.CONST_NULL:
+            yield f'{new} = None'
+        elif op == Op.CONST_FALSE:
+            yield f'{new} = False'
+        elif op == Op.CONST_TRUE:
+            yield f'{new} = True'
+        elif op in [Op.CONST_INT, Op.CONST_INT_BIG, Op.CONST_STRING]:
+            yield f'{new} = {args[0]!r}'
+
+        elif op == Op.OP_NEG:
+            yield f'pc = {pos}'
+            if not int_operands(self.types, pos, 1):
+                yield f'check_int({top})'
+            yield f'{top} = ((0x8000 - {top}) & 0xFFFF) - 0x8000'
+        elif op in ARITH:
+            yield f'pc = {pos}'
+            if not int_operands(self.types, pos, 2):
+                yield f'if type({a}) is not int or type({b}) is not int:'
+                yield f'    check_int({a})'
+                yield f'    check_int({b})'
+            if op == Op.OP_DIV:
+                yield f'if {b} == 0:'
+                yield "    raise MachineError('division by 0')"
+            elif op == Op.OP_MOD:
+                yield f'if {b} == 0:'
+                yield "    raise MachineError('modulo by 0')"
+            yield f'{a} = (({a} {ARITH[op]} {b} + 0x8000) & 0xFFFF) - 0x8000'
+        elif op == Op.OP_NOT:
+            yield f'{top} = not {top}'
+        elif op in [Op.CMP_EQ, Op.CMP_NE]:
+            yield f'{a} = {a} {COMPARISONS[op]} {b}'
+        elif op in COMPARISONS:
+            if not int_operands(self.types, pos, 2):
+                yield f'pc = {pos}'
+                yield f'if type({a}) is not type({b}) and not both_strings({a}, {b}):'
+                yield f'    incompatible({a}, {b})'
+            yield f'{a} = {a} {COMPARISONS[op]} {b}'
+
+        elif op == Op.DUP:
+            yield f'{new} = {top}'
+        elif op == Op.DROP:
+            pass
+        elif op == Op.LOAD_GLOBAL:
+            name, slot = args
+            yield f'{new} = g[{slot}]'
+            yield f'if {new} is UNDEFINED:'
+            yield f'    pc = {pos}'
+            yield f'    raise MachineError({"Undefined global name: " + name!r})'
+        elif op == Op.STORE_GLOBAL:
+            yield f'g[{args[1]}] = {top}'
+        elif op in [Op.LOAD_LOCAL, Op.STORE_LOCAL]:
+            n = args[0]
+            if op == Op.LOAD_LOCAL:
+                yield f'{new} = l{n}'
+            else:
+                yield f'l{n} = {top}'
+
+        elif op == Op.JUMP:
+            yield f'block = {pos + args[0]}'
+            yield 'continue'
+            return
+        elif op == Op.JUMP_IF:
+            yield f'if {top}:'
+            yield f'    block = {pos + args[0]}'
+            yield '    continue'
+        elif op == Op.RET:
+            yield 'frames.pop()'
+            yield f'return {top if depth > 0 else None}'
+            return
+        elif op in [Op.CALL, Op.CALL_VOID]:
+            yield f'pc = {pos}'
+            yield from self.generate_call(op, args, depth)
+            if overflows:
+                yield "raise MachineError('stack overflow')"
+                return
+        else:
+            assert False, op
+
+        if next_pos in self.leaders:
+            yield f'block = {next_pos}'
+
+    def generate_call(self, op, args, depth):
+        site = args[2]
+        n_args = site.n_args
+        call_args = ''.join(f', s{n}' for n in range(depth - n_args, depth))
+        target = f's{depth - n_args} = ' if op == Op.CALL else ''
+
+        if site.func is not None and site.name in pure_functions(self.machine.program):
+            # The namespace is shared by all machines running the program, so
+            # check if this one uses memoization.
+            ident = f'F{self.function_ids[site.name]}'
+            yield 'if machine.memo is None:'
+            yield f'    {target}{ident}(machine{call_args})'
+            yield 'else:'
+            args_tuple = ''.join(f's{n}, ' for n in range(depth - n_args, depth))
+            yield (f'    {target}machine.memo.call(machine, {site.name!r}, {ident}, '
+                   f'({args_tuple}))')
+        elif site.func is not None:
+            yield f'{target}F{self.function_ids[site.name]}(machine{call_args})'
+        elif site.native_func is not None:
+            yield 'try:'
+            yield f'    {target}N{self.native_ids[site.name]}(machine{call_args})'
+            yield 'except Exception as e:'
+            message = f'Error running native function {site.name}: '
+            yield f'    raise MachineError({message!r} + str(e))'
+        else:
+            yield f'raise MachineError({site.error!r})'
+
+
+ARITH = {
+    Op.OP_ADD: '+',
+    Op.OP_SUB: '-',
+    Op.OP_MUL: '*',
+    Op.OP_DIV: '//',
+    Op.OP_MOD: '%',
+}
+
+COMPARISONS = {
+    Op.CMP_EQ: '==',
+    Op.CMP_NE: '!=',
+    Op.CMP_LT: '<',
+    Op.CMP_LTE: '<=',
+    Op.CMP_GT: '>',
+    Op.CMP_GTE: '>=',
+}
+
+
+def run_compiled(machine):
+    # Compiled code is shared by all machines running the program, and uses
+    # global slot numbers, which are the same only if the whole program is
+    # linked in order.
+    machine.link()
+    machine.start()
+    machine.frames.pop()
+    machine.values.clear()
+    machine.result = get_function(machine, 'main')(machine)
+    return machine.result
+
+
+class CompilerTest(unittest.TestCase):
+    code = '''\
+FUNC "main" 0 1
+    CONST_INT 10
+    STORE_LOCAL 0
+LOOP:
+    LOAD_LOCAL 0
+    CONST_INT 0
+    CMP_LTE
+    JUMP_IF END
+    LOAD_LOCAL 0
+    CALL "fib" 1
+    CALL "to_string" 1
+    CALL_VOID "println" 1
+    LOAD_LOCAL 0
+    CONST_INT 1
+    OP_SUB
+    STORE_LOCAL 0
+    JUMP LOOP
+END:
+    CONST_STRING "x"
+    STORE_GLOBAL "g"
+    CALL "odd" 0
+    RET
+
+FUNC "fib" 1 0
+    LOAD_LOCAL 0
+    CONST_INT 2
+    CMP_LT
+    JUMP_IF SMALL
+    LOAD_LOCAL 0
+    CONST_INT 1
+    OP_SUB
+    CALL "fib" 1
+    LOAD_LOCAL 0
+    CONST_INT 2
+    OP_SUB
+    CALL "fib" 1
+    OP_ADD
+    RET
+SMALL:
+    LOAD_LOCAL 0
+    RET
+
+# Not compiled: different stack depth on both paths
+FUNC "odd" 0 0
+    LOAD_GLOBAL "g"
+    JUMP_IF SKIP
+    CONST_INT 1
+SKIP:
+    LOAD_GLOBAL "g"
+    CONST_INT 1
+    OP_ADD
+    RET
+'''
+
+    def run_machine(self, program, engine):
+        machine = Machine(program)
+        machine.use_io = False
+        try:
+            result = engine(machine)
+        except MachineError as e:
+            return 'error', str(e), list(machine.traceback())
+        return result, machine.output
+
+    def test_same_error(self):
+        program = Program(Assembler(self.code).assemble())
+        expected = self.run_machine(program, Machine.run)
+        self.assertEqual(expected[0], 'error')
+        self.assertEqual(self.run_machine(program, run_compiled), expected)
+
+        # The local number is checked before the stack.
+        code = 'FUNC "main" 0 1\nSTORE_LOCAL 5\nCONST_NULL\nRET\n'
+        program = Program(Assembler(code).assemble())
+        expected = self.run_machine(program, Machine.run)
+        self.assertEqual(expected[:2], ('error', 'Invalid local number: 5'))
+        self.assertEqual(self.run_machine(program, Machine.run_fast), expected)
+        self.assertEqual(self.run_machine(program, run_compiled), expected)
+
+    def test_same_result(self):
+        code = self.code.replace('CONST_STRING "x"', 'CONST_INT 5')
+        program = Program(Assembler(code).assemble())
+        expected = self.run_machine(program, Machine.run)
+        self.assertEqual(expected[0], 6)
+        self.assertEqual(self.run_machine(program, run_compiled), expected)
+
+        # Compiled once per program
+        machine = Machine(program)
+        fib = get_function(machine, 'fib')
+        self.assertIsNotNone(fib.source)
+        self.assertIsNone(get_function(machine, 'odd').source)
+        self.run_machine(program, run_compiled)
+        self.assertIs(get_function(machine, 'fib'), fib)
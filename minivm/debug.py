@@ -1,14 +1,218 @@
 import argparse
+import operator
+import re
 import sys
-from pathlib import Path
 import curses
-
-from .tokens import dump_value
-from .program import HEADER, Program
-from .run import Machine
-from .assemble import run_assembler
+import unittest
+from collections import deque
+
+from .tokens import ParseError, Scanner, TIdent, TInteger, TString, dump_value
+from .program import Program
+from .rope import is_string
+from .run import Machine, MachineError, UNDEFINED, read_bytecode
+from .cache import add_cache_arguments, cache_from_args
 from .disassemble import Disassembler
 
+# Breakpoints and watchpoints.
+#
+# A breakpoint stops the program before the instruction at a given offset.
+# The location is an offset (a number, `$` for hexadecimal), a label (as shown
+# in the disassembly), or a function name (its first instruction). With a
+# condition (`LOCATION if VARIABLE OP VALUE`), the program stops only if the
+# condition is true, for instance:
+#
+#     $1F
+#     L3 if local 0 == 3
+#     "fib" if global count >= 100
+#
+# A watchpoint stops the program when a variable (`local N` of the current
+# frame, or `global NAME`) changes.
+#
+# When continuing, the machine runs instruction by instruction, with no UI
+# work, and only checks whether there is a breakpoint at the next offset (and
+# watchpoints, if there are any).
+
+COMPARISONS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+CONDITION_RE = re.compile(r'(.*?)\s*(==|!=|<=|>=|<|>)\s*(.*)')
+IF_RE = re.compile(r'\s+if\s+')
+
+
+class DebugError(Exception):
+    pass
+
+
+def scan(text):
+    try:
+        return list(Scanner(text, 0).iter())
+    except ParseError as e:
+        raise DebugError(e.message)
+
+
+def value_kind(value):
+    return str if is_string(value) else type(value)
+
+
+def same_value(a, b):
+    # true == 1 in Python, so the types are compared too.
+    return a is b or (value_kind(a) == value_kind(b) and a == b)
+
+
+def show_value(value):
+    return 'undefined' if value is UNDEFINED else dump_value(value)
+
+
+def parse_value(text):
+    tokens = scan(text)
+    if len(tokens) == 1:
+        token = tokens[0]
+        if isinstance(token, (TInteger, TString)):
+            return token.value
+        if isinstance(token, TIdent) and token.value in ['null', 'true', 'false']:
+            return {'null': None, 'true': True, 'false': False}[token.value]
+    raise DebugError(f'expected a number, string, true, false or null: {text}')
+
+
+class Variable:
+    """
+    A local variable of a frame (`local N`), or a global variable (`global
+    NAME`).
+    """
+
+    def __init__(self, kind, key):
+        self.kind = kind
+        self.key = key
+
+    @classmethod
+    def parse(cls, text):
+        tokens = scan(text)
+        if len(tokens) == 2 and isinstance(tokens[0], TIdent):
+            kind, token = tokens[0].value, tokens[1]
+            if kind == 'local' and isinstance(token, TInteger) and token.value >= 0:
+                return cls(kind, token.value)
+            if kind == 'global' and isinstance(token, (TIdent, TString)):
+                return cls(kind, token.value)
+        raise DebugError(f"expected 'local N' or 'global NAME': {text}")
+
+    def get(self, machine, frame=None):
+        if self.kind == 'global':
+            return machine.globals.get(self.key, UNDEFINED)
+        if frame is None:
+            frame = machine.frames[-1]
+        if self.key >= frame.n_vars:
+            return UNDEFINED
+        return frame.values[frame.base + self.key]
+
+    def __str__(self):
+        return f'{self.kind} {self.key}'
+
+
+class Condition:
+    def __init__(self, var, op, value):
+        self.var = var
+        self.op = op
+        self.value = value
+
+    @classmethod
+    def parse(cls, text):
+        m = CONDITION_RE.fullmatch(text.strip())
+        if not m:
+            raise DebugError(f'expected VARIABLE OP VALUE: {text}')
+        return cls(Variable.parse(m.group(1)), m.group(2), parse_value(m.group(3)))
+
+    def check(self, machine):
+        value = self.var.get(machine)
+        if self.op in ['==', '!=']:
+            return same_value(value, self.value) == (self.op == '==')
+        # Only numbers and strings are ordered.
+        kind = value_kind(value)
+        if kind != value_kind(self.value) or kind not in [int, str]:
+            return False
+        return COMPARISONS[self.op](value, self.value)
+
+
+class Breakpoint:
+    def __init__(self, pos, text, condition=None):
+        self.pos = pos
+        self.text = text
+        self.condition = condition
+
+
+class Watchpoint:
+    def __init__(self, var, machine):
+        self.var = var
+        # Locals are watched only in the frame that was current when the
+        # watchpoint was set.
+        self.frame = machine.frames[-1] if var.kind == 'local' else None
+        if self.frame is not None and var.key >= self.frame.n_vars:
+            raise DebugError(f'{self.frame.name} has only {self.frame.n_vars} locals')
+        self.value = var.get(machine, self.frame)
+
+    def check(self, machine):
+        """
+        Return (old value, new value) if the variable changed, or None.
+        """
+
+        # Locals of a frame change only when it's on top.
+        if self.frame is not None and machine.frames[-1] is not self.frame:
+            return None
+        value = self.var.get(machine, self.frame)
+        if same_value(value, self.value):
+            return None
+        old, self.value = self.value, value
+        return old, value
+
+
+class OutputView:
+    """
+    Last lines of program output, wrapped to the window width. The output is
+    processed as it comes (see update()), so that drawing it takes time
+    proportional to the window size, not to the whole output.
+    """
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        # Last lines of output; the last one is not finished yet. Each line
+        # takes at least one row, so that's enough to fill the window.
+        self.lines = deque([''], maxlen=height + 1)
+        # Position in Output (see Output.position) processed so far
+        self.position = 0
+
+    def update(self, out):
+        text = out.tail(self.position)
+        self.position = out.position
+        if text:
+            parts = text.split('\n')
+            self.lines[-1] += parts[0]
+            self.lines.extend(parts[1:])
+
+    def rows(self):
+        w = self.width
+        rows = []
+        lines = list(self.lines)
+        if lines[-1] == '':
+            lines.pop()
+        for line in reversed(lines):
+            if line == '':
+                rows.append('')
+            n = (len(line) + w - 1) // w
+            for i in range(n - 1, -1, -1):
+                if len(rows) == self.height:
+                    break
+                rows.append(line[i * w:(i + 1) * w])
+            if len(rows) == self.height:
+                break
+        rows.reverse()
+        return rows
+
 
 class Colors:
     def __init__(self):
@@ -33,9 +237,22 @@ class Debugger:
 
         dis = Disassembler(program, hex=False, color=False)
         self.instructions = list(dis.dump_lines())
+        # Offset -> index in self.instructions
+        self.lines = {pos: i for i, (pos, line) in enumerate(self.instructions) if line}
+        # Label -> offset
+        self.labels = {label: pos for pos, label in dis.targets.items()}
+
+        # Offset -> breakpoints there
+        self.breakpoints = {}
+        self.watchpoints = []
+        # Status line: why the program stopped, or an error
+        self.message = ''
+        self.error = None
+        self.output_view = None
 
     def init_curses(self):
         self.window = curses.initscr()
+        curses.noecho()
         self.h, self.w = self.window.getmaxyx()
         self.win_code = curses.newwin(self.h - 2, self.w // 2 - 1, 1, 0)
         self.win_frames = curses.newwin(
@@ -46,6 +263,9 @@ class Debugger:
             self.h // 2 - 3, self.w // 2 - 1,
             self.h // 2 + 2, self.w // 2
         )
+        if self.output_view is None:
+            h, w = self.win_output.getmaxyx()
+            self.output_view = OutputView(w - 1, h)
 
         self.colors = Colors()
         curses.curs_set(0)
@@ -59,8 +279,21 @@ class Debugger:
         self.init_curses()
         return result
 
+    def prompt(self, text):
+        self.window.move(0, 0)
+        self.window.clrtoeol()
+        self.window.addstr(0, 1, text)
+        curses.echo()
+        curses.curs_set(1)
+        try:
+            return self.window.getstr(0, 1 + len(text)).decode('ascii', 'replace')
+        finally:
+            curses.noecho()
+            curses.curs_set(0)
+
     def refresh(self):
         self.window.clear()
+        self.draw_status()
         self.draw_help()
         self.draw_code()
         self.draw_frames()
@@ -72,26 +305,120 @@ class Debugger:
         self.win_output.refresh()
 
     def run(self):
-        while self.machine.running():
+        while self.machine.running() and self.error is None:
             self.refresh()
             c = self.window.getch()
             self.run_command(c)
+        if self.error is not None:
+            self.refresh()
+            self.window.getch()
         return self.machine.result
 
     def run_command(self, c):
-        if c == ord('n'):
-            self.machine.step()
-        elif c == ord('q'):
-            sys.exit(0)
+        try:
+            if c == ord('n'):
+                self.next()
+            elif c == ord('c'):
+                self.cont()
+            elif c == ord('b'):
+                bp = self.add_breakpoint(self.prompt('break: '))
+                self.message = f'breakpoint set at {bp.pos:04X}'
+            elif c == ord('w'):
+                wp = self.add_watchpoint(self.prompt('watch: '))
+                self.message = f'watching {wp.var}: {show_value(wp.value)}'
+            elif c == ord('d'):
+                self.breakpoints.clear()
+                self.watchpoints.clear()
+                self.message = 'all breakpoints and watchpoints deleted'
+            elif c == ord('q'):
+                sys.exit(0)
+        except DebugError as e:
+            self.message = f'error: {e}'
+        except MachineError as e:
+            self.error = e
+            self.message = f'error: {e} (press any key)'
+
+    def location(self, text):
+        tokens = scan(text)
+        if len(tokens) != 1:
+            raise DebugError(f'expected an offset, label or function: {text}')
+        token = tokens[0]
+        if isinstance(token, TInteger):
+            if token.value not in self.lines:
+                raise DebugError(f'no instruction at offset {token.value:04X}')
+            return token.value
+        if isinstance(token, TIdent) and token.value.upper() in self.labels:
+            return self.labels[token.value.upper()]
+        if isinstance(token, (TIdent, TString)):
+            if token.value in self.machine.functions:
+                return self.machine.functions[token.value].entry
+            raise DebugError(f'unknown function: {token.value}')
+        raise DebugError(f'expected an offset, label or function: {text}')
+
+    def add_breakpoint(self, spec):
+        spec = spec.strip()
+        location, *condition = IF_RE.split(spec, 1)
+        pos = self.location(location)
+        bp = Breakpoint(pos, spec, Condition.parse(condition[0]) if condition else None)
+        self.breakpoints.setdefault(pos, []).append(bp)
+        return bp
+
+    def add_watchpoint(self, spec):
+        wp = Watchpoint(Variable.parse(spec), self.machine)
+        self.watchpoints.append(wp)
+        return wp
+
+    def check_stop(self):
+        """
+        Check watchpoints and breakpoints at the current instruction. Return
+        a message saying why the program should stop, or None.
+        """
+
+        machine = self.machine
+        for wp in self.watchpoints:
+            change = wp.check(machine)
+            if change is not None:
+                old, new = change
+                return f'{wp.var} changed: {show_value(old)} -> {show_value(new)}'
+
+        for bp in self.breakpoints.get(machine.frames[-1].ip, []):
+            if bp.condition is None or bp.condition.check(machine):
+                return f'breakpoint: {bp.text}'
+        return None
+
+    def next(self):
+        self.machine.step()
+        if self.machine.running():
+            self.message = self.check_stop() or ''
+        else:
+            self.message = 'program finished'
+
+    def cont(self):
+        """
+        Run until a breakpoint or watchpoint is hit, or the program ends.
+        """
+
+        frames = self.machine.frames
+        step = self.machine.step
+        breakpoints = self.breakpoints
+        watching = bool(self.watchpoints)
+        while frames:
+            step()
+            if frames and (watching or frames[-1].ip in breakpoints):
+                message = self.check_stop()
+                if message is not None:
+                    self.message = message
+                    return
+        self.message = 'program finished'
+
+    def draw_status(self):
+        self.window.addstr(0, 1, self.message[:self.w - 2], self.colors.BOLD)
 
     def draw_code(self):
         self.win_code.clear()
         h, w = self.win_code.getmaxyx()
 
-        ip_line = None
-        for i, (pos, line) in enumerate(self.instructions):
-            if line and pos == self.machine.ip:
-                ip_line = i
+        ip_line = self.lines.get(self.machine.ip)
 
         start = max(0, (ip_line or 0) - h // 2)
         end = min(len(self.instructions), start + h)
@@ -103,7 +430,12 @@ class Debugger:
             if not line:
                 continue
 
-            prefix = '>' if i == ip_line else ' '
+            if i == ip_line:
+                prefix = '>'
+            elif pos in self.breakpoints:
+                prefix = '*'
+            else:
+                prefix = ' '
             self.win_code.addstr(y, 0, f'{prefix} {pos:04X}')
             self.win_code.addstr(y, 7, line[:w-8])
             attr = self.colors.REVERSE if i == ip_line else self.colors.NORMAL
@@ -111,56 +443,161 @@ class Debugger:
 
     def draw_frames(self):
         self.win_frames.refresh()
+        h, w = self.win_frames.getmaxyx()
 
+        # Only the innermost frames, if there are too many
+        frames = self.machine.frames[-max(1, h // 4):]
         y = 0
-        for frame in self.machine.frames:
+        for frame in frames:
             self.draw_frame_title(frame, y)
             y += 1
-        self.draw_frame_details(self.machine.frames[-1], y)
+        self.draw_frame_details(frames[-1], y)
 
     def draw_frame_title(self, frame, y):
         h, w = self.win_frames.getmaxyx()
-        self.win_frames.addstr(y, 0, f'{frame.name} ({frame.ip:04X})')
+        self.win_frames.addstr(y, 0, f'{frame.name} ({frame.ip:04X})'[:w-1])
         self.win_frames.chgat(y, 0, w, self.colors.BOLD)
 
     def draw_frame_details(self, frame, y):
         h, w = self.win_frames.getmaxyx()
-        self.win_frames.addstr(y, 1, f'Locals ({len(frame.locals)}):', self.colors.DIM)
+        locals = frame.locals
+        stack = frame.stack
+        self.win_frames.addstr(y, 1, f'Locals ({len(locals)}):', self.colors.DIM)
         y += 1
-        for i, value in enumerate(frame.locals):
+        for i, value in enumerate(locals[:max(0, h - y - 3)]):
             self.win_frames.addstr(y, 2, f'{i:-2}: {dump_value(value)}'[:w-3])
             y += 1
 
-        self.win_frames.addstr(y, 1, f'Stack ({len(frame.stack)}):', self.colors.DIM)
+        if y >= h - 1:
+            return
+        self.win_frames.addstr(y, 1, f'Stack ({len(stack)}):', self.colors.DIM)
         y += 1
-        start = max(0, len(frame.stack) - 8)
-        for i in range(start, len(frame.stack)):
-            prefix = '> ' if i == len(frame.stack) - 1 else '  '
-            self.win_frames.addstr(y, 1, (prefix + dump_value(frame.stack[i]))[:w-2])
+        start = max(0, len(stack) - min(8, h - y - 1))
+        for i in range(start, len(stack)):
+            prefix = '> ' if i == len(stack) - 1 else '  '
+            self.win_frames.addstr(y, 1, (prefix + dump_value(stack[i]))[:w-2])
             y += 1
 
     def draw_help(self):
         y = self.h - 1
-        self.window.addstr(y, 1, 'n - next instruction, q - quit', self.colors.DIM)
+        self.window.addstr(
+            y, 1,
+            ('n - next instruction, c - continue, b - break, w - watch, '
+             'd - delete all, q - quit')[:self.w - 2],
+            self.colors.DIM,
+        )
 
     def draw_output(self):
-        output = self.machine.output
-
         self.win_output.clear()
-        h, w = self.win_output.getmaxyx()
-
-        lines = []
-        for line in output.splitlines():
-            if line == '':
-                lines.append(line)
-            else:
-                while line:
-                    line_part, line = line[:w], line[w:]
-                    lines.append(line_part)
-
-        start = max(0, len(lines) - h)
-        for i in range(start, len(lines)):
-            self.win_output.addstr(i - start, 0, lines[i])
+        self.output_view.update(self.machine.out)
+        for y, row in enumerate(self.output_view.rows()):
+            self.win_output.addstr(y, 0, row)
+
+
+class DebuggerTest(unittest.TestCase):
+    code = '''\
+FUNC "main" 0 1
+    CONST_INT 0
+    STORE_GLOBAL "total"
+    CONST_INT 5
+    STORE_LOCAL 0
+LOOP:
+    LOAD_LOCAL 0
+    CALL "f" 1
+    CALL_VOID "println" 1
+    LOAD_LOCAL 0
+    CONST_INT 1
+    OP_SUB
+    DUP
+    STORE_LOCAL 0
+    JUMP_IF LOOP
+    LOAD_GLOBAL "total"
+    RET
+
+FUNC "f" 1 0
+    LOAD_GLOBAL "total"
+    LOAD_LOCAL 0
+    OP_ADD
+    STORE_GLOBAL "total"
+    LOAD_LOCAL 0
+    CONST_INT 2
+    OP_MUL
+    RET
+'''
+
+    def debugger(self):
+        from .assemble import Assembler
+
+        return Debugger(Program(Assembler(self.code).assemble()))
+
+    def test_breakpoints(self):
+        debugger = self.debugger()
+        machine = debugger.machine
+        debugger.add_breakpoint('f if local 0 <= 3')
+        debugger.cont()
+        self.assertEqual(debugger.message, 'breakpoint: f if local 0 <= 3')
+        self.assertEqual(machine.frames[-1].name, 'f')
+        self.assertEqual(machine.frames[-1].locals, [3])
+        self.assertEqual(machine.output, '10\n8\n')
+
+        debugger.add_watchpoint('global total')
+        debugger.cont()
+        self.assertEqual(debugger.message, 'global total changed: 9 -> 12')
+
+        # The label of LOOP
+        debugger.breakpoints.clear()
+        debugger.add_breakpoint('L1')
+        debugger.cont()
+        self.assertEqual(debugger.message, 'breakpoint: L1')
+        self.assertEqual(machine.frames[-1].locals, [2])
+        pos = machine.ip
+
+        debugger.watchpoints.clear()
+        debugger.add_watchpoint('local 0')
+        debugger.cont()
+        self.assertEqual(debugger.message, 'local 0 changed: 2 -> 1')
+
+        debugger.watchpoints.clear()
+        debugger.breakpoints.clear()
+        debugger.add_breakpoint(f'${pos:X} if global "total" == 13')
+        debugger.cont()
+        self.assertEqual(debugger.message, 'program finished')
+        self.assertEqual(machine.result, 15)
+
+    def test_errors(self):
+        debugger = self.debugger()
+        for spec, message in [
+            ('g', 'unknown function: g'),
+            ('$1', 'no instruction at offset 0001'),
+            ('f if local 0', 'expected VARIABLE OP VALUE: local 0'),
+            ('f if local 0 == x', 'expected a number, string, true, false or null: x'),
+            ('f if locals 0 == 1', "expected 'local N' or 'global NAME': locals 0"),
+        ]:
+            with self.assertRaisesRegex(DebugError, '^' + re.escape(message) + '$'):
+                debugger.add_breakpoint(spec)
+        with self.assertRaisesRegex(DebugError, 'main has only 1 locals'):
+            debugger.add_watchpoint('local 1')
+
+    def test_next(self):
+        debugger = self.debugger()
+        debugger.add_watchpoint('global total')
+        for i in range(2):
+            debugger.next()
+        self.assertEqual(debugger.message, 'global total changed: undefined -> 0')
+        self.assertEqual(debugger.lines[debugger.machine.ip], 4)
+
+    def test_output(self):
+        from .output import Output
+
+        out = Output()
+        view = OutputView(4, 3)
+        out.write('ab\n\nabcdefghij')
+        view.update(out)
+        self.assertEqual(view.rows(), ['abcd', 'efgh', 'ij'])
+        out.write('\nxy\n')
+        view.update(out)
+        self.assertEqual(view.rows(), ['efgh', 'ij', 'xy'])
+        self.assertEqual(list(view.lines), ['', 'abcdefghij', 'xy', ''])
 
 
 def main():
@@ -169,26 +606,42 @@ def main():
         'input_file', metavar='INPUT_FILE',
         help='input file, or - for stdin',
     )
+    parser.add_argument(
+        '-b', '--break', dest='breakpoints', metavar='LOCATION', action='append',
+        default=[],
+        help='set a breakpoint (offset, label or function, with an optional '
+        '"if VARIABLE OP VALUE")',
+    )
+    parser.add_argument(
+        '-w', '--watch', dest='watchpoints', metavar='VARIABLE', action='append',
+        default=[],
+        help='set a watchpoint ("local N" or "global NAME")',
+    )
+    add_cache_arguments(parser)
 
     args = parser.parse_args()
 
-    if args.input_file == '-':
-        data = sys.stdin.buffer.read()
-    else:
-        data = Path(args.input_file).read_bytes()
-
-    if data.startswith(HEADER):
-        bytecode = data
-    else:
-        bytecode = run_assembler(data.decode('ascii'))
-
-    program = Program(bytecode)
+    program = Program(read_bytecode(args.input_file, cache_from_args(args)))
 
     debugger = Debugger(program)
+    try:
+        for spec in args.breakpoints:
+            debugger.add_breakpoint(spec)
+        for spec in args.watchpoints:
+            debugger.add_watchpoint(spec)
+    except DebugError as e:
+        parser.error(str(e))
+
     try:
         debugger.init_curses()
         result = debugger.run()
     finally:
         debugger.close_curses()
 
+    if debugger.error is not None:
+        print('Traceback (most recent frame last):', file=sys.stderr)
+        for error_line in debugger.machine.traceback():
+            print(error_line, file=sys.stderr)
+        print(f'error: {debugger.error}', file=sys.stderr)
+        sys.exit(1)
     print(f'result: {dump_value(result)}')
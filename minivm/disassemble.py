@@ -4,15 +4,23 @@ import argparse
 import sys
 from pathlib import Path
 
-from .program import Op, PARAMS, Param, Program, HEADER
+from .program import Op, PARAMS, Param, Program, HEADER, encode_instr, map_file
 from .tokens import dump_value
 
 
 class Disassembler:
-    def __init__(self, program, hex=True, color=True):
+    """
+    Disassembles the program, or only the instructions from start to end (if
+    given, start has to be the offset of an instruction). Labels are only
+    used for jumps inside that part.
+    """
+
+    def __init__(self, program, hex=True, color=True, start=None, end=None):
         self.program = program
         self.hex = hex
         self.color = color
+        self.start = start
+        self.end = end
 
         self.targets = {}
         self.collect_labels()
@@ -38,20 +46,17 @@ class Disassembler:
         return s
 
     def dump_lines(self):
-        for pos, length, op, args in self.program.iter():
+        for pos, length, op, args in self.program.iter(self.start, self.end):
             if op == Op.FUNC:
                 yield pos, ''
             yield pos, self.dump_line(pos, length, op, args)
 
-    def dump(self):
-        lines = []
-        for pos, length, op, args in self.program.iter():
-            if op == Op.FUNC:
-                lines.append("")
-
-            lines.append(self.dump_line(pos, length, op, args))
+    def lines(self):
+        for pos, line in self.dump_lines():
+            yield line
 
-        return "\n".join(lines) + "\n"
+    def dump(self):
+        return ''.join(line + '\n' for line in self.lines())
 
     def dump_line(self, pos, length, op, args):
         if pos in self.targets:
@@ -103,13 +108,13 @@ class Disassembler:
         self.targets.clear()
 
         positions = set()
-        for pos, length, op, args in self.program.iter():
+        for pos, length, op, args in self.program.iter(self.start, self.end):
             if op != Op.FUNC:
                 positions.add(pos)
 
         counter = 1
 
-        for pos, length, op, args in self.program.iter():
+        for pos, length, op, args in self.program.iter(self.start, self.end):
             if op in [Op.JUMP, Op.JUMP_IF]:
                 target = pos + args[0]
                 if target not in positions:
@@ -135,6 +140,57 @@ class Disassembler:
         return result
 
 
+def function_range(program, name):
+    """
+    Return (start, end) of the code of a function, or None if there is no
+    such function. In the indexed format, the function table is used instead
+    of decoding the program.
+    """
+
+    entry = program.function(name)
+    if entry is None:
+        return None
+    start, length, args = entry
+    if program.func_offsets is not None:
+        end = min((pos for pos in program.func_offsets if pos > start),
+                  default=program.code_end)
+        return start, end
+
+    for pos, length, op, args in program.iter(start + length):
+        if op == Op.FUNC:
+            return start, pos
+    return start, program.code_end
+
+
+def align(program, pos):
+    """
+    Return the offset of the first instruction at pos or later. In the
+    indexed format, decoding starts from the closest function before pos.
+    """
+
+    base = program.code_start
+    if program.func_offsets is not None:
+        base = max((start for start in program.func_offsets if start <= pos),
+                   default=base)
+    for instr_pos, length, op, args in program.iter(base):
+        if instr_pos >= pos:
+            return instr_pos
+    return program.code_end
+
+
+def parse_range(s):
+    start, sep, end = s.partition(':')
+    if not sep:
+        raise argparse.ArgumentTypeError(f'expected START:END: {s}')
+    try:
+        return (
+            int(start, 16) if start else None,
+            int(end, 16) if end else None,
+        )
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid range: {s}')
+
+
 class DisassemblerTest(unittest.TestCase):
     def test_disassemble(self):
         bytecode = [
@@ -165,6 +221,86 @@ L1: CALL "print" 1
     RET
 ''')
 
+    def test_wide(self):
+        from .assemble import Assembler
+
+        code = '''\
+
+    FUNC "main" 0 300
+    STORE_LOCAL 299
+L2: JUMP_IF L1  # +32774, 801E
+''' + '    DUP\n' * 32768 + '''\
+L1: JUMP L2  # -32774, 0018
+    RET
+'''
+        bytecode = Assembler(code).assemble()
+        program = Program(bytecode)
+        dis = Disassembler(program, hex=False, color=False)
+        self.assertEqual(dis.dump(), code)
+        self.assertEqual(Assembler(dis.dump()).assemble(), bytecode)
+
+        lines = Disassembler(program, color=False).dump().splitlines()
+        self.assertEqual(lines[1].split('#')[-1],
+                         ' 000A:  0F 01 00 00 00 00 00 00 2C 01')
+        self.assertEqual(lines[2].split('#')[-1], ' 0014:  0F 4B 2B 01')
+        self.assertEqual(lines[-1].split('#')[-1], ' 8024:  58')
+
+    def test_region(self):
+        from .assemble import Assembler
+
+        main = '''\
+
+    FUNC "main" 0 1
+TOP: CALL "f" 0
+    JUMP_IF TOP
+    JUMP -5  # -5, 0011 (unknown)
+    RET
+'''
+        f = '''\
+
+    FUNC "f" 0 0
+    CONST_FALSE
+    JUMP_IF L1  # +5, 0025
+    CONST_TRUE
+    RET
+L1: CONST_NULL
+    RET
+'''
+        g = '''\
+
+    FUNC "g" 0 0
+    CONST_NULL
+    RET
+'''
+        program = Program(Assembler(main + f + g).assemble())
+        start, end = function_range(program, 'f')
+        dis = Disassembler(program, hex=False, color=False, start=start, end=end)
+        self.assertEqual(dis.dump(), f)
+        self.assertEqual(function_range(program, 'g')[1], program.code_end)
+        self.assertIsNone(function_range(program, 'h'))
+
+        # From the middle of JUMP_IF in "main", until CONST_TRUE in "f"
+        start = align(program, 0x14)
+        self.assertEqual(start, 0x16)
+        dis = Disassembler(program, hex=False, color=False, start=start, end=0x23)
+        self.assertEqual(list(dis.lines()), [
+            '    JUMP -5  # -5, 0011 (unknown)',
+            '    RET',
+            '',
+            '    FUNC "f" 0 0',
+            '    CONST_FALSE',
+            '    JUMP_IF 5  # +5, 0025 (unknown)',
+        ])
+
+        # Without the function table
+        code = b''.join(encode_instr(op, args) for _, _, op, args in program.iter())
+        old = Program([*HEADER, *code])
+        self.assertEqual(function_range(old, 'g')[0], function_range(old, 'f')[1])
+        start, end = function_range(old, 'g')
+        dis = Disassembler(old, hex=False, color=False, start=start, end=end)
+        self.assertEqual(dis.dump(), g)
+        self.assertEqual(align(old, start + 1), start + 5)
+
 
 def main():
     parser = argparse.ArgumentParser()
@@ -181,22 +317,46 @@ def main():
         '--hex', action='store_true',
         help='annotate with addresses',
     )
+    region = parser.add_mutually_exclusive_group()
+    region.add_argument(
+        '--function', metavar='NAME',
+        help='disassemble only the given function',
+    )
+    region.add_argument(
+        '--range', metavar='START:END', type=parse_range,
+        help='disassemble only the instructions between given (hexadecimal) offsets',
+    )
 
     args = parser.parse_args()
 
     if args.input_file == '-':
         bytecode = sys.stdin.buffer.read()
     else:
-        bytecode = Path(args.input_file).read_bytes()
+        bytecode = map_file(args.input_file)
 
     color = sys.stdout.isatty() and args.output_file == '-'
     program = Program(bytecode)
-    output = Disassembler(program, color=color, hex=args.hex).dump()
 
-    if args.output_file == '-':
-        sys.stdout.write(output)
-    else:
-        Path(args.output_file).write_text(output)
+    start = end = None
+    if args.function is not None:
+        region = function_range(program, args.function)
+        if region is None:
+            print(f'error: function not found: {args.function}', file=sys.stderr)
+            sys.exit(1)
+        start, end = region
+    elif args.range is not None:
+        start, end = args.range
+        if start is not None:
+            start = align(program, start)
+
+    dis = Disassembler(program, color=color, hex=args.hex, start=start, end=end)
+    out = sys.stdout if args.output_file == '-' else open(args.output_file, 'w')
+    try:
+        for line in dis.lines():
+            out.write(line + '\n')
+    finally:
+        if out is not sys.stdout:
+            out.close()
 
 
 if __name__ == '__main__':
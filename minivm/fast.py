@@ -0,0 +1,1227 @@
+import operator
+import unittest
+import weakref
+from collections import Counter
+
+from .assemble import Assembler
+from .program import Op, Program, ProgramError
+from .run import Frame, Machine, MachineError, STACK_LIMIT, UNDEFINED, check_int
+from .tokens import dump_value
+from .infer import INT, STRING, infer_types, int_operands
+from .memo import memo_key
+from .rope import both_strings
+from .verify import check
+
+# The fast engine translates the program into a table of entries:
+#
+#     ip -> (handler, arg, next_ip)
+#
+# and runs it in a single loop (run_fast). A handler is called as
+# handler(values, frame, arg), where values is Machine.values and frame is the
+# top frame, and returns:
+#
+#  - None, to continue at next_ip,
+#  - a non-negative offset, to jump there,
+#  - FRAME_CHANGED, after pushing or popping a frame.
+
+FRAME_CHANGED = -1
+
+# Tables built by run_fast(), per machine and options. Entries refer to the
+# lists of the machine (frames, global values), which Machine.restore() keeps,
+# so the machine can be restored and run again without building a new table.
+_tables = weakref.WeakKeyDictionary()
+
+
+def wrap(n):
+    # Same as run.overflow(), as a single expression.
+    return ((n + 0x8000) & 0xFFFF) - 0x8000
+
+
+def underflow():
+    raise MachineError('stack underflow')
+
+
+def overflow_error():
+    raise MachineError('stack overflow')
+
+
+def op_func(values, frame, arg):
+    raise MachineError('trying to execute FUNC')
+
+
+def op_const(values, frame, val):
+    if len(values) >= frame.limit:
+        overflow_error()
+    values.append(val)
+
+
+def op_neg(values, frame, arg):
+    if len(values) <= frame.stack_base:
+        underflow()
+    val = values.pop()
+    check_int(val)
+    values.append(wrap(-val))
+
+
+def op_add(values, frame, arg):
+    if len(values) - 2 < frame.stack_base:
+        underflow()
+    b = values.pop()
+    a = values.pop()
+    if type(a) is not int or type(b) is not int:
+        check_int(a)
+        check_int(b)
+    values.append(wrap(a + b))
+
+
+def op_sub(values, frame, arg):
+    if len(values) - 2 < frame.stack_base:
+        underflow()
+    b = values.pop()
+    a = values.pop()
+    if type(a) is not int or type(b) is not int:
+        check_int(a)
+        check_int(b)
+    values.append(wrap(a - b))
+
+
+def op_mul(values, frame, arg):
+    if len(values) - 2 < frame.stack_base:
+        underflow()
+    b = values.pop()
+    a = values.pop()
+    if type(a) is not int or type(b) is not int:
+        check_int(a)
+        check_int(b)
+    values.append(wrap(a * b))
+
+
+def op_div(values, frame, arg):
+    if len(values) - 2 < frame.stack_base:
+        underflow()
+    b = values.pop()
+    a = values.pop()
+    if type(a) is not int or type(b) is not int:
+        check_int(a)
+        check_int(b)
+    if b == 0:
+        raise MachineError('division by 0')
+    values.append(wrap(a // b))
+
+
+def op_mod(values, frame, arg):
+    if len(values) - 2 < frame.stack_base:
+        underflow()
+    b = values.pop()
+    a = values.pop()
+    if type(a) is not int or type(b) is not int:
+        check_int(a)
+        check_int(b)
+    if b == 0:
+        raise MachineError('modulo by 0')
+    values.append(wrap(a % b))
+
+
+def op_not(values, frame, arg):
+    if len(values) <= frame.stack_base:
+        underflow()
+    values[-1] = not values[-1]
+
+
+def incompatible(a, b):
+    raise MachineError(
+        'incompatible types for comparison: '
+        f'{dump_value(a)} and {dump_value(b)}')
+
+
+def op_eq(values, frame, arg):
+    if len(values) - 2 < frame.stack_base:
+        underflow()
+    b = values.pop()
+    values[-1] = values[-1] == b
+
+
+def op_ne(values, frame, arg):
+    if len(values) - 2 < frame.stack_base:
+        underflow()
+    b = values.pop()
+    values[-1] = values[-1] != b
+
+
+def op_lt(values, frame, arg):
+    if len(values) - 2 < frame.stack_base:
+        underflow()
+    b = values.pop()
+    a = values[-1]
+    if type(a) is not type(b) and not both_strings(a, b):
+        incompatible(a, b)
+    values[-1] = a < b
+
+
+def op_lte(values, frame, arg):
+    if len(values) - 2 < frame.stack_base:
+        underflow()
+    b = values.pop()
+    a = values[-1]
+    if type(a) is not type(b) and not both_strings(a, b):
+        incompatible(a, b)
+    values[-1] = a <= b
+
+
+def op_gt(values, frame, arg):
+    if len(values) - 2 < frame.stack_base:
+        underflow()
+    b = values.pop()
+    a = values[-1]
+    if type(a) is not type(b) and not both_strings(a, b):
+        incompatible(a, b)
+    values[-1] = a > b
+
+
+def op_gte(values, frame, arg):
+    if len(values) - 2 < frame.stack_base:
+        underflow()
+    b = values.pop()
+    a = values[-1]
+    if type(a) is not type(b) and not both_strings(a, b):
+        incompatible(a, b)
+    values[-1] = a >= b
+
+
+def op_dup(values, frame, arg):
+    if len(values) <= frame.stack_base:
+        underflow()
+    if len(values) >= frame.limit:
+        overflow_error()
+    values.append(values[-1])
+
+
+def op_drop(values, frame, arg):
+    if len(values) <= frame.stack_base:
+        underflow()
+    values.pop()
+
+
+def op_load_global(values, frame, arg):
+    g, slot, name = arg
+    val = g[slot]
+    if val is UNDEFINED:
+        raise MachineError(f'Undefined global name: {name}')
+    if len(values) >= frame.limit:
+        overflow_error()
+    values.append(val)
+
+
+def op_store_global(values, frame, arg):
+    g, slot = arg
+    if len(values) <= frame.stack_base:
+        underflow()
+    g[slot] = values.pop()
+
+
+def op_load_local(values, frame, n):
+    if n >= frame.n_vars:
+        raise MachineError(f'Invalid local number: {n}')
+    if len(values) >= frame.limit:
+        overflow_error()
+    values.append(values[frame.base + n])
+
+
+def op_store_local(values, frame, n):
+    if n >= frame.n_vars:
+        raise MachineError(f'Invalid local number: {n}')
+    if len(values) <= frame.stack_base:
+        underflow()
+    values[frame.base + n] = values.pop()
+
+
+def op_jump(values, frame, target):
+    return target
+
+
+def op_jump_if(values, frame, target):
+    if len(values) <= frame.stack_base:
+        underflow()
+    if values.pop():
+        return target
+    return None
+
+
+def op_call(values, frame, arg):
+    frames, pos, return_ip, name, entry, n_args, n_vars, padding, void = arg
+    base = len(values) - n_args
+    if base < frame.stack_base:
+        underflow()
+    frame.prev_ip = pos
+    frame.ip = return_ip
+    frame.top = base
+    values += padding
+    frames.append(Frame(name, entry, values, base, n_vars, void=void))
+    return FRAME_CHANGED
+
+
+def op_call_memo(values, frame, arg):
+    memo, name, call_arg = arg
+    n_args = call_arg[5]
+    base = len(values) - n_args
+    if base < frame.stack_base:
+        underflow()
+    key = memo_key(name, values[base:])
+    found, result = memo.lookup(key)
+    if not found:
+        op_call(values, frame, call_arg)
+        call_arg[0][-1].memo_key = key
+        return FRAME_CHANGED
+    del values[base:]
+    if not call_arg[8]:
+        values.append(result)
+
+
+def op_call_native(values, frame, arg):
+    machine, name, native_func, n_args, void = arg
+    if len(values) - n_args < frame.stack_base:
+        underflow()
+    if n_args:
+        args = values[-n_args:]
+        del values[-n_args:]
+    else:
+        args = ()
+    try:
+        result = native_func(machine, *args)
+    except Exception as e:
+        raise MachineError(f'Error running native function {name}: {e}')
+    if not void:
+        if len(values) >= frame.limit:
+            overflow_error()
+        values.append(result)
+
+
+def op_call_error(values, frame, arg):
+    n_args, message = arg
+    if len(values) - n_args < frame.stack_base:
+        underflow()
+    raise MachineError(message)
+
+
+def op_ret(values, frame, machine):
+    val = values[-1] if len(values) > frame.stack_base else None
+    del values[frame.base:]
+    frames = machine.frames
+    frames.pop()
+    if frames:
+        caller = frames[-1]
+        caller.activate()
+        if not frame.void:
+            if len(values) >= caller.limit:
+                overflow_error()
+            values.append(val)
+    else:
+        machine.result = val
+    return FRAME_CHANGED
+
+
+def op_ret_memo(values, frame, machine):
+    if frame.memo_key is not None:
+        val = values[-1] if len(values) > frame.stack_base else None
+        machine.memo.store(frame.memo_key, val)
+    return op_ret(values, frame, machine)
+
+
+# Handlers for verified programs (see verify.py), without checks for stack
+# underflow and overflow, and for local numbers.
+
+
+def op_const_unchecked(values, frame, val):
+    values.append(val)
+
+
+def op_neg_unchecked(values, frame, arg):
+    val = values.pop()
+    check_int(val)
+    values.append(wrap(-val))
+
+
+def op_add_unchecked(values, frame, arg):
+    b = values.pop()
+    a = values.pop()
+    if type(a) is not int or type(b) is not int:
+        check_int(a)
+        check_int(b)
+    values.append(wrap(a + b))
+
+
+def op_sub_unchecked(values, frame, arg):
+    b = values.pop()
+    a = values.pop()
+    if type(a) is not int or type(b) is not int:
+        check_int(a)
+        check_int(b)
+    values.append(wrap(a - b))
+
+
+def op_mul_unchecked(values, frame, arg):
+    b = values.pop()
+    a = values.pop()
+    if type(a) is not int or type(b) is not int:
+        check_int(a)
+        check_int(b)
+    values.append(wrap(a * b))
+
+
+def op_not_unchecked(values, frame, arg):
+    values[-1] = not values[-1]
+
+
+def op_eq_unchecked(values, frame, arg):
+    b = values.pop()
+    values[-1] = values[-1] == b
+
+
+def op_ne_unchecked(values, frame, arg):
+    b = values.pop()
+    values[-1] = values[-1] != b
+
+
+def op_lt_unchecked(values, frame, arg):
+    b = values.pop()
+    a = values[-1]
+    if type(a) is not type(b) and not both_strings(a, b):
+        incompatible(a, b)
+    values[-1] = a < b
+
+
+def op_lte_unchecked(values, frame, arg):
+    b = values.pop()
+    a = values[-1]
+    if type(a) is not type(b) and not both_strings(a, b):
+        incompatible(a, b)
+    values[-1] = a <= b
+
+
+def op_gt_unchecked(values, frame, arg):
+    b = values.pop()
+    a = values[-1]
+    if type(a) is not type(b) and not both_strings(a, b):
+        incompatible(a, b)
+    values[-1] = a > b
+
+
+def op_gte_unchecked(values, frame, arg):
+    b = values.pop()
+    a = values[-1]
+    if type(a) is not type(b) and not both_strings(a, b):
+        incompatible(a, b)
+    values[-1] = a >= b
+
+
+def op_dup_unchecked(values, frame, arg):
+    values.append(values[-1])
+
+
+def op_drop_unchecked(values, frame, arg):
+    values.pop()
+
+
+def op_load_global_unchecked(values, frame, arg):
+    g, slot, name = arg
+    val = g[slot]
+    if val is UNDEFINED:
+        raise MachineError(f'Undefined global name: {name}')
+    values.append(val)
+
+
+def op_store_global_unchecked(values, frame, arg):
+    g, slot = arg
+    g[slot] = values.pop()
+
+
+def op_load_local_unchecked(values, frame, n):
+    values.append(values[frame.base + n])
+
+
+def op_store_local_unchecked(values, frame, n):
+    values[frame.base + n] = values.pop()
+
+
+def op_jump_if_unchecked(values, frame, target):
+    if values.pop():
+        return target
+    return None
+
+
+def op_call_unchecked(values, frame, arg):
+    frames, pos, return_ip, name, entry, n_args, n_vars, padding, void = arg
+    base = len(values) - n_args
+    frame.prev_ip = pos
+    frame.ip = return_ip
+    frame.top = base
+    values += padding
+    frames.append(Frame(name, entry, values, base, n_vars, void=void))
+    return FRAME_CHANGED
+
+
+def op_call_native_unchecked(values, frame, arg):
+    machine, name, native_func, n_args, void = arg
+    if n_args:
+        args = values[-n_args:]
+        del values[-n_args:]
+    else:
+        args = ()
+    try:
+        result = native_func(machine, *args)
+    except Exception as e:
+        raise MachineError(f'Error running native function {name}: {e}')
+    if not void:
+        values.append(result)
+
+
+def op_ret_unchecked(values, frame, machine):
+    val = values[-1] if len(values) > frame.stack_base else None
+    del values[frame.base:]
+    frames = machine.frames
+    frames.pop()
+    if frames:
+        frames[-1].activate()
+        if not frame.void:
+            values.append(val)
+    else:
+        machine.result = val
+    return FRAME_CHANGED
+
+
+# Handlers for operations on integers, used where type inference (see
+# infer.py) shows that the operands are certainly integers. Then, there are
+# also enough values on the stack.
+
+
+def op_neg_int(values, frame, arg):
+    values[-1] = wrap(-values[-1])
+
+
+def op_add_int(values, frame, arg):
+    b = values.pop()
+    values[-1] = wrap(values[-1] + b)
+
+
+def op_sub_int(values, frame, arg):
+    b = values.pop()
+    values[-1] = wrap(values[-1] - b)
+
+
+def op_mul_int(values, frame, arg):
+    b = values.pop()
+    values[-1] = wrap(values[-1] * b)
+
+
+def op_div_int(values, frame, arg):
+    if values[-1] == 0:
+        raise MachineError('division by 0')
+    b = values.pop()
+    values[-1] = wrap(values[-1] // b)
+
+
+def op_mod_int(values, frame, arg):
+    if values[-1] == 0:
+        raise MachineError('modulo by 0')
+    b = values.pop()
+    values[-1] = wrap(values[-1] % b)
+
+
+def op_lt_int(values, frame, arg):
+    b = values.pop()
+    values[-1] = values[-1] < b
+
+
+def op_lte_int(values, frame, arg):
+    b = values.pop()
+    values[-1] = values[-1] <= b
+
+
+def op_gt_int(values, frame, arg):
+    b = values.pop()
+    values[-1] = values[-1] > b
+
+
+def op_gte_int(values, frame, arg):
+    b = values.pop()
+    values[-1] = values[-1] >= b
+
+
+SIMPLE_HANDLERS = {
+    Op.FUNC: op_func,
+    Op.OP_NEG: op_neg,
+    Op.OP_ADD: op_add,
+    Op.OP_SUB: op_sub,
+    Op.OP_MUL: op_mul,
+    Op.OP_DIV: op_div,
+    Op.OP_MOD: op_mod,
+    Op.OP_NOT: op_not,
+    Op.CMP_EQ: op_eq,
+    Op.CMP_NE: op_ne,
+    Op.CMP_LT: op_lt,
+    Op.CMP_LTE: op_lte,
+    Op.CMP_GT: op_gt,
+    Op.CMP_GTE: op_gte,
+    Op.DUP: op_dup,
+    Op.DROP: op_drop,
+}
+
+CONSTANTS = {
+    Op.CONST_NULL: None,
+    Op.CONST_FALSE: False,
+    Op.CONST_TRUE: True,
+}
+
+# Handlers for integer operands, and the number of operands.
+INT_HANDLERS = {
+    Op.OP_NEG: (op_neg_int, 1),
+    Op.OP_ADD: (op_add_int, 2),
+    Op.OP_SUB: (op_sub_int, 2),
+    Op.OP_MUL: (op_mul_int, 2),
+    Op.OP_DIV: (op_div_int, 2),
+    Op.OP_MOD: (op_mod_int, 2),
+    Op.CMP_LT: (op_lt_int, 2),
+    Op.CMP_LTE: (op_lte_int, 2),
+    Op.CMP_GT: (op_gt_int, 2),
+    Op.CMP_GTE: (op_gte_int, 2),
+}
+
+# Replacements for the above handlers, in a verified program. OP_DIV and
+# OP_MOD are only checked for division by 0, and reuse the plain handlers.
+UNCHECKED = {
+    op_const: op_const_unchecked,
+    op_neg: op_neg_unchecked,
+    op_add: op_add_unchecked,
+    op_sub: op_sub_unchecked,
+    op_mul: op_mul_unchecked,
+    op_not: op_not_unchecked,
+    op_eq: op_eq_unchecked,
+    op_ne: op_ne_unchecked,
+    op_lt: op_lt_unchecked,
+    op_lte: op_lte_unchecked,
+    op_gt: op_gt_unchecked,
+    op_gte: op_gte_unchecked,
+    op_dup: op_dup_unchecked,
+    op_drop: op_drop_unchecked,
+    op_load_global: op_load_global_unchecked,
+    op_store_global: op_store_global_unchecked,
+    op_load_local: op_load_local_unchecked,
+    op_store_local: op_store_local_unchecked,
+    op_jump_if: op_jump_if_unchecked,
+    op_call: op_call_unchecked,
+    op_call_native: op_call_native_unchecked,
+    op_ret: op_ret_unchecked,
+}
+
+
+def make_entry(machine, pos):
+    length, op, args = machine.instr_at(pos)
+    next_ip = pos + length
+
+    if op in SIMPLE_HANDLERS:
+        return SIMPLE_HANDLERS[op], None, next_ip
+    if op in CONSTANTS:
+        return op_const, CONSTANTS[op], next_ip
+    if op in [Op.CONST_INT, Op.CONST_INT_BIG, Op.CONST_STRING]:
+        return op_const, args[0], next_ip
+    if op == Op.LOAD_GLOBAL:
+        name, slot = args
+        return op_load_global, (machine.global_values, slot, name), next_ip
+    if op == Op.STORE_GLOBAL:
+        name, slot = args
+        return op_store_global, (machine.global_values, slot), next_ip
+    if op == Op.LOAD_LOCAL:
+        return op_load_local, args[0], next_ip
+    if op == Op.STORE_LOCAL:
+        return op_store_local, args[0], next_ip
+    if op == Op.JUMP:
+        return op_jump, pos + args[0], next_ip
+    if op == Op.JUMP_IF:
+        return op_jump_if, pos + args[0], next_ip
+    if op == Op.RET:
+        if machine.memo is not None:
+            return op_ret_memo, machine, next_ip
+        return op_ret, machine, next_ip
+    if op in [Op.CALL, Op.CALL_VOID]:
+        void = op == Op.CALL_VOID
+        handler, arg = make_call(machine, pos, next_ip, args[2], void)
+        return handler, arg, next_ip
+    assert False, op
+
+
+def make_call(machine, pos, next_ip, site, void):
+    func = site.func
+    if func is not None:
+        n_vars = func.n_params + func.n_locals
+        padding = (None,) * func.n_locals
+        arg = (
+            machine.frames, pos, next_ip, func.name, func.entry, site.n_args,
+            n_vars, padding, void,
+        )
+        if site.memo is not None:
+            return op_call_memo, (site.memo, site.name, arg)
+        return op_call, arg
+    if site.native_func is not None:
+        return op_call_native, (machine, site.name, site.native_func, site.n_args, void)
+    return op_call_error, (site.n_args, site.error)
+
+
+# Superinstructions
+#
+# At load time, common sequences of instructions are replaced with a single
+# fused entry, stored at the offset of the first instruction. The entries for
+# the following instructions stay in the table, so jumps into the middle of a
+# sequence still work.
+#
+# A fused handler first checks everything that could go wrong (stack size,
+# local numbers, operand types). If any check fails, it runs only the first
+# instruction of the sequence with its plain handler, and continues with the
+# next one, so that errors are reported from the right offset.
+
+
+def deopt(values, frame, plain):
+    handler, arg, next_ip = plain
+    handler(values, frame, arg)
+    return next_ip
+
+
+def op_load_local_load_local_binop(values, frame, arg):
+    a, b, fn, plain = arg
+    n_vars = frame.n_vars
+    if len(values) + 2 <= frame.limit and a < n_vars and b < n_vars:
+        base = frame.base
+        x = values[base + a]
+        y = values[base + b]
+        if type(x) is int and type(y) is int:
+            values.append(fn(x, y))
+            return None
+    return deopt(values, frame, plain)
+
+
+def op_load_local_const_binop(values, frame, arg):
+    a, k, fn, plain = arg
+    if len(values) + 2 <= frame.limit and a < frame.n_vars:
+        x = values[frame.base + a]
+        if type(x) is type(k):
+            values.append(fn(x, k))
+            return None
+    return deopt(values, frame, plain)
+
+
+def op_load_local_load_local_binop_store(values, frame, arg):
+    a, b, fn, c, plain = arg
+    n_vars = frame.n_vars
+    if len(values) + 2 <= frame.limit and a < n_vars and b < n_vars and c < n_vars:
+        base = frame.base
+        x = values[base + a]
+        y = values[base + b]
+        if type(x) is int and type(y) is int:
+            values[base + c] = fn(x, y)
+            return None
+    return deopt(values, frame, plain)
+
+
+def op_load_local_const_binop_store(values, frame, arg):
+    a, k, fn, c, plain = arg
+    n_vars = frame.n_vars
+    if len(values) + 2 <= frame.limit and a < n_vars and c < n_vars:
+        base = frame.base
+        x = values[base + a]
+        if type(x) is type(k):
+            values[base + c] = fn(x, k)
+            return None
+    return deopt(values, frame, plain)
+
+
+def op_load_local_const_cmp_jump_if(values, frame, arg):
+    a, k, fn, target, plain = arg
+    if len(values) + 2 <= frame.limit and a < frame.n_vars:
+        x = values[frame.base + a]
+        if type(x) is type(k):
+            if fn(x, k):
+                return target
+            return None
+    return deopt(values, frame, plain)
+
+
+def op_const_cmp_jump_if(values, frame, arg):
+    k, fn, target, plain = arg
+    if frame.stack_base < len(values) < frame.limit:
+        x = values[-1]
+        if type(x) is type(k):
+            values.pop()
+            if fn(x, k):
+                return target
+            return None
+    return deopt(values, frame, plain)
+
+
+def op_dup_store_local(values, frame, arg):
+    n, plain = arg
+    if frame.stack_base < len(values) < frame.limit and n < frame.n_vars:
+        values[frame.base + n] = values[-1]
+        return None
+    return deopt(values, frame, plain)
+
+
+# Versions of the above for known types (see typed_fusion), without any
+# checks.
+
+
+def op_load_local_load_local_binop_int(values, frame, arg):
+    a, b, fn, plain = arg
+    base = frame.base
+    values.append(fn(values[base + a], values[base + b]))
+
+
+def op_load_local_const_binop_int(values, frame, arg):
+    a, k, fn, plain = arg
+    values.append(fn(values[frame.base + a], k))
+
+
+def op_load_local_load_local_binop_store_int(values, frame, arg):
+    a, b, fn, c, plain = arg
+    base = frame.base
+    values[base + c] = fn(values[base + a], values[base + b])
+
+
+def op_load_local_const_binop_store_int(values, frame, arg):
+    a, k, fn, c, plain = arg
+    base = frame.base
+    values[base + c] = fn(values[base + a], k)
+
+
+def op_load_local_const_cmp_jump_if_int(values, frame, arg):
+    a, k, fn, target, plain = arg
+    if fn(values[frame.base + a], k):
+        return target
+    return None
+
+
+def op_const_cmp_jump_if_typed(values, frame, arg):
+    k, fn, target, plain = arg
+    if fn(values.pop(), k):
+        return target
+    return None
+
+
+def op_dup_store_local_typed(values, frame, arg):
+    n, plain = arg
+    values[frame.base + n] = values[-1]
+
+
+def typed_fusion(handler, arg, state):
+    """
+    Find a version of a fused handler without checks, if the state before it
+    (stack and local types, see infer.py) shows that none of the checks can
+    fail. Returns None otherwise.
+    """
+
+    stack, lcl = state
+
+    def ints(*ns):
+        return all(n < len(lcl) and lcl[n] == INT for n in ns)
+
+    def fits(n):
+        return len(stack) + n <= STACK_LIMIT
+
+    if handler is op_load_local_load_local_binop:
+        a, b, fn = arg
+        if fits(2) and ints(a, b):
+            return op_load_local_load_local_binop_int
+    elif handler is op_load_local_const_binop:
+        a, k, fn = arg
+        if fits(2) and ints(a):
+            return op_load_local_const_binop_int
+    elif handler is op_load_local_load_local_binop_store:
+        a, b, fn, c = arg
+        if fits(2) and ints(a, b) and c < len(lcl):
+            return op_load_local_load_local_binop_store_int
+    elif handler is op_load_local_const_binop_store:
+        a, k, fn, c = arg
+        if fits(2) and ints(a) and c < len(lcl):
+            return op_load_local_const_binop_store_int
+    elif handler is op_load_local_const_cmp_jump_if:
+        a, k, fn, target = arg
+        if fits(2) and ints(a):
+            return op_load_local_const_cmp_jump_if_int
+    elif handler is op_const_cmp_jump_if:
+        k, fn, target = arg
+        k_type = INT if type(k) is int else STRING
+        if stack and fits(1) and stack[-1] == k_type:
+            return op_const_cmp_jump_if_typed
+    elif handler is op_dup_store_local:
+        n, = arg
+        if stack and fits(1) and n < len(lcl):
+            return op_dup_store_local_typed
+    return None
+
+
+# Operations that can be fused, for operands of the same type (ints, in
+# case of arithmetic). OP_DIV and OP_MOD are left out, because they can fail
+# on valid operands.
+ARITH_FUNCTIONS = {
+    Op.OP_ADD: lambda a, b: ((a + b + 0x8000) & 0xFFFF) - 0x8000,
+    Op.OP_SUB: lambda a, b: ((a - b + 0x8000) & 0xFFFF) - 0x8000,
+    Op.OP_MUL: lambda a, b: ((a * b + 0x8000) & 0xFFFF) - 0x8000,
+}
+
+CMP_FUNCTIONS = {
+    Op.CMP_EQ: operator.eq,
+    Op.CMP_NE: operator.ne,
+    Op.CMP_LT: operator.lt,
+    Op.CMP_LTE: operator.le,
+    Op.CMP_GT: operator.gt,
+    Op.CMP_GTE: operator.ge,
+}
+
+BINOP_FUNCTIONS = {**ARITH_FUNCTIONS, **CMP_FUNCTIONS}
+
+INT_CONSTANTS = [Op.CONST_INT, Op.CONST_INT_BIG]
+CONSTANT_OPS = [Op.CONST_INT, Op.CONST_INT_BIG, Op.CONST_STRING]
+
+
+def match_fusion(pos, instrs):
+    """
+    Find a fused handler for a sequence of instructions starting at pos.
+    Returns the number of instructions fused, the handler, and its argument
+    (without the plain entry), or None.
+    """
+
+    ops = [op for length, op, args in instrs] + [None] * 4
+    args = [args for length, op, args in instrs]
+
+    if ops[0] == Op.LOAD_LOCAL:
+        a = args[0][0]
+        if ops[1] == Op.LOAD_LOCAL and ops[2] in BINOP_FUNCTIONS:
+            b = args[1][0]
+            fn = BINOP_FUNCTIONS[ops[2]]
+            if ops[3] == Op.STORE_LOCAL:
+                return 4, op_load_local_load_local_binop_store, (a, b, fn, args[3][0])
+            return 3, op_load_local_load_local_binop, (a, b, fn)
+
+        if ops[1] in INT_CONSTANTS and ops[2] in BINOP_FUNCTIONS:
+            k = args[1][0]
+            fn = BINOP_FUNCTIONS[ops[2]]
+            if ops[3] == Op.STORE_LOCAL:
+                return 4, op_load_local_const_binop_store, (a, k, fn, args[3][0])
+            if ops[2] in CMP_FUNCTIONS and ops[3] == Op.JUMP_IF:
+                jump_pos = pos + instrs[0].length + instrs[1].length + instrs[2].length
+                target = jump_pos + args[3][0]
+                return 4, op_load_local_const_cmp_jump_if, (a, k, fn, target)
+            return 3, op_load_local_const_binop, (a, k, fn)
+
+    if ops[0] in CONSTANT_OPS and ops[1] in CMP_FUNCTIONS and ops[2] == Op.JUMP_IF:
+        k = args[0][0]
+        fn = CMP_FUNCTIONS[ops[1]]
+        target = pos + instrs[0].length + instrs[1].length + args[2][0]
+        return 3, op_const_cmp_jump_if, (k, fn, target)
+
+    if ops[0] == Op.DUP and ops[1] == Op.STORE_LOCAL:
+        return 2, op_dup_store_local, (args[1][0],)
+
+    return None
+
+
+class FusionStats:
+    """
+    Counts superinstructions: how many were created, how many times they
+    were executed, and how many times they fell back to plain handlers.
+    """
+
+    def __init__(self):
+        self.sites = Counter()
+        self.executed = Counter()
+        self.deopts = Counter()
+        self.sizes = {}
+
+    def count(self, name, handler):
+        def counting_handler(values, frame, arg):
+            self.executed[name] += 1
+            return handler(values, frame, arg)
+
+        return counting_handler
+
+    def count_deopt(self, name, handler):
+        def counting_handler(values, frame, arg):
+            self.deopts[name] += 1
+            return handler(values, frame, arg)
+
+        return counting_handler
+
+    def saved(self, name):
+        return (self.sizes[name] - 1) * (self.executed[name] - self.deopts[name])
+
+    def report(self):
+        yield f'{"fusion":48} {"sites":>6} {"executed":>10} {"deopts":>8} {"saved":>10}'
+        for name in sorted(self.sites, key=self.saved, reverse=True):
+            yield (
+                f'{name:48} {self.sites[name]:6} {self.executed[name]:10} '
+                f'{self.deopts[name]:8} {self.saved(name):10}'
+            )
+        total = sum(self.saved(name) for name in self.sites)
+        yield f'dispatches saved: {total}'
+
+
+def fuse(machine, table, stats=None, types=None):
+    code = machine.code
+    positions = iter(list(code))
+    for pos in positions:
+        instrs = []
+        p = pos
+        while len(instrs) < 4 and p in code:
+            instrs.append(code[p])
+            p += code[p].length
+
+        match = match_fusion(pos, instrs)
+        if not match:
+            continue
+        size, handler, arg = match
+        plain = table[pos]
+        next_ip = pos + sum(instr.length for instr in instrs[:size])
+        if types is not None and pos in types:
+            handler = typed_fusion(handler, arg, types[pos]) or handler
+
+        if stats is not None:
+            name = ' '.join(instr.op.name for instr in instrs[:size])
+            stats.sites[name] += 1
+            stats.sizes[name] = size
+            handler = stats.count(name, handler)
+            plain = (stats.count_deopt(name, plain[0]), plain[1], plain[2])
+
+        table[pos] = handler, arg + (plain,), next_ip
+
+        # Skip the rest of the sequence.
+        for _ in range(size - 1):
+            next(positions, None)
+
+
+def build_table(machine, *, fusion=True, stats=None, checks=True, specialize=True):
+    machine.link()
+    table = {}
+    for pos in machine.code:
+        table[pos] = make_entry(machine, pos)
+    if not checks:
+        for pos, (handler, arg, next_ip) in table.items():
+            table[pos] = UNCHECKED.get(handler, handler), arg, next_ip
+    types = None
+    if specialize:
+        types = infer_types(machine.program)
+        for pos, instr in machine.code.items():
+            if instr.op in INT_HANDLERS:
+                handler, n = INT_HANDLERS[instr.op]
+                if int_operands(types, pos, n):
+                    table[pos] = handler, None, table[pos][2]
+    if fusion:
+        fuse(machine, table, stats, types)
+    return table
+
+
+def run_fast(machine, *, fusion=True, stats=None, checks=True, specialize=True):
+    """
+    Run the program. With checks=False, the program is verified first (see
+    verify.check()), and stack and local checks are skipped. With
+    specialize=True, operations on values that are certainly integers use
+    handlers without type checks.
+    """
+
+    if not checks:
+        check(machine.program)
+    # Start the program, unless resuming from a snapshot.
+    if not machine.frames:
+        machine.start()
+    if stats is None:
+        tables = _tables.setdefault(machine, {})
+        key = (fusion, checks, specialize)
+        table = tables.get(key)
+        if table is None:
+            table = tables[key] = build_table(
+                machine, fusion=fusion, checks=checks, specialize=specialize)
+    else:
+        table = build_table(
+            machine, fusion=fusion, stats=stats, checks=checks, specialize=specialize)
+
+    frames = machine.frames
+    values = machine.values
+    frame = frames[-1]
+    ip = next_ip = frame.ip
+    try:
+        while True:
+            try:
+                handler, arg, next_ip = table[ip]
+            except KeyError:
+                handler, arg, next_ip = table[ip] = make_entry(machine, ip)
+
+            r = handler(values, frame, arg)
+            if r is None:
+                ip = next_ip
+            elif r >= 0:
+                ip = r
+            else:
+                if not frames:
+                    break
+                frame = frames[-1]
+                ip = frame.ip
+    except MachineError:
+        frame.prev_ip = ip
+        frame.ip = next_ip
+        raise
+    return machine.result
+
+
+class FastTest(unittest.TestCase):
+    code = '''\
+FUNC "main" 0 1
+    CONST_INT 10
+    STORE_LOCAL 0
+    CONST_STRING "start"
+    STORE_GLOBAL "g"
+LOOP:
+    LOAD_LOCAL 0
+    CONST_INT 0
+    CMP_LTE
+    JUMP_IF END
+    LOAD_LOCAL 0
+    CALL "square" 1
+    CALL "to_string" 1
+    CALL_VOID "println" 1
+    LOAD_LOCAL 0
+    CONST_INT 1
+    OP_SUB
+    STORE_LOCAL 0
+    JUMP LOOP
+END:
+    CONST_INT_BIG 1000
+    CONST_INT 7
+    OP_MOD
+    LOAD_GLOBAL "g"
+    CALL "length" 1
+    OP_ADD
+    RET
+
+FUNC "square" 1 0
+    LOAD_LOCAL 0
+    DUP
+    OP_MUL
+    RET
+'''
+
+    def run_machine(self, code, engine):
+        program = Program(Assembler(code).assemble())
+        machine = Machine(program)
+        machine.use_io = False
+        try:
+            result = engine(machine)
+        except MachineError as e:
+            return 'error', str(e), list(machine.traceback())
+        return result, machine.output
+
+    def test_same_result(self):
+        expected = self.run_machine(self.code, Machine.run)
+        self.assertEqual(expected[0], 11)
+        self.assertEqual(self.run_machine(self.code, run_fast), expected)
+
+    def test_same_error(self):
+        code = self.code.replace('CONST_INT 7', 'CONST_STRING "7"')
+        expected = self.run_machine(code, Machine.run)
+        self.assertEqual(expected[0], 'error')
+        self.assertEqual(self.run_machine(code, run_fast), expected)
+
+        code = self.code.replace('LOAD_GLOBAL "g"', 'LOAD_GLOBAL "h"')
+        expected = self.run_machine(code, Machine.run)
+        self.assertEqual(expected[1], 'Undefined global name: h')
+        self.assertEqual(self.run_machine(code, run_fast), expected)
+
+    def test_no_checks(self):
+        expected = self.run_machine(self.code, Machine.run)
+        result = self.run_machine(self.code, lambda m: run_fast(m, checks=False))
+        self.assertEqual(result, expected)
+
+        code = self.code.replace('LOAD_LOCAL 0\n    DUP', 'LOAD_LOCAL 1\n    DUP')
+        with self.assertRaises(ProgramError):
+            self.run_machine(code, lambda m: run_fast(m, checks=False))
+
+    def test_specialize(self):
+        code = '''\
+FUNC "main" 0 2
+    CONST_INT_BIG 30000
+    STORE_LOCAL 0
+LOOP:
+    LOAD_LOCAL 0
+    CONST_INT_BIG 32000
+    CMP_LT
+    JUMP_IF BODY
+    LOAD_LOCAL 0
+    LOAD_LOCAL 0
+    CONST_INT 3
+    OP_MUL
+    OP_ADD
+    RET
+BODY:
+    LOAD_LOCAL 0
+    CONST_INT 100
+    OP_ADD
+    STORE_LOCAL 0
+    JUMP LOOP
+'''
+        expected = self.run_machine(code, Machine.run)
+        self.assertEqual(expected[0], -3072)
+        for fusion in [True, False]:
+            result = self.run_machine(code, lambda m: run_fast(m, fusion=fusion))
+            self.assertEqual(result, expected)
+
+        machine = Machine(Program(Assembler(code).assemble()))
+        handlers = {handler for handler, arg, next_ip in build_table(machine).values()}
+        self.assertIn(op_mul_int, handlers)
+        self.assertIn(op_load_local_const_cmp_jump_if_int, handlers)
+        self.assertIn(op_load_local_const_binop_store_int, handlers)
+
+        # Parameters are not known to be integers
+        code = code.replace(
+            'FUNC "main" 0 2\n    CONST_INT_BIG 30000\n    STORE_LOCAL 0\n',
+            'FUNC "main" 0 0\n    RET\n\nFUNC "f" 1 1\n')
+        machine = Machine(Program(Assembler(code).assemble()))
+        handlers = {handler for handler, arg, next_ip in build_table(machine).values()}
+        self.assertNotIn(op_load_local_const_cmp_jump_if_int, handlers)
+
+    def test_stack_limit(self):
+        # The limit is per frame, and does not include locals.
+        code = '''\
+FUNC "main" 0 2
+    CONST_INT 1
+    CALL "fill" 1
+    RET
+
+FUNC "fill" 1 3
+    LOAD_LOCAL 0
+LOOP:
+    DUP
+    JUMP LOOP
+'''
+        expected = self.run_machine(code, Machine.run)
+        self.assertEqual(expected[1], 'stack overflow')
+        self.assertEqual(self.run_machine(code, run_fast), expected)
+
+        program = Program(Assembler(code).assemble())
+        machine = Machine(program)
+        with self.assertRaises(MachineError):
+            machine.run_fast()
+        self.assertEqual(len(machine.frames[-1].stack), STACK_LIMIT)
+        self.assertEqual(machine.frames[-1].locals, [1, None, None, None])
+        self.assertEqual(len(machine.values), 2 + 4 + STACK_LIMIT)
+
+    def test_fusion(self):
+        stats = FusionStats()
+        result = self.run_machine(self.code, lambda m: run_fast(m, stats=stats))
+        self.assertEqual(result, self.run_machine(self.code, Machine.run))
+        self.assertEqual(stats.executed['LOAD_LOCAL CONST_INT CMP_LTE JUMP_IF'], 11)
+        self.assertEqual(stats.saved('LOAD_LOCAL CONST_INT OP_SUB STORE_LOCAL'), 30)
+
+        # Error in the middle of a fused sequence
+        code = self.code.replace('CONST_INT 10', 'CONST_STRING "10"')
+        stats = FusionStats()
+        expected = self.run_machine(code, Machine.run)
+        self.assertEqual(expected[0], 'error')
+        self.assertEqual(
+            self.run_machine(code, lambda m: run_fast(m, stats=stats)), expected)
+        self.assertEqual(stats.deopts['LOAD_LOCAL CONST_INT CMP_LTE JUMP_IF'], 1)
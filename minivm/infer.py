@@ -0,0 +1,370 @@
+import argparse
+import unittest
+import weakref
+
+from .program import Op, Program, ProgramError
+from .verify import split_functions, stack_effect
+
+# Type inference: for each instruction, find the possible types of values on
+# the stack and in locals, by abstract interpretation of each function.
+#
+# A type is a set of basic types, as a bit mask. Parameters start as ANY,
+# other locals as NULL. Calls to known functions produce their return types,
+# other values that come from outside (globals, input) are ANY. Return types
+# are computed with a worklist: when the return type of a function changes,
+# only its callers are analysed again.
+#
+# The results are only used when they are certain: if any function jumps
+# outside of its body, nothing is known about the whole program, and if the
+# stack depth in a function is not consistent, nothing is known about that
+# function.
+
+NULL = 1
+BOOL = 2
+INT = 4
+STRING = 8
+ANY = NULL | BOOL | INT | STRING
+
+TYPE_NAMES = {NULL: 'null', BOOL: 'bool', INT: 'int', STRING: 'string'}
+
+CONST_TYPES = {
+    Op.CONST_NULL: NULL,
+    Op.CONST_FALSE: BOOL,
+    Op.CONST_TRUE: BOOL,
+    Op.CONST_INT: INT,
+    Op.CONST_INT_BIG: INT,
+    Op.CONST_STRING: STRING,
+}
+
+# Result types of operations that succeed.
+RESULT_TYPES = {
+    Op.OP_NEG: INT,
+    Op.OP_ADD: INT,
+    Op.OP_SUB: INT,
+    Op.OP_MUL: INT,
+    Op.OP_DIV: INT,
+    Op.OP_MOD: INT,
+    Op.OP_NOT: BOOL,
+    Op.CMP_EQ: BOOL,
+    Op.CMP_NE: BOOL,
+    Op.CMP_LT: BOOL,
+    Op.CMP_LTE: BOOL,
+    Op.CMP_GT: BOOL,
+    Op.CMP_GTE: BOOL,
+    Op.LOAD_GLOBAL: ANY,
+}
+
+NATIVE_TYPES = {
+    'print': NULL,
+    'println': NULL,
+    'input': STRING,
+    'to_int': INT | NULL,
+    'to_string': STRING,
+    'concat': STRING,
+    'length': INT,
+    'slice': STRING,
+    'b64d': STRING | NULL,
+}
+
+# Results of infer_types(), per program.
+_results = weakref.WeakKeyDictionary()
+
+
+def type_name(t):
+    if t == ANY:
+        return 'any'
+    names = [name for bit, name in TYPE_NAMES.items() if t & bit]
+    return '|'.join(names) or 'none'
+
+
+class Unknown(Exception):
+    pass
+
+
+class InconsistentDepth(Exception):
+    pass
+
+
+class TypeInference:
+    def __init__(self, program):
+        self.program = program
+        self.functions = []
+        # Return type of each function
+        self.returns = {}
+        # (stack types, local types) before each instruction
+        self.types = {}
+
+    def infer(self):
+        try:
+            instrs = list(self.program.iter())
+        except ProgramError:
+            return self.types
+
+        for func_instrs in split_functions(instrs):
+            func_pos, func_length, _, (name, n_params, n_locals) = func_instrs[0]
+            entry = func_pos + func_length
+            body = {
+                pos: (length, op, args) for pos, length, op, args in func_instrs[1:]
+            }
+            self.functions.append((name, entry, n_params, n_locals, body))
+            self.returns[name] = 0
+
+        # name -> indexes of functions calling it
+        callers = {}
+        for i, (name, entry, n_params, n_locals, body) in enumerate(self.functions):
+            for length, op, args in body.values():
+                if op in [Op.CALL, Op.CALL_VOID]:
+                    callers.setdefault(args[0], set()).add(i)
+
+        # Return types only grow, so this stops. A function is analysed again
+        # whenever the return type of a function it calls changes, so the last
+        # states of each function are the final ones.
+        results = [None] * len(self.functions)
+        todo = list(reversed(range(len(self.functions))))
+        queued = set(todo)
+        try:
+            while todo:
+                i = todo.pop()
+                queued.discard(i)
+                name, entry, n_params, n_locals, body = self.functions[i]
+                states, ret = self.infer_function(entry, n_params, n_locals, body)
+                results[i] = states
+                if self.returns[name] | ret != self.returns[name]:
+                    self.returns[name] |= ret
+                    for caller in callers.get(name, ()):
+                        if caller not in queued:
+                            queued.add(caller)
+                            todo.append(caller)
+        except Unknown:
+            self.returns = {name: ANY for name in self.returns}
+            return self.types
+
+        for states in results:
+            self.types.update(states)
+        return self.types
+
+    def infer_function(self, entry, n_params, n_locals, body):
+        states = {}
+        todo = []
+        ret = 0
+
+        def flow(target, state):
+            if target not in body:
+                # Either a jump outside, or falling through to the next
+                # function (which is an error, but only if the function has
+                # no more instructions).
+                if target != entry + sum(length for length, op, args in body.values()):
+                    raise Unknown()
+                return
+            if target not in states:
+                states[target] = state
+                todo.append(target)
+                return
+            old_stack, old_lcl = states[target]
+            stack, lcl = state
+            if len(stack) != len(old_stack):
+                raise InconsistentDepth()
+            new_state = (
+                tuple(a | b for a, b in zip(old_stack, stack)),
+                tuple(a | b for a, b in zip(old_lcl, lcl)),
+            )
+            if new_state != states[target]:
+                states[target] = new_state
+                todo.append(target)
+
+        try:
+            flow(entry, ((), (ANY,) * n_params + (NULL,) * n_locals))
+            while todo:
+                pos = todo.pop()
+                length, op, args = body[pos]
+                stack, lcl = states[pos]
+                n_pop, n_push = stack_effect(op, args)
+                if op == Op.FUNC or len(stack) < n_pop:
+                    continue
+
+                if op == Op.RET:
+                    ret |= stack[-1] if stack else NULL
+                    continue
+                if op in [Op.LOAD_LOCAL, Op.STORE_LOCAL] and args[0] >= len(lcl):
+                    continue
+
+                stack = list(stack)
+                if op in CONST_TYPES:
+                    stack.append(CONST_TYPES[op])
+                elif op in RESULT_TYPES:
+                    del stack[len(stack) - n_pop:]
+                    stack.append(RESULT_TYPES[op])
+                elif op == Op.DUP:
+                    stack.append(stack[-1])
+                elif op == Op.LOAD_LOCAL:
+                    stack.append(lcl[args[0]])
+                elif op == Op.STORE_LOCAL:
+                    lcl = lcl[:args[0]] + (stack.pop(),) + lcl[args[0] + 1:]
+                elif op in [Op.CALL, Op.CALL_VOID]:
+                    name, n_args = args[:2]
+                    del stack[len(stack) - n_args:]
+                    if op == Op.CALL:
+                        if name in self.returns:
+                            stack.append(self.returns[name])
+                        else:
+                            stack.append(NATIVE_TYPES.get(name, ANY))
+                else:
+                    del stack[len(stack) - n_pop:]
+
+                state = (tuple(stack), lcl)
+                if op in [Op.JUMP, Op.JUMP_IF]:
+                    flow(pos + args[0], state)
+                if op != Op.JUMP:
+                    flow(pos + length, state)
+        except InconsistentDepth:
+            return {}, ANY
+
+        return states, ret
+
+
+def infer_types(program):
+    """
+    Return types before each instruction, as a dictionary:
+
+        pos -> (stack types, local types)
+
+    The result is remembered for each Program object.
+    """
+
+    types = _results.get(program)
+    if types is None:
+        types = _results[program] = TypeInference(program).infer()
+    return types
+
+
+def int_operands(types, pos, n):
+    """
+    Check if the top n values on the stack before an instruction are
+    certainly integers.
+    """
+
+    state = types.get(pos)
+    if state is None:
+        return False
+    stack = state[0]
+    return len(stack) >= n and all(t == INT for t in stack[len(stack) - n:])
+
+
+class InferenceTest(unittest.TestCase):
+    def test_infer(self):
+        from .assemble import Assembler
+
+        code = '''\
+FUNC "main" 0 2
+    CONST_INT 0
+    STORE_LOCAL 0
+    CALL "input" 0
+    STORE_LOCAL 1
+LOOP:
+    LOAD_LOCAL 0
+    CONST_INT 10
+    CMP_LT
+    JUMP_IF BODY
+    LOAD_LOCAL 1
+    LOAD_LOCAL 0
+    CALL "twice" 1
+    RET
+BODY:
+    LOAD_LOCAL 0
+    CONST_INT 1
+    OP_ADD
+    STORE_LOCAL 0
+    JUMP LOOP
+
+FUNC "twice" 1 0
+    LOAD_LOCAL 0
+    DUP
+    OP_ADD
+    RET
+'''
+        program = Program(Assembler(code).assemble())
+        inference = TypeInference(program)
+        types = inference.infer()
+        self.assertEqual(inference.returns, {'main': INT, 'twice': INT})
+
+        by_op = {}
+        for pos, length, op, args in program.iter():
+            if pos in types:
+                by_op.setdefault(op, []).append(types[pos])
+
+        # Local 0 is always an int, local 1 is a string
+        self.assertEqual(by_op[Op.CMP_LT], [((INT, INT), (INT, STRING))])
+        self.assertEqual(by_op[Op.RET][0], ((STRING, INT), (INT, STRING)))
+        self.assertTrue(int_operands(types, min(types), 0))
+
+        # Parameter types are unknown
+        self.assertEqual(by_op[Op.DUP], [((ANY,), (ANY,))])
+
+    def test_call_chain(self):
+        from .assemble import Assembler
+
+        # Each function only returns what the next one does, so return types
+        # move up the chain one function at a time.
+        n = 300
+        code = 'FUNC "main" 0 0\n    CALL "f0" 0\n    RET\n'
+        for i in range(n):
+            code += f'FUNC "f{i}" 0 0\n    CALL "f{i + 1}" 0\n    RET\n'
+        code += f'FUNC "f{n}" 0 0\n    CONST_INT 1\n    RET\n'
+        program = Program(Assembler(code).assemble())
+
+        calls = []
+
+        class CountingInference(TypeInference):
+            def infer_function(self, *args):
+                calls.append(args[0])
+                return super().infer_function(*args)
+
+        inference = CountingInference(program)
+        inference.infer()
+        self.assertEqual(inference.returns['main'], INT)
+        # Each function is analysed at most twice, not once per round.
+        self.assertLessEqual(len(calls), 2 * (n + 2))
+
+    def test_unknown(self):
+        from .assemble import Assembler
+
+        code = '''\
+FUNC "main" 0 0
+    CONST_INT 1
+    JUMP_IF L
+    CONST_INT 2
+L:  CONST_INT 3
+    OP_ADD
+    RET
+'''
+        program = Program(Assembler(code).assemble())
+        self.assertEqual(infer_types(program), {})
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'input_file', metavar='PROGRAM',
+        help='program (bytecode or assembly), or - for stdin',
+    )
+
+    args = parser.parse_args()
+
+    from .disassemble import Disassembler
+    from .run import read_bytecode
+
+    program = Program(read_bytecode(args.input_file))
+    types = infer_types(program)
+    dis = Disassembler(program, hex=False, color=False)
+    for pos, length, op, args in program.iter():
+        line = dis.dump_line(pos, length, op, args)
+        if pos in types:
+            stack, lcl = types[pos]
+            stack = ' '.join(type_name(t) for t in stack)
+            lcl = ' '.join(type_name(t) for t in lcl)
+            line = f'{line:40} [{stack}] locals: [{lcl}]'
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
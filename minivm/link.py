@@ -0,0 +1,373 @@
+import argparse
+import multiprocessing
+from pathlib import Path
+import sys
+import unittest
+
+from .assemble import Assembler
+from .cache import BytecodeCache, add_cache_arguments, cache_from_args
+from .program import (
+    HEADER, OBJECT_HEADER, PARAMS, PARAM_SIZES, Op, Param, Program, ProgramError,
+    ProgramWriter, WIDE, fits, map_file,
+)
+from .run import NATIVE_FUNCTIONS
+
+# Linking: combining object files (see OBJECT_HEADER) into a program.
+#
+# Code doesn't depend on where it is: jumps are relative, and functions are
+# called by name. So the code of object files is copied as it is, one after
+# another, and only the string parameters are changed, to indexes into the
+# combined string pool. The function table is built from function tables of
+# object files.
+#
+# Each function can be defined only once in the program, and each imported
+# name (a function called in an object file, but not defined there) must be
+# defined in another object file, or be a native function.
+
+
+def string_params(program):
+    """
+    Yield (pos, size) of each string parameter in the code of an indexed
+    program or object file.
+    """
+
+    buf = program.buf
+    pos = program.code_start
+    end = program.code_end
+    while pos < end:
+        op_pos = pos
+        scale = 1
+        if buf[pos] == WIDE:
+            scale = 2
+            pos += 1
+            if pos == end:
+                raise ProgramError(pos, "unexpected end of input")
+        try:
+            op = Op(buf[pos])
+        except ValueError:
+            raise ProgramError(pos, f"{buf[pos]:02X} is not a valid op code")
+        pos += 1
+        for param in PARAMS.get(op, []):
+            if param == Param.STRING:
+                size = 2 * scale
+                yield pos, size
+            else:
+                size = PARAM_SIZES[param][0] * scale
+            pos += size
+        if pos > end:
+            raise ProgramError(op_pos, "unexpected end of input")
+
+
+class Linker:
+    def __init__(self):
+        # (file name, Program)
+        self.objects = []
+        self.errors = []
+        # File name of the object file being linked, for errors
+        self.current = None
+
+    def add(self, name, data):
+        try:
+            program = Program(data)
+        except ProgramError as e:
+            self.errors.append(f'{name}: {e}')
+            return
+        if not program.is_object:
+            self.errors.append(f'{name}: not an object file')
+            return
+        self.objects.append((name, program))
+
+    def link(self):
+        """
+        Return the linked program, or None if there are errors.
+        """
+
+        try:
+            return self.write()
+        except ProgramError as e:
+            self.errors.append(f'{self.current}: {e}')
+            return None
+
+    def write(self):
+        # name -> file name
+        defined = {}
+        # (name, pos) for each object file
+        functions = []
+        for name, program in self.objects:
+            self.current = name
+            functions.append([])
+            for pos, length, args in program.functions():
+                func = args[0]
+                if func in defined:
+                    self.errors.append(
+                        f'{name}: duplicate function: {func} '
+                        f'(already defined in {defined[func]})')
+                else:
+                    defined[func] = name
+                functions[-1].append((func, pos))
+
+        for name, program in self.objects:
+            self.current = name
+            for index in program.imports:
+                callee = program.string(index)
+                if callee not in defined and callee not in NATIVE_FUNCTIONS:
+                    self.errors.append(f'{name}: undefined function: {callee}')
+
+        if self.errors:
+            return None
+
+        # Strings that fit in 2-byte indexes in their object file go first,
+        # so that they also do in the program.
+        writer = ProgramWriter()
+        for name, program in self.objects:
+            for i in range(min(len(program.strings), 0x10000)):
+                writer.string_index(program.string(i))
+        for name, program in self.objects:
+            for i in range(0x10000, len(program.strings)):
+                writer.string_index(program.string(i))
+
+        for (name, program), object_functions in zip(self.objects, functions):
+            self.current = name
+            start = program.code_start
+            code = bytearray(program.buf[start:program.code_end])
+            for pos, size in string_params(program):
+                pos -= start
+                index = int.from_bytes(code[pos:pos + size], 'little')
+                if index >= len(program.strings):
+                    raise ProgramError(pos + start, f"invalid string index: {index}")
+                index = writer.strings[program.string(index)]
+                if not fits(index, size, False):
+                    self.errors.append(f'{name}: too many strings in the program')
+                    return None
+                code[pos:pos + size] = index.to_bytes(size, 'little')
+
+            base = writer.pos() - start
+            for func, pos in object_functions:
+                writer.add_function(pos + base, func)
+            writer.data.extend(code)
+
+        return writer.finish()
+
+
+def assemble_object(path, cache_dir=None):
+    """
+    Assemble a source file to an object file. Return (object file, error
+    lines); the object file is None if there are errors.
+    """
+
+    source = Path(path).read_bytes()
+    cache = BytecodeCache(cache_dir) if cache_dir is not None else None
+    if cache is not None:
+        data = cache.get(source, object_file=True)
+        if data is not None:
+            return bytes(data), []
+
+    asm = Assembler(str(source, 'ascii'), object_file=True)
+    data = asm.assemble()
+    if data is None:
+        return None, [
+            line if line.startswith(' ') else f'{path}:{line}'
+            for line in asm.describe_errors()
+        ]
+    if cache is not None:
+        cache.put(source, data, object_file=True)
+    return data, []
+
+
+def assemble_objects(paths, *, cache_dir=None, jobs=1):
+    """
+    Assemble source files to object files, in parallel. Yields results of
+    assemble_object(), in the same order.
+    """
+
+    args = [(path, cache_dir) for path in paths]
+    if jobs == 1 or len(args) <= 1:
+        for path, cache_dir in args:
+            yield assemble_object(path, cache_dir)
+        return
+
+    with multiprocessing.Pool(min(jobs, len(args))) as pool:
+        yield from pool.starmap(assemble_object, args)
+
+
+def link_files(paths, *, cache_dir=None, jobs=1):
+    """
+    Link object files and assembly sources (which are assembled first).
+    Return (program, error lines); the program is None if there are errors.
+    """
+
+    inputs = []
+    sources = []
+    for path in paths:
+        data = map_file(path)
+        if data[:len(OBJECT_HEADER)] in [OBJECT_HEADER, HEADER]:
+            inputs.append((path, data))
+        else:
+            inputs.append((path, None))
+            sources.append(path)
+
+    results = assemble_objects(sources, cache_dir=cache_dir, jobs=jobs)
+    assembled = dict(zip(sources, results))
+    linker = Linker()
+    errors = []
+    for path, data in inputs:
+        if data is None:
+            data, asm_errors = assembled[path]
+            errors.extend(asm_errors)
+            if data is None:
+                continue
+        linker.add(path, data)
+    if errors:
+        return None, errors
+
+    program = linker.link()
+    return program, [f'error: {error}' for error in linker.errors]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'input_files', metavar='INPUT_FILE', nargs='+',
+        help='object file (see: mini as -c), or assembly source',
+    )
+    parser.add_argument(
+        '-o', '--output', metavar='OUTPUT_FILE', required=True,
+        help='output file',
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+        help='number of processes assembling the sources (default: number of CPUs)',
+    )
+    add_cache_arguments(parser)
+
+    args = parser.parse_args()
+
+    cache = cache_from_args(args)
+    program, errors = link_files(
+        args.input_files,
+        cache_dir=cache.path if cache is not None else None,
+        jobs=args.jobs,
+    )
+    for error_line in errors:
+        print(error_line, file=sys.stderr)
+    if program is None:
+        sys.exit(1)
+    Path(args.output).write_bytes(program)
+
+
+class LinkTest(unittest.TestCase):
+    args = '    CONST_INT 1\n' * 256
+    main_code = f'''\
+FUNC "main" 0 0
+    CONST_STRING "hello"
+    CALL "greet" 1
+    DROP
+    CONST_STRING "hello"
+    CALL "length" 1
+    DROP
+{args}\
+    CALL "sum" 256
+    RET
+'''
+
+    lib_code = '''\
+FUNC "greet" 1 0
+    CONST_STRING "hello, "
+    LOAD_LOCAL 0
+    CALL "concat" 2
+    CALL_VOID "println" 1
+    CONST_NULL
+    RET
+
+FUNC "sum" 256 0
+    LOAD_LOCAL 0
+    LOAD_LOCAL 255
+    OP_ADD
+    DUP
+    CONST_INT 2
+    CMP_EQ
+    JUMP_IF OK
+    CONST_NULL
+    RET
+OK:
+    RET
+'''
+
+    def link(self, *sources):
+        linker = Linker()
+        for i, code in enumerate(sources):
+            linker.add(f'{i}.o', Assembler(code, object_file=True).assemble())
+        return linker.link(), linker.errors
+
+    def test_object(self):
+        data = Assembler(self.main_code, object_file=True).assemble()
+        program = Program(data)
+        self.assertTrue(program.is_object)
+        self.assertEqual([program.string(i) for i in program.imports],
+                         ['greet', 'length', 'sum'])
+        self.assertEqual(program.functions()[0][2], ['main', 0, 0])
+
+    def test_link(self):
+        from .run import ENGINES, Machine
+
+        data, errors = self.link(self.lib_code, self.main_code)
+        self.assertEqual(errors, [])
+        program = Program(data)
+        self.assertFalse(program.is_object)
+        self.assertEqual([args[0] for pos, length, args in program.functions()],
+                         ['greet', 'main', 'sum'])
+        for engine in ENGINES.values():
+            machine = Machine(program)
+            machine.use_io = False
+            self.assertEqual(engine(machine), 2)
+            self.assertEqual(machine.output, 'hello, hello\n')
+
+        # One object file makes the same program as the assembler.
+        code = self.lib_code + '\n' + self.main_code
+        self.assertEqual(self.link(code)[0], Assembler(code).assemble())
+
+    def test_errors(self):
+        other_code = self.main_code.replace('"greet"', '"other"')
+        data, errors = self.link(self.main_code, other_code)
+        self.assertIsNone(data)
+        self.assertEqual(errors, [
+            '1.o: duplicate function: main (already defined in 0.o)',
+            '0.o: undefined function: greet',
+            '0.o: undefined function: sum',
+            '1.o: undefined function: other',
+            '1.o: undefined function: sum',
+        ])
+
+        linker = Linker()
+        linker.add('prog.bc', Assembler(self.lib_code).assemble())
+        self.assertEqual(linker.errors, ['prog.bc: not an object file'])
+
+    def test_files(self):
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            (tmp / 'main.asm').write_text(self.main_code)
+            (tmp / 'lib.asm').write_text(self.lib_code)
+            (tmp / 'bad.asm').write_text('FUNC "bad" 0 0\n    JUMP NOWHERE\n')
+            lib_data = Assembler(self.lib_code, object_file=True).assemble()
+            (tmp / 'lib.o').write_bytes(lib_data)
+
+            program, errors = link_files([tmp / 'lib.asm', tmp / 'main.asm'], jobs=2)
+            self.assertEqual(errors, [])
+            self.assertEqual(program, self.link(self.lib_code, self.main_code)[0])
+
+            cache_dir = tmp / 'cache'
+            for i in range(2):
+                program2, errors = link_files(
+                    [tmp / 'lib.o', tmp / 'main.asm'], cache_dir=cache_dir, jobs=2)
+                self.assertEqual(program2, program)
+            self.assertEqual(len(list(cache_dir.iterdir())), 1)
+
+            program, errors = link_files([tmp / 'main.asm', tmp / 'bad.asm'], jobs=2)
+            self.assertIsNone(program)
+            self.assertEqual(errors, [
+                f'{tmp / "bad.asm"}:1:9: error: unknown label: NOWHERE',
+                '      JUMP NOWHERE',
+                '           ^',
+            ])
@@ -0,0 +1,228 @@
+import unittest
+import weakref
+from collections import OrderedDict
+
+from .program import Op, Program, ProgramError
+from .verify import split_functions
+
+# Memoization of pure functions.
+#
+# A function is pure if its result depends only on its arguments: it does not
+# use globals, and calls only pure functions (including natives that do not
+# do I/O). With memoization enabled, calls to pure functions are looked up in
+# a cache (MemoCache), keyed by the function name and argument values. On a
+# miss, the function runs as usual, and its result is stored when it
+# returns.
+#
+# Errors are never cached: a call that fails is not stored, and the same call
+# will fail again in the same way.
+
+# Default maximum number of cached results.
+MEMO_SIZE = 10000
+
+PURE_NATIVES = {'to_int', 'to_string', 'concat', 'length', 'slice', 'b64d'}
+
+# Results of pure_functions(), per program.
+_results = weakref.WeakKeyDictionary()
+
+
+def find_pure_functions(program):
+    try:
+        instrs = list(program.iter())
+    except ProgramError:
+        return frozenset()
+
+    # name -> names of called functions, for functions that are not impure
+    # by themselves
+    candidates = {}
+    defined = set()
+    for func_instrs in split_functions(instrs):
+        name = func_instrs[0][3][0]
+        defined.add(name)
+        start = func_instrs[1][0] if len(func_instrs) > 1 else None
+        end = func_instrs[-1][0] + func_instrs[-1][1]
+        callees = set()
+        for pos, length, op, args in func_instrs[1:]:
+            if op in [Op.LOAD_GLOBAL, Op.STORE_GLOBAL]:
+                break
+            if op in [Op.JUMP, Op.JUMP_IF] and not start <= pos + args[0] < end:
+                break
+            if op in [Op.CALL, Op.CALL_VOID]:
+                callees.add(args[0])
+        else:
+            candidates[name] = callees
+
+    # Remove functions calling anything impure, until nothing changes.
+    changed = True
+    while changed:
+        changed = False
+        for name, callees in list(candidates.items()):
+            for callee in callees:
+                if callee in defined:
+                    ok = callee in candidates
+                else:
+                    ok = callee in PURE_NATIVES
+                if not ok:
+                    del candidates[name]
+                    changed = True
+                    break
+
+    return frozenset(candidates)
+
+
+def pure_functions(program):
+    """
+    Return names of pure functions in a program. The result is remembered
+    for each Program object.
+    """
+
+    result = _results.get(program)
+    if result is None:
+        result = _results[program] = find_pure_functions(program)
+    return result
+
+
+def memo_key(name, args):
+    # True == 1 and False == 0 in Python, so types are part of the key.
+    args = tuple(args)
+    return name, args, tuple(map(type, args))
+
+
+class MemoCache:
+    """
+    Results of pure function calls, with least recently used entries evicted
+    when there are more than `size`.
+    """
+
+    def __init__(self, size=MEMO_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, key):
+        """
+        Return (True, result) for a cached call, or (False, None).
+        """
+
+        entries = self.entries
+        try:
+            result = entries[key]
+        except KeyError:
+            self.misses += 1
+            return False, None
+        entries.move_to_end(key)
+        self.hits += 1
+        return True, result
+
+    def store(self, key, result):
+        entries = self.entries
+        entries[key] = result
+        entries.move_to_end(key)
+        if len(entries) > self.size:
+            entries.popitem(last=False)
+            self.evictions += 1
+
+    def call(self, machine, name, func, args):
+        """
+        Call func(machine, *args) through the cache (used by the compiled
+        engine).
+        """
+
+        key = memo_key(name, args)
+        found, result = self.lookup(key)
+        if not found:
+            result = func(machine, *args)
+            self.store(key, result)
+        return result
+
+    def report(self):
+        total = self.hits + self.misses
+        rate = 100 * self.hits / total if total else 0
+        yield (
+            f'memoization: {self.hits} hits, {self.misses} misses ({rate:.1f}% hits), '
+            f'{len(self.entries)} entries (max {self.size}), {self.evictions} evictions'
+        )
+
+
+class MemoTest(unittest.TestCase):
+    code = '''\
+FUNC "main" 0 0
+    CONST_INT 40
+    CALL "fib" 1
+    CALL "show" 1
+    RET
+
+FUNC "fib" 1 0
+    LOAD_LOCAL 0
+    CONST_INT 2
+    CMP_LT
+    JUMP_IF SMALL
+    LOAD_LOCAL 0
+    CONST_INT 1
+    OP_SUB
+    CALL "fib" 1
+    LOAD_LOCAL 0
+    CONST_INT 2
+    OP_SUB
+    CALL "fib" 1
+    OP_ADD
+    RET
+SMALL:
+    LOAD_LOCAL 0
+    RET
+
+FUNC "show" 1 0
+    LOAD_LOCAL 0
+    CALL "to_string" 1
+    CALL_VOID "println" 1
+    CALL "count" 0
+    RET
+
+FUNC "count" 0 0
+    LOAD_GLOBAL "n"
+    RET
+'''
+
+    def test_pure(self):
+        from .assemble import Assembler
+
+        program = Program(Assembler(self.code).assemble())
+        self.assertEqual(pure_functions(program), {'fib'})
+
+    def test_cache(self):
+        cache = MemoCache(2)
+        cache.store(memo_key('f', [1]), 'a')
+        cache.store(memo_key('f', [2]), 'b')
+        self.assertEqual(cache.lookup(memo_key('f', [1])), (True, 'a'))
+        self.assertEqual(cache.lookup(memo_key('f', [True])), (False, None))
+        cache.store(memo_key('f', [3]), 'c')
+        # f(2) was the least recently used
+        self.assertEqual(cache.lookup(memo_key('f', [2])), (False, None))
+        self.assertEqual(cache.lookup(memo_key('f', [3])), (True, 'c'))
+        self.assertEqual((cache.hits, cache.misses, cache.evictions), (2, 2, 1))
+
+    def test_engines(self):
+        from .assemble import Assembler
+        from .run import ENGINES, Machine, MachineError
+
+        # fib(40) takes hundreds of millions of instructions without
+        # memoization. The result wraps around to 16 bits.
+        code = self.code.replace('CALL "count" 0', 'CONST_NULL')
+        program = Program(Assembler(code).assemble())
+        for engine in ENGINES.values():
+            cache = MemoCache()
+            machine = Machine(program, memo=cache)
+            machine.use_io = False
+            self.assertIs(engine(machine), None)
+            self.assertEqual(machine.output, '32459\n')
+            self.assertEqual((cache.hits, cache.misses), (38, 41))
+
+        # Small cache, errors
+        program = Program(Assembler(self.code).assemble())
+        for engine in ENGINES.values():
+            machine = Machine(program, memo=MemoCache(3))
+            machine.use_io = False
+            with self.assertRaisesRegex(MachineError, 'Undefined global name: n'):
+                engine(machine)
@@ -0,0 +1,550 @@
+import argparse
+import operator
+import sys
+import unittest
+from pathlib import Path
+
+from .program import Op, Program, ProgramError, ProgramWriter, fits
+
+# The optimizer decodes a program into a list of nodes, where jumps point to
+# other nodes instead of offsets, runs a number of passes until nothing
+# changes, and encodes the result again.
+#
+# Removed nodes are only marked as such. A jump to a removed node goes to the
+# next node that is kept, so passes are careful to remove only instructions
+# that have no effect when jumped over.
+
+
+class Node:
+    def __init__(self, op, args):
+        self.op = op
+        self.args = args
+        self.target = None
+        self.removed = False
+
+    def __repr__(self):
+        return f'Node({self.op.name}, {self.args})'
+
+
+def wrap(n):
+    n = n & 0xFFFF
+    if n & 0x8000:
+        n -= 0x10000
+    return n
+
+
+def is_int(val):
+    return isinstance(val, int) and not isinstance(val, bool)
+
+
+# Folding functions return None if the operation would fail at run time.
+
+def fold_arith(func):
+    def fold(a, b):
+        if is_int(a) and is_int(b):
+            return wrap(func(a, b))
+        return None
+
+    return fold
+
+
+def fold_div(func):
+    def fold(a, b):
+        if is_int(a) and is_int(b) and b != 0:
+            return wrap(func(a, b))
+        return None
+
+    return fold
+
+
+def fold_cmp(func):
+    # Only integers and strings can be ordered.
+    def fold(a, b):
+        if (is_int(a) and is_int(b)) or (isinstance(a, str) and isinstance(b, str)):
+            return func(a, b)
+        return None
+
+    return fold
+
+
+FOLD_BINARY = {
+    Op.OP_ADD: fold_arith(operator.add),
+    Op.OP_SUB: fold_arith(operator.sub),
+    Op.OP_MUL: fold_arith(operator.mul),
+    Op.OP_DIV: fold_div(operator.floordiv),
+    Op.OP_MOD: fold_div(operator.mod),
+    Op.CMP_EQ: operator.eq,
+    Op.CMP_NE: operator.ne,
+    Op.CMP_LT: fold_cmp(operator.lt),
+    Op.CMP_LTE: fold_cmp(operator.le),
+    Op.CMP_GT: fold_cmp(operator.gt),
+    Op.CMP_GTE: fold_cmp(operator.ge),
+}
+
+CONSTANTS = {
+    Op.CONST_NULL: None,
+    Op.CONST_FALSE: False,
+    Op.CONST_TRUE: True,
+}
+
+
+def const_value(node):
+    if node.op in CONSTANTS:
+        return True, CONSTANTS[node.op]
+    if node.op in [Op.CONST_INT, Op.CONST_INT_BIG, Op.CONST_STRING]:
+        return True, node.args[0]
+    return False, None
+
+
+def set_const(node, value):
+    if value is None:
+        node.op, node.args = Op.CONST_NULL, []
+    elif value is True:
+        node.op, node.args = Op.CONST_TRUE, []
+    elif value is False:
+        node.op, node.args = Op.CONST_FALSE, []
+    elif isinstance(value, str):
+        node.op, node.args = Op.CONST_STRING, [value]
+    elif -0x80 <= value <= 0x7F:
+        node.op, node.args = Op.CONST_INT, [value]
+    else:
+        node.op, node.args = Op.CONST_INT_BIG, [value]
+
+
+class Optimizer:
+    def __init__(self, program):
+        self.program = program
+        self.nodes = []
+        self.index = {}
+        self.stats = {
+            'folded': 0,
+            'dead': 0,
+            'threaded': 0,
+            'peephole': 0,
+            'shortened': 0,
+        }
+
+    def load(self):
+        by_pos = {}
+        jumps = []
+        for pos, length, op, args in self.program.iter():
+            node = Node(op, list(args))
+            by_pos[pos] = node
+            self.index[id(node)] = len(self.nodes)
+            self.nodes.append(node)
+            if op in [Op.JUMP, Op.JUMP_IF]:
+                jumps.append((pos, node))
+
+        for pos, node in jumps:
+            target = pos + node.args[0]
+            if target not in by_pos:
+                raise ProgramError(pos, f'cannot optimize a jump to {target:04X}')
+            node.target = by_pos[target]
+
+    def optimize(self):
+        self.load()
+        while True:
+            changed = False
+            changed |= self.thread_jumps()
+            changed |= self.fold_constants()
+            changed |= self.remove_dead_code()
+            changed |= self.peephole()
+            changed |= self.shorten()
+            if not changed:
+                break
+        return self.dump()
+
+    def live(self):
+        return [node for node in self.nodes if not node.removed]
+
+    def resolve(self, node):
+        # First node that is kept, starting at given one.
+        i = self.index[id(node)]
+        while self.nodes[i].removed:
+            i += 1
+        return self.nodes[i]
+
+    def targets(self):
+        result = set()
+        for node in self.live():
+            if node.target is not None:
+                node.target = self.resolve(node.target)
+                result.add(id(node.target))
+        return result
+
+    def remove(self, node, stat):
+        node.removed = True
+        self.stats[stat] += 1
+
+    def thread_jumps(self):
+        changed = False
+        live = self.live()
+        for i, node in enumerate(live):
+            if node.target is None:
+                continue
+
+            # Follow chains of unconditional jumps.
+            seen = set()
+            target = self.resolve(node.target)
+            while target.op == Op.JUMP and id(target) not in seen:
+                seen.add(id(target))
+                target = self.resolve(target.target)
+            if target is not self.resolve(node.target):
+                node.target = target
+                self.stats['threaded'] += 1
+                changed = True
+
+            if node.op == Op.JUMP and target.op == Op.RET:
+                node.op, node.args, node.target = Op.RET, [], None
+                self.stats['threaded'] += 1
+                changed = True
+            elif node.op == Op.JUMP and i + 1 < len(live) and live[i + 1] is target:
+                self.remove(node, 'threaded')
+                changed = True
+        return changed
+
+    def fold_constants(self):
+        changed = False
+        targets = self.targets()
+        live = self.live()
+        i = 0
+        while i < len(live):
+            node = live[i]
+            is_const, a = const_value(node)
+            if not is_const:
+                i += 1
+                continue
+
+            # CONST a; CONST b; OP -> CONST (a OP b)
+            if (i + 2 < len(live) and id(live[i + 1]) not in targets
+                    and id(live[i + 2]) not in targets):
+                is_const_b, b = const_value(live[i + 1])
+                op = live[i + 2].op
+                if is_const_b and op in FOLD_BINARY:
+                    result = FOLD_BINARY[op](a, b)
+                    if result is not None:
+                        set_const(node, result)
+                        self.remove(live[i + 1], 'folded')
+                        self.remove(live[i + 2], 'folded')
+                        del live[i + 1 : i + 3]
+                        changed = True
+                        continue
+
+            if i + 1 < len(live) and id(live[i + 1]) not in targets:
+                next_node = live[i + 1]
+                # CONST a; OP_NEG -> CONST -a
+                if next_node.op == Op.OP_NEG and is_int(a):
+                    set_const(node, wrap(-a))
+                    self.remove(next_node, 'folded')
+                    del live[i + 1]
+                    changed = True
+                    continue
+                # CONST a; OP_NOT -> CONST (not a)
+                if next_node.op == Op.OP_NOT:
+                    set_const(node, not a)
+                    self.remove(next_node, 'folded')
+                    del live[i + 1]
+                    changed = True
+                    continue
+                # CONST a; JUMP_IF L -> JUMP L, or nothing
+                if next_node.op == Op.JUMP_IF:
+                    if a:
+                        node.op, node.args, node.target = Op.JUMP, [0], next_node.target
+                        self.remove(next_node, 'folded')
+                    else:
+                        self.remove(node, 'folded')
+                        self.remove(next_node, 'folded')
+                    changed = True
+                    i += 2
+                    continue
+            i += 1
+        return changed
+
+    def successors(self, live, i):
+        node = live[i]
+        if node.op == Op.RET:
+            return []
+        if node.op == Op.JUMP:
+            return [node.target]
+        result = []
+        if i + 1 < len(live):
+            result.append(live[i + 1])
+        if node.op == Op.JUMP_IF:
+            result.append(node.target)
+        return result
+
+    def remove_dead_code(self):
+        self.targets()
+        live = self.live()
+        index = {id(node): i for i, node in enumerate(live)}
+
+        # Each function is entered after its FUNC. Executing FUNC itself is an
+        # error, so FUNC does not lead anywhere.
+        reachable = set()
+        todo = []
+        for i, node in enumerate(live):
+            if node.op == Op.FUNC:
+                reachable.add(i)
+                if i + 1 < len(live):
+                    todo.append(i + 1)
+        while todo:
+            i = todo.pop()
+            if i in reachable:
+                continue
+            reachable.add(i)
+            if live[i].op == Op.FUNC:
+                continue
+            for succ in self.successors(live, i):
+                todo.append(index[id(succ)])
+
+        changed = False
+        for i, node in enumerate(live):
+            if i not in reachable:
+                self.remove(node, 'dead')
+                changed = True
+        return changed
+
+    def peephole(self):
+        changed = False
+        targets = self.targets()
+        live = self.live()
+        for i in range(len(live) - 1):
+            node, next_node = live[i], live[i + 1]
+            if node.removed or id(next_node) in targets:
+                continue
+            # DUP; DROP or CONST; DROP -> nothing
+            if next_node.op == Op.DROP and (node.op == Op.DUP or const_value(node)[0]):
+                self.remove(node, 'peephole')
+                self.remove(next_node, 'peephole')
+                changed = True
+        return changed
+
+    def shorten(self):
+        changed = False
+        for node in self.live():
+            # CONST_INT_BIG n -> CONST_INT n, if n fits in one byte
+            if node.op == Op.CONST_INT_BIG and -0x80 <= node.args[0] <= 0x7F:
+                node.op = Op.CONST_INT
+                self.stats['shortened'] += 1
+                changed = True
+        return changed
+
+    def dump(self):
+        self.targets()
+        live = self.live()
+        writer = ProgramWriter()
+        # Jumps are short, unless they do not fit. Widening a jump moves the
+        # code after it, so repeat until nothing changes.
+        wide = set()
+        while True:
+            positions = {}
+            pos = len(writer.data)
+            for node in live:
+                positions[id(node)] = pos
+                if node.target is not None:
+                    pos += len(writer.encode(node.op, [0], wide=id(node) in wide))
+                else:
+                    pos += len(writer.encode(node.op, node.args))
+
+            too_long = [
+                node for node in live
+                if node.target is not None and id(node) not in wide
+                and not fits(positions[id(node.target)] - positions[id(node)], 2, True)
+            ]
+            if not too_long:
+                break
+            wide.update(id(node) for node in too_long)
+
+        # Distances only grow, so writer.add() chooses the same sizes.
+        for node in live:
+            if node.target is not None:
+                pos = positions[id(node)]
+                delta = positions[id(node.target)] - pos
+                if not fits(delta, 4, True):
+                    raise ProgramError(pos, f'jump too big ({delta} bytes)')
+                node.args = [delta]
+            writer.add(node.op, node.args)
+        return writer.finish()
+
+
+def optimize(bytecode):
+    return Optimizer(Program(bytecode)).optimize()
+
+
+class OptimizerTest(unittest.TestCase):
+    def test_optimize(self):
+        from .assemble import Assembler
+        from .disassemble import Disassembler
+
+        code = '''\
+FUNC "main" 0 1
+    CONST_INT 100
+    CONST_INT 100
+    OP_MUL
+    CONST_INT 1
+    OP_ADD
+    STORE_LOCAL 0
+    CONST_INT_BIG 5
+    DUP
+    DROP
+    JUMP_IF A
+    CONST_STRING "unreachable"
+A:  JUMP B
+    CONST_STRING "dead"
+    RET
+B:  JUMP C
+C:  LOAD_LOCAL 0
+    CONST_INT 0
+    CMP_GT
+    JUMP_IF D
+    JUMP B
+D:  RET
+'''
+        data = optimize(Assembler(code).assemble())
+        dis = Disassembler(Program(data), hex=False, color=False).dump()
+        self.assertEqual(dis, '''\
+
+    FUNC "main" 0 1
+    CONST_INT_BIG 10001
+    STORE_LOCAL 0
+L2: LOAD_LOCAL 0
+    CONST_INT 0
+    CMP_GT
+    JUMP_IF L1  # +6, 001F
+    JUMP L2  # -8, 0014
+L1: RET
+''')
+
+    def test_wide(self):
+        from .assemble import Assembler
+
+        code = '''\
+FUNC "main" 0 1
+    CONST_INT 3
+    STORE_LOCAL 0
+LOOP:
+    LOAD_LOCAL 0
+    CONST_INT 1
+    OP_SUB
+    DUP
+    STORE_LOCAL 0
+    JUMP_IF LOOP
+    JUMP END
+''' + '    CONST_NULL\n    DROP\n' * 20000 + '''\
+END:
+    LOAD_LOCAL 0
+    RET
+'''
+        bytecode = Assembler(code).assemble()
+        self.assertEqual(Program(bytecode).instr_at(30).length, 6)
+        # Without the dead code, the jumps are short again.
+        program = Program(optimize(bytecode))
+        self.assertEqual([(op, args) for _, _, op, args in program.iter()], [
+            (Op.FUNC, ['main', 0, 1]),
+            (Op.CONST_INT, [3]),
+            (Op.STORE_LOCAL, [0]),
+            (Op.LOAD_LOCAL, [0]),
+            (Op.CONST_INT, [1]),
+            (Op.OP_SUB, []),
+            (Op.DUP, []),
+            (Op.STORE_LOCAL, [0]),
+            (Op.JUMP_IF, [-8]),
+            (Op.LOAD_LOCAL, [0]),
+            (Op.RET, []),
+        ])
+        self.assertEqual(program.code_end, 33)
+
+    def test_shorten(self):
+        from .assemble import Assembler
+
+        code = '''\
+FUNC "main" 0 0
+    CONST_INT_BIG 5
+    CONST_INT_BIG -128
+    CONST_INT_BIG 128
+    OP_ADD
+    CALL_VOID "println" 1
+    RET
+'''
+        optimizer = Optimizer(Program(Assembler(code).assemble()))
+        program = Program(optimizer.optimize())
+        self.assertEqual([(op, args) for _, _, op, args in program.iter()], [
+            (Op.FUNC, ['main', 0, 0]),
+            (Op.CONST_INT, [5]),
+            (Op.CONST_INT, [0]),
+            (Op.CALL_VOID, ['println', 1]),
+            (Op.RET, []),
+        ])
+        self.assertEqual(optimizer.stats['shortened'], 1)
+
+    def test_compare(self):
+        from .assemble import Assembler
+
+        # Comparisons that fail at run time are not folded, even in dead code.
+        code = '''\
+FUNC "main" 0 0
+    CONST_STRING "a"
+    CONST_STRING "b"
+    CMP_LT
+    RET
+    CONST_NULL
+    CONST_NULL
+    CMP_LT
+    CONST_TRUE
+    CONST_FALSE
+    CMP_GT
+    CONST_INT 1
+    CONST_STRING "1"
+    CMP_LTE
+    RET
+'''
+        program = Program(optimize(Assembler(code).assemble()))
+        self.assertEqual([(op, args) for _, _, op, args in program.iter()], [
+            (Op.FUNC, ['main', 0, 0]),
+            (Op.CONST_TRUE, []),
+            (Op.RET, []),
+        ])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'input_file', metavar='INPUT_FILE',
+        help='input file, or - for stdin',
+    )
+    parser.add_argument(
+        'output_file', metavar='OUTPUT_FILE',
+        help='output file, or - for stdout',
+    )
+    parser.add_argument(
+        '--stats', action='store_true',
+        help='print number of changes made by each pass',
+    )
+
+    args = parser.parse_args()
+
+    if args.input_file == '-':
+        bytecode = sys.stdin.buffer.read()
+    else:
+        bytecode = Path(args.input_file).read_bytes()
+
+    optimizer = Optimizer(Program(bytecode))
+    try:
+        data = optimizer.optimize()
+    except ProgramError as e:
+        print(f'error: {e}', file=sys.stderr)
+        sys.exit(1)
+
+    if args.stats:
+        for name, count in optimizer.stats.items():
+            print(f'{name}: {count}', file=sys.stderr)
+        print(f'size: {len(bytecode)} -> {len(data)} bytes', file=sys.stderr)
+
+    if args.output_file == '-':
+        sys.stdout.buffer.write(data)
+    else:
+        Path(args.output_file).write_bytes(data)
+
+
+if __name__ == '__main__':
+    main()
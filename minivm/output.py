@@ -0,0 +1,145 @@
+import io
+import unittest
+from collections import deque
+
+# Default number of characters to buffer before writing to the stream.
+BUFFER_SIZE = 8192
+
+
+class Output:
+    """
+    Output of a running program.
+
+    Written text is buffered, and passed to the stream when the buffer is
+    full, on newline (if line_buffered is set; by default, when the stream is
+    a terminal), and on flush().
+
+    Separately, a transcript of the output (and echoed input) is kept:
+    everything if capture is True, only the last `limit` characters if
+    `limit` is given, or nothing if capture is False.
+    """
+
+    def __init__(self, stream=None, *, capture=True, limit=None,
+                 line_buffered=None, buffer_size=BUFFER_SIZE):
+        self.stream = stream
+        self.capture = capture
+        self.limit = limit
+        if line_buffered is None:
+            line_buffered = stream is not None and stream.isatty()
+        self.line_buffered = line_buffered
+        self.buffer_size = buffer_size
+
+        self.pending = []
+        self.pending_size = 0
+
+        self.chunks = deque()
+        self.size = 0
+        # Number of characters dropped from the beginning of transcript
+        self.dropped = 0
+
+    def write(self, s):
+        if self.stream is not None:
+            self.pending.append(s)
+            self.pending_size += len(s)
+            if (self.pending_size >= self.buffer_size
+                    or (self.line_buffered and '\n' in s)):
+                self.flush()
+        self.record(s)
+
+    def record(self, s):
+        if not self.capture or not s:
+            return
+        self.chunks.append(s)
+        self.size += len(s)
+        if self.limit is not None:
+            while self.size - len(self.chunks[0]) >= self.limit:
+                self.size -= len(self.chunks[0])
+                self.dropped += len(self.chunks.popleft())
+
+    def flush(self):
+        if self.pending:
+            self.stream.write(''.join(self.pending))
+            self.pending.clear()
+            self.pending_size = 0
+        if self.stream is not None:
+            self.stream.flush()
+
+    @property
+    def position(self):
+        """Total number of characters recorded so far."""
+        return self.dropped + self.size
+
+    def snapshot(self):
+        return self.position, self.getvalue()
+
+    def restore(self, state):
+        """
+        Go back to a state returned by snapshot(). Only the transcript is
+        restored; text already written to the stream stays there.
+        """
+
+        position, transcript = state
+        self.chunks.clear()
+        if self.capture and transcript:
+            self.chunks.append(transcript)
+        self.size = len(transcript) if self.capture else 0
+        self.dropped = position - self.size
+
+    def tail(self, position):
+        """
+        Return the text recorded after `position` (as much of it as is kept),
+        without joining the whole transcript.
+        """
+
+        n = self.position - position
+        if self.limit is not None:
+            n = min(n, self.limit)
+        parts = []
+        size = 0
+        for chunk in reversed(self.chunks):
+            if size >= n:
+                break
+            parts.append(chunk)
+            size += len(chunk)
+        s = ''.join(reversed(parts))
+        return s[max(0, size - n):]
+
+    def getvalue(self):
+        if len(self.chunks) > 1:
+            s = ''.join(self.chunks)
+            self.chunks.clear()
+            self.chunks.append(s)
+        s = self.chunks[0] if self.chunks else ''
+        if self.limit is not None and len(s) > self.limit:
+            return s[len(s) - self.limit:]
+        return s
+
+
+class OutputTest(unittest.TestCase):
+    def test_buffering(self):
+        stream = io.StringIO()
+        out = Output(stream, line_buffered=True, buffer_size=10)
+        out.write('abc')
+        self.assertEqual(stream.getvalue(), '')
+        out.write('def\n')
+        self.assertEqual(stream.getvalue(), 'abcdef\n')
+        out.write('0123456789')
+        self.assertEqual(stream.getvalue(), 'abcdef\n0123456789')
+        out.write('x')
+        out.flush()
+        self.assertEqual(stream.getvalue(), 'abcdef\n0123456789x')
+        self.assertEqual(out.getvalue(), 'abcdef\n0123456789x')
+
+    def test_transcript(self):
+        out = Output(limit=5)
+        for s in ['abc', 'def', 'ghijkl', 'm']:
+            out.write(s)
+        self.assertEqual(out.getvalue(), 'ijklm')
+        self.assertEqual(out.position, 13)
+        self.assertEqual(out.tail(11), 'lm')
+        self.assertEqual(out.tail(0), 'ijklm')
+        self.assertEqual(out.tail(13), '')
+
+        out = Output(capture=False)
+        out.write('abc')
+        self.assertEqual(out.getvalue(), '')
@@ -0,0 +1,248 @@
+import argparse
+import sys
+import time
+import unittest
+from collections import Counter
+
+from .output import Output
+from .program import Op, Program
+from .run import Machine, MachineError, read_bytecode
+from .tokens import dump_value
+
+# The profiler runs a program with Machine.step(), and measures each step.
+# It has its own loop, so that Machine.run() is not slowed down when not
+# profiling.
+
+
+class FunctionStats:
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        # Instructions and time spent in the function itself
+        self.instrs = 0
+        self.time = 0
+        # Including called functions
+        self.incl_instrs = 0
+        self.incl_time = 0
+
+
+class Profiler:
+    def __init__(self, machine):
+        self.machine = machine
+        self.op_counts = Counter()
+        self.functions = {}
+        # (function, jump position, target) -> count, for jumps backwards
+        self.back_edges = Counter()
+        # Instructions executed, by call stack ("main;f;g")
+        self.stacks = Counter()
+        self.total_instrs = 0
+        # Time spent in Machine.step(), and total time (including profiling)
+        self.step_time = 0
+        self.total_time = 0
+
+        # Active calls: (stats, stack, start instrs, start step time)
+        self.calls = []
+        self.active = Counter()
+
+    def function(self, name):
+        stats = self.functions.get(name)
+        if stats is None:
+            stats = self.functions[name] = FunctionStats(name)
+        return stats
+
+    def enter(self, name):
+        stats = self.function(name)
+        stats.calls += 1
+        stack = self.calls[-1][1] + ';' + name if self.calls else name
+        self.calls.append((stats, stack, self.total_instrs, self.step_time))
+        self.active[name] += 1
+
+    def leave(self):
+        stats, stack, start_instrs, start_time = self.calls.pop()
+        self.active[stats.name] -= 1
+        # Count recursive calls only once.
+        if self.active[stats.name] == 0:
+            stats.incl_instrs += self.total_instrs - start_instrs
+            stats.incl_time += self.step_time - start_time
+
+    def run(self):
+        machine = self.machine
+        frames = machine.frames
+        clock = time.perf_counter_ns
+
+        start = clock()
+        machine.start()
+        self.enter(frames[-1].name)
+        try:
+            while frames:
+                frame = frames[-1]
+                pos = frame.ip
+                length, op, args = machine.instr_at(pos)
+                stats, stack = self.calls[-1][:2]
+                depth = len(frames)
+
+                t0 = clock()
+                try:
+                    machine.step()
+                finally:
+                    t1 = clock()
+                    self.op_counts[op] += 1
+                    self.total_instrs += 1
+                    stats.instrs += 1
+                    stats.time += t1 - t0
+                    self.step_time += t1 - t0
+                    self.stacks[stack] += 1
+
+                if len(frames) > depth:
+                    self.enter(frames[-1].name)
+                elif len(frames) < depth:
+                    self.leave()
+                elif op in [Op.CALL, Op.CALL_VOID]:
+                    # Native function
+                    self.function(args[0]).calls += 1
+                elif op in [Op.JUMP, Op.JUMP_IF] and frame.ip <= pos:
+                    self.back_edges[frame.name, pos, frame.ip] += 1
+        finally:
+            while self.calls:
+                self.leave()
+            self.total_time = clock() - start
+        return machine.result
+
+    def report(self, top=10):
+        total = max(self.total_instrs, 1)
+        yield (
+            f'instructions: {self.total_instrs}, time: {self.step_time / 1e6:.1f} ms '
+            f'({self.total_time / 1e6:.1f} ms with profiling)'
+        )
+
+        yield ''
+        yield f'{"opcode":16} {"count":>10} {"%":>6}'
+        for op, count in self.op_counts.most_common():
+            yield f'{op.name:16} {count:10} {100 * count / total:6.1f}'
+
+        yield ''
+        yield (
+            f'{"function":20} {"calls":>8} {"instrs":>10} {"incl":>10} '
+            f'{"ms":>9} {"incl ms":>9}'
+        )
+        functions = sorted(
+            self.functions.values(), key=lambda f: f.instrs, reverse=True)
+        for f in functions:
+            yield (
+                f'{f.name:20} {f.calls:8} {f.instrs:10} {f.incl_instrs:10} '
+                f'{f.time / 1e6:9.2f} {f.incl_time / 1e6:9.2f}'
+            )
+
+        if self.back_edges:
+            yield ''
+            yield f'{"back-edge":30} {"count":>10}'
+            for (name, pos, target), count in self.back_edges.most_common(top):
+                edge = f'{name} {pos:04X} -> {target:04X}'
+                yield f'{edge:30} {count:10}'
+
+    def collapsed(self):
+        """
+        Call stacks in the "collapsed" format, with the number of instructions
+        executed, for flame graph tools.
+        """
+
+        for stack, count in sorted(self.stacks.items()):
+            yield f'{stack} {count}'
+
+
+class ProfilerTest(unittest.TestCase):
+    def test_profile(self):
+        from .assemble import Assembler
+
+        code = '''\
+FUNC "main" 0 0
+    CONST_INT 3
+    CALL "f" 1
+    CALL_VOID "println" 1
+    RET
+
+FUNC "f" 1 0
+    LOAD_LOCAL 0
+    JUMP_IF REC
+    CONST_INT 0
+    RET
+REC:
+    LOAD_LOCAL 0
+    CONST_INT 1
+    OP_SUB
+    CALL "f" 1
+    LOAD_LOCAL 0
+    OP_ADD
+    RET
+'''
+        machine = Machine(Program(Assembler(code).assemble()))
+        machine.use_io = False
+        profiler = Profiler(machine)
+        self.assertEqual(profiler.run(), None)
+        self.assertEqual(machine.output, '6\n')
+
+        self.assertEqual(profiler.total_instrs, 4 + 3 * 9 + 4)
+        self.assertEqual(profiler.op_counts[Op.CALL], 4)
+        f = profiler.functions['f']
+        self.assertEqual(f.calls, 4)
+        self.assertEqual(f.instrs, 3 * 9 + 4)
+        self.assertEqual(f.incl_instrs, f.instrs)
+        self.assertEqual(profiler.functions['main'].incl_instrs, profiler.total_instrs)
+        self.assertEqual(profiler.functions['println'].calls, 1)
+        self.assertEqual(list(profiler.collapsed()), [
+            'main 4',
+            'main;f 9',
+            'main;f;f 9',
+            'main;f;f;f 9',
+            'main;f;f;f;f 4',
+        ])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'input_file', metavar='PROGRAM',
+        help='program (bytecode or assembly), or - for stdin',
+    )
+    parser.add_argument(
+        '--top', type=int, default=10,
+        help='number of back-edges to show (default: 10)',
+    )
+    parser.add_argument(
+        '--collapsed', metavar='FILE',
+        help='write call stacks in collapsed format (for flame graphs)',
+    )
+
+    args = parser.parse_args()
+
+    program = Program(read_bytecode(args.input_file))
+    machine = Machine(program, output=Output(sys.stdout, capture=False))
+    profiler = Profiler(machine)
+    failed = False
+    try:
+        result = profiler.run()
+        machine.out.flush()
+        print(f'result: {dump_value(result)}')
+    except MachineError as e:
+        failed = True
+        machine.out.flush()
+        print('Traceback (most recent frame last):', file=sys.stderr)
+        for error_line in machine.traceback():
+            print(error_line, file=sys.stderr)
+        print(f'error: {e}', file=sys.stderr)
+    print(file=sys.stderr)
+
+    for line in profiler.report(top=args.top):
+        print(line, file=sys.stderr)
+
+    if args.collapsed:
+        with open(args.collapsed, 'w') as f:
+            for line in profiler.collapsed():
+                f.write(line + '\n')
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
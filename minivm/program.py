@@ -1,11 +1,40 @@
 from enum import Enum
+from collections import namedtuple
+import mmap
+import struct
 import unittest
 
 
 HEADER = b'MINIVM\0\0'
 
+# Indexed format: after HEADER, a 00 byte (not a valid op code, so that
+# the original format is easy to tell apart) and the format version. Then:
+#
+#   code              instructions; string parameters are 2-byte indexes
+#                     into the string pool
+#   function table    count, offset of each FUNC instruction (sorted by
+#                     function name, then by offset)
+#   string pool       count, start offset of each string and end offset of
+#                     the last one, ASCII data
+#   trailer           offsets of the function table and the string pool
+#
+# Counts and offsets are 4-byte little-endian. Programs without the 00 byte
+# (version 1, with strings stored inline) are still accepted.
+#
+# Object files (parts of a program, combined by `mini link`) have the same
+# format, but start with OBJECT_HEADER, and the function table is followed
+# by the imports: count, and string index of each function called, but not
+# defined, in the object file.
+FORMAT_VERSION = 2
+OBJECT_HEADER = b'MINIOBJ\0'
+TRAILER = struct.Struct('<II')
+
 
 class Op(Enum):
+    # Members are unique, so the default object hash works, and it's faster
+    # than the one from Enum (ops are often used as dict keys).
+    __hash__ = object.__hash__
+
     FUNC = 0x01
 
     CONST_NULL = 0x10
@@ -69,6 +98,51 @@ PARAMS = {
 }
 
 
+# WIDE prefix: an instruction starting with this byte (before the op code) has
+# all its parameters twice as big. It is used only for parameters that do not
+# fit in the normal encoding, so that compact programs stay compact.
+WIDE = 0x0F
+
+# Operations that can be prefixed with WIDE. The integer constants are not
+# included: values in the VM are 16-bit anyway.
+WIDE_OPS = {
+    Op.FUNC, Op.CONST_STRING, Op.LOAD_GLOBAL, Op.STORE_GLOBAL,
+    Op.LOAD_LOCAL, Op.STORE_LOCAL, Op.JUMP, Op.JUMP_IF, Op.CALL, Op.CALL_VOID,
+}
+
+# Size in bytes (in the normal encoding) and whether the value is signed.
+# For strings, the size is of the length (version 1) or the pool index
+# (version 2).
+PARAM_SIZES = {
+    Param.UINT: (1, False),
+    Param.INT: (1, True),
+    Param.INT_BIG: (2, True),
+}
+
+# Formats of the parameters in the short encoding, for struct (with string
+# parameters as pool indexes). Packing fails if a value does not fit.
+SHORT_FORMATS = {
+    op: struct.Struct('<B' + ''.join(
+        {Param.STRING: 'H', Param.UINT: 'B', Param.INT: 'b', Param.INT_BIG: 'h'}[param]
+        for param in params
+    ))
+    for op, params in PARAMS.items()
+}
+
+# Longest string that can be encoded (in both formats, with WIDE)
+MAX_STRING = 0xFFFF
+
+
+def fits(value, size, signed):
+    bits = size * 8
+    if signed:
+        return -(1 << (bits - 1)) <= value < (1 << (bits - 1))
+    return 0 <= value < (1 << bits)
+
+
+Instr = namedtuple('Instr', ['length', 'op', 'args'])
+
+
 class ProgramError(Exception):
     def __init__(self, pos, message):
         self.pos = pos
@@ -80,29 +154,97 @@ class ProgramError(Exception):
 
 class Program:
     def __init__(self, bytecode):
-        self.buf = bytes(bytecode)
-        if not self.buf.startswith(HEADER):
+        # Objects supporting the buffer protocol (bytes, mmap, memoryview) are
+        # used without copying, and must not change while the program is in
+        # use. Other sequences (such as lists of ints) are converted to bytes.
+        try:
+            self.buf = memoryview(bytecode).cast('B')
+        except TypeError:
+            self.buf = memoryview(bytes(bytecode))
+        header = self.buf[:len(HEADER)]
+        self.is_object = header == OBJECT_HEADER
+        if header != HEADER and not self.is_object:
             raise ProgramError(0, "Program doesn't start with a header")
-        self.pos = len(HEADER)
+        self.version = 1
+        self.code_start = len(HEADER)
+        self.code_end = len(self.buf)
+        # Indexed format only: offsets of FUNC instructions, string pool
+        self.func_offsets = None
+        # Original format only: name -> FUNC instruction, see function()
+        self.func_index = None
+        self.string_offsets = None
+        self.strings = None
+        # Object files only: string indexes of imported names
+        self.imports = None
+        if len(self.buf) > len(HEADER) and self.buf[len(HEADER)] == 0:
+            self.read_index()
+        elif self.is_object:
+            raise ProgramError(len(HEADER), "object file without program index")
+
+        self.pos = self.code_start
+        # Decoded instructions, by offset. Filled by decode(), and lazily by
+        # instr_at() for offsets that are not on the main instruction stream.
+        self.code = {}
+        self.decoded = False
+
+    def read_index(self):
+        buf = self.buf
+        pos = len(HEADER) + 1
+        if pos >= len(buf):
+            raise ProgramError(pos, "unexpected end of input")
+        if buf[pos] != FORMAT_VERSION:
+            raise ProgramError(pos, f"unsupported format version: {buf[pos]}")
+        self.version = buf[pos]
+        self.code_start = pos + 1
+
+        trailer_pos = len(buf) - TRAILER.size
+        if trailer_pos < self.code_start:
+            raise ProgramError(self.code_start, "missing program index")
+        func_table, string_pool = TRAILER.unpack_from(buf, trailer_pos)
+        if not self.code_start <= func_table <= string_pool <= trailer_pos:
+            raise ProgramError(trailer_pos, "invalid program index")
+        self.code_end = func_table
+
+        try:
+            n_funcs, = struct.unpack_from('<I', buf, func_table)
+            self.func_offsets = struct.unpack_from(f'<{n_funcs}I', buf, func_table + 4)
+            if self.is_object:
+                imports = func_table + 4 + 4 * n_funcs
+                n_imports, = struct.unpack_from('<I', buf, imports)
+                self.imports = struct.unpack_from(f'<{n_imports}I', buf, imports + 4)
+            n_strings, = struct.unpack_from('<I', buf, string_pool)
+            self.string_offsets = struct.unpack_from(
+                f'<{n_strings + 1}I', buf, string_pool + 4)
+        except struct.error:
+            raise ProgramError(func_table, "invalid program index")
+        self.strings = [None] * n_strings
+        if self.imports is not None and any(i >= n_strings for i in self.imports):
+            raise ProgramError(func_table, "invalid program index")
 
     def read_instr(self):
         op_code = self.read_uint()
+        scale = 1
+        if op_code == WIDE:
+            scale = 2
+            op_code = self.read_uint()
         try:
             op = Op(op_code)
         except ValueError:
             raise ProgramError(self.pos, f"{op_code:02X} is not a valid op code")
+        if scale == 2 and op not in WIDE_OPS:
+            raise ProgramError(self.pos, f"{op.name} cannot have a WIDE prefix")
 
         params = PARAMS.get(op, [])
         args = []
         for param in params:
             if param == Param.STRING:
-                args.append(self.read_string())
+                args.append(self.read_string(scale))
             elif param == Param.UINT:
-                args.append(self.read_uint())
+                args.append(self.read_uint(scale))
             elif param == Param.INT:
-                args.append(self.read_int())
+                args.append(self.read_int(scale))
             elif param == Param.INT_BIG:
-                args.append(self.read_int_big())
+                args.append(self.read_int(2 * scale))
             else:
                 assert False, param
         return op, args
@@ -113,48 +255,310 @@ class Program:
         length = self.pos - pos
         return length, op, args
 
-    def read_uint(self):
-        if self.pos >= len(self.buf):
+    def read_uint(self, size=1):
+        end = self.pos + size
+        if end > self.code_end:
             raise ProgramError(self.pos, "unexpected end of input")
 
-        result = self.buf[self.pos]
-        self.pos += 1
+        if size == 1:
+            result = self.buf[self.pos]
+        else:
+            result = int.from_bytes(self.buf[self.pos:end], 'little')
+        self.pos = end
         return result
 
-    def read_int(self):
-        result = self.read_uint()
-        if result & 0x80:
-            result -= 0x100
+    def read_int(self, size=1):
+        result = self.read_uint(size)
+        bits = size * 8
+        if result >> (bits - 1):
+            result -= 1 << bits
         return result
 
-    def read_int_big(self):
-        r1 = self.read_uint()
-        r2 = self.read_uint()
-        result = r1 + (r2 << 8)
-        if result & 0x8000:
-            result -= 0x10000
-        return result
+    def read_string(self, scale=1):
+        if self.strings is not None:
+            pos = self.pos
+            index = self.read_uint(2 * scale)
+            if index >= len(self.strings):
+                raise ProgramError(pos, f"invalid string index: {index}")
+            return self.string(index)
 
-    def read_string(self):
-        length = self.read_uint()
-        if self.pos + length > len(self.buf):
+        length = self.read_uint(scale)
+        if self.pos + length > self.code_end:
             raise ProgramError(self.pos, "unexpected end of input inside a string")
         data = self.buf[self.pos : self.pos + length]
         try:
-            result = data.decode("ascii")
+            result = str(data, "ascii")
         except UnicodeDecodeError:
-            raise ProgramError(self.pos, f"string is not ASCII: {data}")
+            raise ProgramError(self.pos, f"string is not ASCII: {bytes(data)}")
         self.pos += length
         return result
 
-    def iter(self):
-        self.pos = len(HEADER)
-        while self.pos < len(self.buf):
+    def string(self, index):
+        """
+        Return a string from the pool (decoded on first use).
+        """
+
+        result = self.strings[index]
+        if result is None:
+            start, end = self.string_offsets[index], self.string_offsets[index + 1]
+            data = self.buf[start:end]
+            try:
+                result = str(data, "ascii")
+            except UnicodeDecodeError:
+                raise ProgramError(start, f"string is not ASCII: {bytes(data)}")
+            self.strings[index] = result
+        return result
+
+    def iter(self, start=None, end=None):
+        """
+        Decode the instructions from start (which has to be the offset of an
+        instruction) until end, or the whole program.
+        """
+
+        self.pos = self.code_start if start is None else start
+        end = self.code_end if end is None else min(end, self.code_end)
+        while self.pos < end:
             pos = self.pos
             op, args = self.read_instr()
             length = self.pos - pos
             yield pos, length, op, args
 
+    def decode(self):
+        """
+        Decode the whole program once, and return a table of instructions
+        indexed by offset.
+        """
+
+        if not self.decoded:
+            for pos, length, op, args in self.iter():
+                self.code[pos] = Instr(length, op, args)
+            self.decoded = True
+        return self.code
+
+    def instr_at(self, pos):
+        try:
+            return self.code[pos]
+        except KeyError:
+            pass
+        instr = Instr(*self.read_from(pos))
+        self.code[pos] = instr
+        return instr
+
+    def functions(self):
+        """
+        Return the FUNC instructions, as a list of (pos, length, args). In the
+        indexed format, only these instructions are decoded (and they are
+        sorted by name); otherwise, the whole program is.
+        """
+
+        if self.func_offsets is None:
+            return [
+                (pos, length, args)
+                for pos, (length, op, args) in self.decode().items()
+                if op == Op.FUNC
+            ]
+
+        return [self.function_entry(i) for i in range(len(self.func_offsets))]
+
+    def function_entry(self, i):
+        pos = self.func_offsets[i]
+        if not self.code_start <= pos < self.code_end:
+            raise ProgramError(pos, "function table points outside of code")
+        length, op, args = self.instr_at(pos)
+        if op != Op.FUNC:
+            raise ProgramError(pos, f"function table points to {op.name}, not FUNC")
+        return pos, length, args
+
+    def function(self, name):
+        """
+        Find a function by name, and return its FUNC instruction as (pos,
+        length, args), or None. If there are several functions with the same
+        name, the last one counts.
+
+        In the indexed format, this is a binary search in the function table,
+        decoding only a few FUNC instructions.
+        """
+
+        if self.func_offsets is None:
+            if self.func_index is None:
+                self.func_index = {
+                    args[0]: (pos, length, args)
+                    for pos, length, args in self.functions()
+                }
+            return self.func_index.get(name)
+
+        # Find the first entry after all functions called `name`.
+        lo, hi = 0, len(self.func_offsets)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.function_entry(mid)[2][0] <= name:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo > 0:
+            entry = self.function_entry(lo - 1)
+            if entry[2][0] == name:
+                return entry
+        return None
+
+
+def encode_instr(op, args, string_index=None, wide=None):
+    """
+    Encode an instruction. If string_index is given, string parameters are
+    encoded as string_index(s) (for the indexed format), otherwise inline.
+
+    The WIDE prefix is added if a parameter does not fit otherwise, or if
+    `wide` is true.
+    """
+
+    if wide is None and string_index is not None:
+        # Common case: the short encoding, if everything fits.
+        params = PARAMS.get(op)
+        if params is None:
+            return bytes((op.value,))
+        values = [
+            string_index(arg) if param == Param.STRING else arg
+            for param, arg in zip(params, args)
+        ]
+        try:
+            return SHORT_FORMATS[op].pack(op.value, *values)
+        except struct.error:
+            pass
+
+    # (value, size, signed, data following the value)
+    values = []
+    for param, arg in zip(PARAMS.get(op, []), args):
+        if param == Param.STRING and string_index is not None:
+            values.append((string_index(arg), 2, False, b''))
+        elif param == Param.STRING:
+            data = arg.encode('ascii')
+            values.append((len(data), 1, False, data))
+        else:
+            size, signed = PARAM_SIZES[param]
+            values.append((arg, size, signed, b''))
+
+    if wide is None:
+        wide = op in WIDE_OPS and not all(
+            fits(value, size, signed) for value, size, signed, _ in values)
+
+    result = bytearray()
+    scale = 1
+    if wide:
+        result.append(WIDE)
+        scale = 2
+    result.append(op.value)
+    for value, size, signed, data in values:
+        size *= scale
+        result.extend((value & ((1 << (size * 8)) - 1)).to_bytes(size, 'little'))
+        result.extend(data)
+    return bytes(result)
+
+
+class ProgramWriter:
+    """
+    Encodes a program in the indexed format. Instructions are appended to
+    `data` (which can be patched in place until the end), and finish() adds
+    the function table and string pool.
+
+    The program can also be written out in parts: flush() returns the data
+    so far and removes it from `data`. Positions in the program stay the
+    same, so that `data` starts at position `written`.
+
+    With object_file=True, the result is an object file (see OBJECT_HEADER).
+    """
+
+    def __init__(self, *, object_file=False):
+        self.object_file = object_file
+        self.data = bytearray(OBJECT_HEADER if object_file else HEADER)
+        self.data.extend([0, FORMAT_VERSION])
+        self.written = 0
+        # string -> index in the pool
+        self.strings = {}
+        # (name, offset) of each FUNC instruction
+        self.functions = []
+        # Names used in CALL and CALL_VOID (object files only)
+        self.calls = set()
+
+    def string_index(self, s):
+        index = self.strings.get(s)
+        if index is None:
+            index = len(self.strings)
+            self.strings[s] = index
+        return index
+
+    def encode(self, op, args, wide=None):
+        if self.object_file and (op == Op.CALL or op == Op.CALL_VOID):
+            self.calls.add(args[0])
+        return encode_instr(op, args, self.string_index, wide)
+
+    def pos(self):
+        """
+        Position of the next instruction.
+        """
+
+        return self.written + len(self.data)
+
+    def flush(self):
+        result = bytes(self.data)
+        self.written += len(result)
+        self.data.clear()
+        return result
+
+    def add_function(self, pos, name):
+        self.functions.append((name, pos))
+
+    def add(self, op, args):
+        if op == Op.FUNC:
+            self.add_function(self.pos(), args[0])
+        self.data.extend(self.encode(op, args))
+
+    def finish(self):
+        """
+        Add the function table and string pool, and return the rest of the
+        program (everything after the last flush()).
+        """
+
+        data = self.data
+        func_table = self.pos()
+        # Sorted by name, for Program.function(). The sort is stable, so that
+        # functions with the same name stay in program order.
+        func_offsets = [pos for name, pos in sorted(self.functions, key=lambda f: f[0])]
+        data.extend(struct.pack('<I', len(func_offsets)))
+        data.extend(struct.pack(f'<{len(func_offsets)}I', *func_offsets))
+
+        if self.object_file:
+            defined = {name for name, pos in self.functions}
+            imports = [self.strings[name] for name in self.strings
+                       if name in self.calls and name not in defined]
+            data.extend(struct.pack('<I', len(imports)))
+            data.extend(struct.pack(f'<{len(imports)}I', *imports))
+
+        string_pool = self.pos()
+        encoded = [s.encode('ascii') for s in self.strings]
+        offsets = [string_pool + 4 + 4 * (len(encoded) + 1)]
+        for s in encoded:
+            offsets.append(offsets[-1] + len(s))
+        data.extend(struct.pack('<I', len(encoded)))
+        data.extend(struct.pack(f'<{len(offsets)}I', *offsets))
+        for s in encoded:
+            data.extend(s)
+
+        data.extend(TRAILER.pack(func_table, string_pool))
+        return bytes(data)
+
+
+def map_file(path):
+    """
+    Return the contents of a file, memory-mapped if possible.
+    """
+
+    with open(path, 'rb') as f:
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # Empty file, or not a regular file
+            return f.read()
+
 
 class ProgramTest(unittest.TestCase):
     def test_instructions(self):
@@ -172,3 +576,139 @@ class ProgramTest(unittest.TestCase):
             (17, 3, Op.CONST_INT_BIG, [0x1FF]),
             (20, 6, Op.CALL, ['bar', 5]),
         ])
+
+        encoded = b''.join(encode_instr(op, args) for _, _, op, args in program.iter())
+        self.assertEqual(HEADER + encoded, bytes(data))
+
+    def test_decode(self):
+        data = [
+            *HEADER,
+            Op.CONST_INT.value, 0x05,
+            Op.CONST_INT_BIG.value, Op.OP_ADD.value, 0x00,
+            Op.RET.value,
+        ]
+        program = Program(data)
+        self.assertDictEqual(program.decode(), {
+            8: (2, Op.CONST_INT, [5]),
+            10: (3, Op.CONST_INT_BIG, [0x21]),
+            13: (1, Op.RET, []),
+        })
+        # Offset in the middle of an instruction
+        self.assertEqual(program.instr_at(11), (1, Op.OP_ADD, []))
+        self.assertEqual(program.instr_at(13), (1, Op.RET, []))
+
+    def test_indexed(self):
+        writer = ProgramWriter()
+        writer.add(Op.FUNC, ['main', 0, 0])
+        writer.add(Op.CONST_STRING, ['foo'])
+        writer.add(Op.CALL, ['f', 1])
+        writer.add(Op.RET, [])
+        writer.add(Op.FUNC, ['f', 1, 0])
+        writer.add(Op.CONST_STRING, ['foo'])
+        writer.add(Op.RET, [])
+        data = writer.finish()
+        self.assertEqual(data[:18], bytes([
+            *HEADER, 0, FORMAT_VERSION,
+            Op.FUNC.value, 0, 0, 0, 0,
+            Op.CONST_STRING.value, 1, 0,
+        ]))
+
+        program = Program(data)
+        self.assertEqual(program.version, 2)
+        self.assertEqual(program.functions(),
+                         [(23, 5, ['f', 1, 0]), (10, 5, ['main', 0, 0])])
+        # Only the function headers are decoded so far
+        self.assertEqual(list(program.code), [23, 10])
+        self.assertEqual(program.strings, ['main', None, 'f'])
+        self.assertListEqual(list(program.iter()), [
+            (10, 5, Op.FUNC, ['main', 0, 0]),
+            (15, 3, Op.CONST_STRING, ['foo']),
+            (18, 4, Op.CALL, ['f', 1]),
+            (22, 1, Op.RET, []),
+            (23, 5, Op.FUNC, ['f', 1, 0]),
+            (28, 3, Op.CONST_STRING, ['foo']),
+            (31, 1, Op.RET, []),
+        ])
+        with self.assertRaisesRegex(ProgramError, 'unexpected end of input'):
+            program.read_from(32)
+
+    def test_wide(self):
+        instrs = [
+            (Op.LOAD_LOCAL, [3]),
+            (Op.LOAD_LOCAL, [300]),
+            (Op.CALL, ['f', 256]),
+            (Op.JUMP, [-0x8000]),
+            (Op.JUMP, [0x8000]),
+            (Op.CONST_STRING, ['x' * 300]),
+        ]
+        data = HEADER + b''.join(encode_instr(op, args) for op, args in instrs)
+        self.assertEqual(data[8:21], bytes([
+            Op.LOAD_LOCAL.value, 3,
+            WIDE, Op.LOAD_LOCAL.value, 0x2C, 0x01,
+            WIDE, Op.CALL.value, 1, 0, *b'f', 0x00, 0x01,
+        ]))
+        program = Program(data)
+        self.assertListEqual(
+            [(pos, length, op, args) for pos, length, op, args in program.iter()], [
+                (8, 2, Op.LOAD_LOCAL, [3]),
+                (10, 4, Op.LOAD_LOCAL, [300]),
+                (14, 7, Op.CALL, ['f', 256]),
+                (21, 3, Op.JUMP, [-0x8000]),
+                (24, 6, Op.JUMP, [0x8000]),
+                (30, 304, Op.CONST_STRING, ['x' * 300]),
+            ])
+
+        writer = ProgramWriter()
+        for i in range(0x10001):
+            writer.string_index(str(i))
+        self.assertEqual(
+            writer.encode(Op.CONST_STRING, ['1']),
+            bytes([Op.CONST_STRING.value, 1, 0]))
+        self.assertEqual(
+            writer.encode(Op.CONST_STRING, ['65536']),
+            bytes([WIDE, Op.CONST_STRING.value, 0, 0, 1, 0]))
+
+        with self.assertRaisesRegex(ProgramError,
+                                    'CONST_INT cannot have a WIDE prefix'):
+            Program(HEADER + bytes([WIDE, Op.CONST_INT.value, 1, 0])).decode()
+
+    def test_function(self):
+        import tempfile
+        from pathlib import Path
+        from .run import Machine
+
+        writer = ProgramWriter()
+        writer.add(Op.FUNC, ['main', 0, 0])
+        writer.add(Op.CALL, ['f500', 0])
+        writer.add(Op.CALL, ['f3', 0])
+        writer.add(Op.OP_ADD, [])
+        writer.add(Op.RET, [])
+        for i in range(1000):
+            writer.add(Op.FUNC, [f'f{i}', 0, 0])
+            writer.add(Op.CONST_INT_BIG, [i])
+            writer.add(Op.RET, [])
+        # Redefined function: the last one counts.
+        writer.add(Op.FUNC, ['f3', 0, 0])
+        writer.add(Op.CONST_INT, [-3])
+        writer.add(Op.RET, [])
+        data = writer.finish()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / 'program.bc'
+            path.write_bytes(data)
+            program = Program(map_file(path))
+            self.assertIsInstance(program.buf.obj, mmap.mmap)
+            self.assertEqual(program.function('f500')[2], ['f500', 0, 0])
+            self.assertEqual(program.function('f3'),
+                             (writer.functions[-1][1], 5, ['f3', 0, 0]))
+            self.assertIsNone(program.function('g'))
+            program.buf.release()
+
+        program = Program(data)
+        self.assertIs(program.buf.obj, data)
+        machine = Machine(program)
+        machine.use_io = False
+        self.assertEqual(machine.run(), 497)
+        # Only the binary searches and the executed code were decoded.
+        self.assertLess(len(program.code), 50)
+        self.assertEqual(len(machine.functions), 1001)
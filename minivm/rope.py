@@ -0,0 +1,321 @@
+import unittest
+
+# Ropes: string values built by concat() and slice().
+#
+# A rope is a balanced binary tree (with the same rules as an AVL tree) with
+# str leaves. Concatenation and slicing take O(log n) time, instead of copying
+# the whole string, so that programs building a long string piece by piece
+# (or consuming one piece by piece) are not quadratic.
+#
+# Strings up to LEAF_SIZE characters are always plain str, so a string value
+# in the VM is either a str or a Rope (see is_string()). Ropes behave like
+# strings for len(), comparisons, hashing and truth value. Anything that needs
+# the actual text (printing, dump_value(), b64d, saving to JSON) calls str(),
+# which flattens the rope once and remembers the result.
+
+# Maximum length of a leaf, and of a result kept as plain str.
+LEAF_SIZE = 65536
+
+
+class Rope:
+    __slots__ = ['left', 'right', 'length', 'depth', 'flat']
+
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+        self.length = len(left) + len(right)
+        self.depth = max(depth(left), depth(right)) + 1
+        # Flattened string, computed by str()
+        self.flat = None
+
+    def __len__(self):
+        return self.length
+
+    def __bool__(self):
+        return self.length > 0
+
+    def __str__(self):
+        if self.flat is None:
+            parts = []
+            todo = [self]
+            while todo:
+                node = todo.pop()
+                if type(node) is Rope:
+                    if node.flat is not None:
+                        parts.append(node.flat)
+                    else:
+                        todo.append(node.right)
+                        todo.append(node.left)
+                else:
+                    parts.append(node)
+            self.flat = ''.join(parts)
+        return self.flat
+
+    def __repr__(self):
+        return f'Rope({str(self)!r})'
+
+    def __hash__(self):
+        return hash(str(self))
+
+    def __eq__(self, other):
+        if not is_string(other):
+            return NotImplemented
+        return len(self) == len(other) and str(self) == str(other)
+
+    def __ne__(self, other):
+        if not is_string(other):
+            return NotImplemented
+        return not self == other
+
+    def __lt__(self, other):
+        if not is_string(other):
+            return NotImplemented
+        return str(self) < str(other)
+
+    def __le__(self, other):
+        if not is_string(other):
+            return NotImplemented
+        return str(self) <= str(other)
+
+    def __gt__(self, other):
+        if not is_string(other):
+            return NotImplemented
+        return str(self) > str(other)
+
+    def __ge__(self, other):
+        if not is_string(other):
+            return NotImplemented
+        return str(self) >= str(other)
+
+
+def is_string(val):
+    return type(val) is str or type(val) is Rope
+
+
+def both_strings(a, b):
+    return is_string(a) and is_string(b)
+
+
+def depth(node):
+    return node.depth if type(node) is Rope else 0
+
+
+def from_str(s, start=0, end=None):
+    """
+    Build a balanced rope from s[start:end], in chunks of LEAF_SIZE.
+    """
+
+    if end is None:
+        end = len(s)
+    if end - start <= LEAF_SIZE:
+        return s[start:end]
+    n_chunks = (end - start + LEAF_SIZE - 1) // LEAF_SIZE
+    mid = start + (n_chunks // 2) * LEAF_SIZE
+    return Rope(from_str(s, start, mid), from_str(s, mid, end))
+
+
+def balance(left, right):
+    # Both sides are balanced, and their depth differs by at most 2.
+    dl, dr = depth(left), depth(right)
+    if dl > dr + 1:
+        if depth(left.left) >= depth(left.right):
+            return Rope(left.left, Rope(left.right, right))
+        inner = left.right
+        return Rope(Rope(left.left, inner.left), Rope(inner.right, right))
+    if dr > dl + 1:
+        if depth(right.right) >= depth(right.left):
+            return Rope(Rope(left, right.left), right.right)
+        inner = right.left
+        return Rope(Rope(left, inner.left), Rope(inner.right, right.right))
+    return Rope(left, right)
+
+
+def join(left, right):
+    """
+    Concatenate two balanced ropes (or str leaves). Takes time proportional
+    to the difference in depth.
+    """
+
+    if type(left) is str and type(right) is str:
+        if len(left) + len(right) <= LEAF_SIZE:
+            return left + right
+        return Rope(left, right)
+
+    # Merge short pieces into the neighbouring leaf.
+    if type(right) is str and type(left.right) is str \
+            and len(left.right) + len(right) <= LEAF_SIZE:
+        return join(left.left, left.right + right)
+    if type(left) is str and type(right) is Rope and type(right.left) is str \
+            and len(left) + len(right.left) <= LEAF_SIZE:
+        return join(left + right.left, right.right)
+
+    dl, dr = depth(left), depth(right)
+    if dl > dr + 1:
+        return balance(left.left, join(left.right, right))
+    if dr > dl + 1:
+        return balance(join(left, right.left), right.right)
+    return Rope(left, right)
+
+
+def concat(a, b):
+    if not b:
+        return a
+    if not a:
+        return b
+    if len(a) + len(b) <= LEAF_SIZE:
+        return str(a) + str(b)
+    if type(a) is str and len(a) > LEAF_SIZE:
+        a = from_str(a)
+    if type(b) is str and len(b) > LEAF_SIZE:
+        b = from_str(b)
+    return join(a, b)
+
+
+def substring(s, start, end):
+    # 0 <= start <= end <= len(s)
+    if start == 0 and end == len(s):
+        return s
+    if type(s) is str:
+        return from_str(s, start, end)
+    if s.flat is not None and end - start <= LEAF_SIZE:
+        return s.flat[start:end]
+
+    n = len(s.left)
+    if end <= n:
+        return substring(s.left, start, end)
+    if start >= n:
+        return substring(s.right, start - n, end - n)
+    return join(substring(s.left, start, n), substring(s.right, 0, end - n))
+
+
+def slice(s, pos, length):
+    """
+    Same as s[pos:pos+length] for a string (pos and length are not negative).
+    """
+
+    n = len(s)
+    start = min(pos, n)
+    end = min(pos + length, n)
+    result = substring(s, start, end)
+    if type(result) is Rope and len(result) <= LEAF_SIZE:
+        return str(result)
+    return result
+
+
+class RopeTest(unittest.TestCase):
+    def check(self, rope, expected):
+        self.assertEqual(str(rope), expected)
+        self.assertEqual(len(rope), len(expected))
+        if type(rope) is Rope:
+            self.check_balanced(rope)
+        else:
+            self.assertLessEqual(len(rope), LEAF_SIZE)
+
+    def check_balanced(self, node):
+        if type(node) is Rope:
+            self.assertLessEqual(abs(depth(node.left) - depth(node.right)), 1)
+            self.assertEqual(node.depth, max(depth(node.left), depth(node.right)) + 1)
+            self.check_balanced(node.left)
+            self.check_balanced(node.right)
+
+    def test_append(self):
+        piece = 'x' * 100
+        s = ''
+        for i in range(3000):
+            s = concat(s, piece + str(i))
+        expected = ''.join(piece + str(i) for i in range(3000))
+        self.check(s, expected)
+        # Short pieces are merged into leaves.
+        self.assertLess(s.depth, 5)
+
+        s = ''
+        for i in range(2999, -1, -1):
+            s = concat(piece + str(i), s)
+        self.check(s, expected)
+
+    def test_slice(self):
+        n = LEAF_SIZE * 5 + 123
+        text = ''.join(chr(ord('a') + i % 26) for i in range(n))
+        s = concat(text[:1234], text[1234:])
+        for pos, length in [
+            (0, n), (10, n - 20), (1200, 100), (LEAF_SIZE - 10, LEAF_SIZE + 20),
+            (n - 10, 100), (n + 1, 1),
+        ]:
+            self.check(slice(s, pos, length), text[pos:pos+length])
+
+        # Consuming a string from the front
+        rest = s
+        step = LEAF_SIZE // 3
+        pos = 0
+        while rest:
+            self.assertEqual(slice(rest, 0, 10), text[pos:pos+10])
+            rest = slice(rest, step, len(rest))
+            pos += step
+        self.assertEqual(rest, '')
+
+    def test_compare(self):
+        text = 'x' * LEAF_SIZE + 'y'
+        a = concat(text[:-1], 'y')
+        b = concat(text[:100], text[100:])
+        self.assertIs(type(a), Rope)
+        self.assertEqual(a, b)
+        self.assertEqual(a, text)
+        self.assertEqual(text, a)
+        self.assertEqual(hash(a), hash(text))
+        self.assertLess(a, 'y')
+        self.assertGreater('y', a)
+        self.assertNotEqual(a, 1)
+        self.assertTrue(a)
+
+    def test_machine(self):
+        from .assemble import Assembler
+        from .program import Program
+        from .run import ENGINES, Machine
+
+        code = f'''\
+FUNC "main" 0 2
+    CONST_STRING ""
+    STORE_LOCAL 0
+    CONST_INT_BIG 1000
+    STORE_LOCAL 1
+LOOP:
+    LOAD_LOCAL 0
+    CONST_STRING "{'ab' * 35}"
+    CALL "concat" 2
+    STORE_LOCAL 0
+    LOAD_LOCAL 1
+    CONST_INT 1
+    OP_SUB
+    DUP
+    STORE_LOCAL 1
+    JUMP_IF LOOP
+
+    LOAD_LOCAL 0
+    CALL "length" 1
+    CALL_VOID "println" 1
+    LOAD_LOCAL 0
+    CONST_INT 1
+    LOAD_LOCAL 0
+    CALL "length" 1
+    CALL "slice" 3
+    DUP
+    STORE_LOCAL 0
+    CONST_STRING "b"
+    CMP_LT
+    CALL_VOID "println" 1
+    LOAD_LOCAL 0
+    CONST_INT_BIG 3990
+    CONST_INT 10
+    CALL "slice" 3
+    CALL_VOID "println" 1
+    LOAD_LOCAL 0
+    RET
+'''
+        program = Program(Assembler(code).assemble())
+        for engine in ENGINES.values():
+            machine = Machine(program)
+            machine.use_io = False
+            result = engine(machine)
+            self.assertIs(type(result), Rope)
+            self.assertEqual(result, 'ba' * 34999 + 'b')
+            self.assertEqual(machine.output, '70000\nfalse\nbababababa\n')
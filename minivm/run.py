@@ -1,30 +1,128 @@
 import argparse
-from pathlib import Path
 import sys
 from collections import namedtuple
+from collections.abc import Mapping
 import base64
 
 from .tokens import dump_value
-from .program import Program, Op, HEADER
+from .output import Output
+from .snapshot import Snapshot
+from .program import Program, Op, HEADER, OBJECT_HEADER, Instr, map_file
 from .assemble import run_assembler
+from .cache import add_cache_arguments, cache_from_args
 from .disassemble import Disassembler
+from .verify import STACK_LIMIT
+from . import rope
+from .rope import both_strings, is_string
+from .memo import MEMO_SIZE, MemoCache, memo_key, pure_functions
 
 Function = namedtuple('Function', ['name', 'entry', 'n_params', 'n_locals'])
 
+# Target of a CALL/CALL_VOID, resolved when linking. Exactly one of func
+# (a Function), native_func and error is set. For calls to pure functions
+# with memoization enabled, memo is the MemoCache.
+CallSite = namedtuple(
+    'CallSite', ['name', 'n_args', 'func', 'native_func', 'error', 'memo'],
+    defaults=[None])
+
 
 class MachineError(Exception):
     pass
 
 
 class Frame:
-    def __init__(self, name, ip, args, n_locals, *, void):
+    """
+    A function call. The locals and the stack of all frames are kept in one
+    list (Machine.values):
+
+        ... | locals (base..stack_base) | stack (stack_base..top) | ...
+
+    The top of the stack is the end of the list for the top frame, and the
+    base of the next frame for others. Arguments of a call become the first
+    locals of the called function, without being copied.
+    """
+
+    __slots__ = [
+        'name', 'prev_ip', 'ip', 'values', 'base', 'stack_base', 'n_vars',
+        'limit', 'top', 'void', 'saved', 'memo_key',
+    ]
+
+    def __init__(self, name, ip, values, base, n_vars, *, void):
         self.name = name
         self.prev_ip = ip
         self.ip = ip
-        self.stack = []
-        self.locals = list(args)
-        self.locals += [None] * n_locals
+        self.values = values
+        self.base = base
+        self.stack_base = base + n_vars
+        self.n_vars = n_vars
+        self.limit = self.stack_base + STACK_LIMIT
+        self.top = None
         self.void = void
+        # Saved state of the frame, as stored in a Snapshot. Only kept while
+        # this is not the top frame, because then the frame cannot change.
+        self.saved = None
+        # Key for storing the result in Machine.memo, when called through
+        # the cache.
+        self.memo_key = None
+
+    @property
+    def locals(self):
+        if self.saved is not None:
+            return list(self.saved[4])
+        return self.values[self.base:self.stack_base]
+
+    @property
+    def stack(self):
+        if self.saved is not None:
+            return list(self.saved[3])
+        return self.values[self.stack_base:self.top]
+
+    def freeze(self):
+        return (
+            self.name, self.prev_ip, self.ip,
+            tuple(self.stack), tuple(self.locals), self.void,
+        )
+
+    @classmethod
+    def thaw(cls, state, values, *, lazy=False):
+        """
+        Recreate a frame from a saved state, on top of the values list.
+
+        With lazy=True, the stack and locals are not copied to the list until
+        the frame becomes the top frame again (see activate()). This is only
+        valid for frames below the top one, when all frames below are lazy
+        as well: the list is then empty when the frame is activated.
+        """
+
+        name, prev_ip, ip, stack, lcl, void = state
+        base = 0 if lazy else len(values)
+        frame = cls(name, ip, values, base, len(lcl), void=void)
+        frame.prev_ip = prev_ip
+        if lazy:
+            frame.saved = state
+        else:
+            values += lcl
+            values += stack
+        return frame
+
+    def suspend(self, top):
+        """
+        Called when another frame is entered, starting at top.
+        """
+
+        self.top = top
+
+    def activate(self):
+        """
+        Called when the frame becomes the top frame again, after a return.
+        """
+
+        if self.top is None:
+            # Thawed lazily, never suspended: copy the saved state now.
+            self.values += self.saved[4]
+            self.values += self.saved[3]
+        self.top = None
+        self.saved = None
 
 
 NATIVE_FUNCTIONS = {}
@@ -40,8 +138,8 @@ def native(name, n_args):
 
 @native('print', 1)
 def native_print(machine, val):
-    if isinstance(val, str):
-        out = val
+    if is_string(val):
+        out = str(val)
     else:
         out = dump_value(val)
     machine.print(out)
@@ -49,8 +147,11 @@ def native_print(machine, val):
 
 @native('println', 1)
 def native_println(machine, val):
-    native_print(machine, val)
-    native_print(machine, '\n')
+    if is_string(val):
+        out = str(val)
+    else:
+        out = dump_value(val)
+    machine.print(out + '\n')
 
 
 @native('input', 0)
@@ -62,14 +163,14 @@ def native_input(machine):
 def native_to_int(machine, val):
     check_string(val)
     try:
-        return overflow(int(val))
+        return overflow(int(str(val)))
     except ValueError:
         return None
 
 
 @native('to_string', 1)
 def native_to_string(machine, val):
-    if isinstance(val, str):
+    if is_string(val):
         return val
     return dump_value(val)
 
@@ -78,7 +179,7 @@ def native_to_string(machine, val):
 def native_concat(machine, s1, s2):
     check_string(s1)
     check_string(s2)
-    return s1 + s2
+    return rope.concat(s1, s2)
 
 
 @native('length', 1)
@@ -94,14 +195,14 @@ def native_slice(machine, s, pos, length):
     check_int(length)
     if pos < 0 or length < 0:
         raise MachineError('slice: arguments cannot be negative')
-    return s[pos:pos+length]
+    return rope.slice(s, pos, length)
 
 
 @native('b64d', 1)
 def native_b64d(machine, s):
     check_string(s)
     try:
-        return base64.b64decode(s).decode('ascii')
+        return base64.b64decode(str(s)).decode('ascii')
     except ValueError:
         return None
 
@@ -119,42 +220,196 @@ def check_int(val):
 
 
 def check_string(val):
-    if not isinstance(val, str):
+    if not is_string(val):
         raise MachineError(f'expecting a string, got {dump_value(val)}')
 
 
-STACK_LIMIT = 256
+# Value of a global slot before the first STORE_GLOBAL.
+UNDEFINED = object()
+
+
+class GlobalsView(Mapping):
+    """
+    Read-only view of global slots, as a name -> value mapping.
+    """
+
+    def __init__(self, slots, values):
+        self.slots = slots
+        self.values = values
+
+    def __getitem__(self, name):
+        val = self.values[self.slots[name]]
+        if val is UNDEFINED:
+            raise KeyError(name)
+        return val
+
+    def __iter__(self):
+        for name, slot in self.slots.items():
+            if self.values[slot] is not UNDEFINED:
+                yield name
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class FunctionTable(Mapping):
+    """
+    Functions of a program, as a name -> Function mapping. A function is
+    looked up in the program when it's first used, so that starting a big
+    program does not decode all of its functions. Iterating loads all of them
+    (in the order of the program's function table).
+    """
+
+    def __init__(self, program):
+        self.program = program
+        self.loaded = {}
+        self.missing = set()
+        self.all_loaded = False
+
+    def __getitem__(self, name):
+        try:
+            return self.loaded[name]
+        except KeyError:
+            pass
+        if self.all_loaded or name in self.missing:
+            raise KeyError(name)
+        found = self.program.function(name)
+        if found is None:
+            self.missing.add(name)
+            raise KeyError(name)
+        func = self.loaded[name] = make_function(*found)
+        return func
+
+    def load_all(self):
+        if not self.all_loaded:
+            loaded = {}
+            for pos, length, args in self.program.functions():
+                loaded[args[0]] = make_function(pos, length, args)
+            self.loaded = loaded
+            self.all_loaded = True
+
+    def __iter__(self):
+        self.load_all()
+        return iter(self.loaded)
+
+    def __len__(self):
+        self.load_all()
+        return len(self.loaded)
+
+
+def make_function(pos, length, args):
+    name, n_params, n_locals = args
+    return Function(name, pos + length, n_params, n_locals)
 
 
 class Machine:
-    def __init__(self, program: Program):
+    def __init__(self, program: Program, *, output: Output = None, memo=None):
         self.program = program
-        self.functions = {}
-        for pos, length, op, args in program.iter():
-            if op == Op.FUNC:
-                name, n_params, n_locals = args
-                entry = pos + length
-                self.functions[name] = Function(name, entry, n_params, n_locals)
+        # MemoCache for pure functions, if enabled
+        self.memo = memo
+        self.functions = FunctionTable(program)
+
+        # Global names, resolved to slots in global_values
+        self.global_slots = {}
+        self.global_values = []
+        self.globals = GlobalsView(self.global_slots, self.global_values)
+        # Linked instructions, filled by instr_at() as they are executed, or
+        # by link() for the whole program.
+        self.code = {}
+        self.linked = False
+        self.pure = pure_functions(program) if memo is not None else frozenset()
+
         self.frames = []
-        self.globals = {}
+        # Locals and stacks of all frames
+        self.values = []
         self.result = None
-        self.output = ''
+        self.out = output or Output(sys.stdout)
 
-        self.use_io = True
         self.on_input = None
 
+    def link(self):
+        """
+        Prepare the instruction table for the whole program (for engines that
+        translate it up front). LOAD_GLOBAL and STORE_GLOBAL get a slot number
+        as additional argument, CALL and CALL_VOID get a CallSite.
+        """
+
+        if not self.linked:
+            # Keep the program order, and the instructions linked so far.
+            code = {}
+            for pos, instr in self.program.decode().items():
+                code[pos] = self.code.get(pos) or self.link_instr(instr)
+            for pos, instr in self.code.items():
+                code.setdefault(pos, instr)
+            self.code.clear()
+            self.code.update(code)
+            self.linked = True
+
+    def link_instr(self, instr):
+        length, op, args = instr
+        if op in [Op.LOAD_GLOBAL, Op.STORE_GLOBAL]:
+            name = args[0]
+            slot = self.global_slots.get(name)
+            if slot is None:
+                slot = self.global_slots[name] = len(self.global_values)
+                self.global_values.append(UNDEFINED)
+            return Instr(length, op, [name, slot])
+        if op in [Op.CALL, Op.CALL_VOID]:
+            name, n_args = args
+            return Instr(length, op, [name, n_args, self.link_call(name, n_args)])
+        return instr
+
+    def link_call(self, name, n_args):
+        if name in self.functions:
+            func = self.functions[name]
+            if n_args != func.n_params:
+                error = (f'Function {name} expects {func.n_params} arguments, '
+                         f'not {n_args}')
+                return CallSite(name, n_args, None, None, error)
+            memo = self.memo if name in self.pure else None
+            return CallSite(name, n_args, func, None, None, memo)
+
+        if name in NATIVE_FUNCTIONS:
+            n_params, native_func = NATIVE_FUNCTIONS[name]
+            if n_args != n_params:
+                error = f'Function {name} expects {n_params} arguments, not {n_args}'
+                return CallSite(name, n_args, None, None, error)
+            return CallSite(name, n_args, None, native_func, None)
+
+        return CallSite(name, n_args, None, None, f'unknown function: {name}')
+
+    def instr_at(self, pos):
+        try:
+            return self.code[pos]
+        except KeyError:
+            pass
+        instr = self.code[pos] = self.link_instr(self.program.instr_at(pos))
+        return instr
+
+    @property
+    def use_io(self):
+        return self.out.stream is not None
+
+    @use_io.setter
+    def use_io(self, value):
+        self.out.flush()
+        self.out.stream = sys.stdout if value else None
+
+    @property
+    def output(self):
+        return self.out.getvalue()
+
     def print(self, s):
-        self.output += s
-        if self.use_io:
-            print(s, end='')
+        self.out.write(s)
 
     def input(self):
         if self.use_io:
+            self.out.flush()
             result = input()
         else:
             assert self.on_input
             result = self.on_input()
-        self.output += result + '\n'
+        self.out.record(result + '\n')
         return result
 
     @property
@@ -165,10 +420,22 @@ class Machine:
 
     def run(self):
         self.start()
+        return self.resume()
+
+    def resume(self):
         while self.running():
             self.step()
         return self.result
 
+    def run_fast(self, **kwargs):
+        # The fast engine is built on top of this module, so import it late.
+        from .fast import run_fast
+        return run_fast(self, **kwargs)
+
+    def run_compiled(self):
+        from .compiler import run_compiled
+        return run_compiled(self)
+
     def running(self):
         return len(self.frames) > 0
 
@@ -183,30 +450,48 @@ class Machine:
         if len(args) != func.n_params:
             raise MachineError(f'Function {name} expects {func.n_params} arguments, not {len(args)}')
 
-        frame = Frame(name, func.entry, args, func.n_locals, void=void)
-        self.frames.append(frame)
+        self.values.extend(args)
+        self.push_frame(func, void=void)
+
+    def push_frame(self, func, *, void):
+        """
+        Enter a function, with its arguments already on top of the values.
+        """
+
+        values = self.values
+        base = len(values) - func.n_params
+        if self.frames:
+            self.frames[-1].suspend(base)
+        values += [None] * func.n_locals
+        n_vars = func.n_params + func.n_locals
+        self.frames.append(
+            Frame(func.name, func.entry, values, base, n_vars, void=void))
 
     def step(self):
         frame = self.frames[-1]
-        length, op, args = self.program.read_from(frame.ip)
+        values = self.values
+        try:
+            length, op, args = self.code[frame.ip]
+        except KeyError:
+            length, op, args = self.instr_at(frame.ip)
         frame.prev_ip = frame.ip
         frame.ip += length
 
         if op == Op.FUNC:
             raise MachineError('trying to execute FUNC')
         elif op == Op.CONST_NULL:
-            self.push(None)
+            self.push(frame, None)
         elif op == Op.CONST_FALSE:
-            self.push(False)
+            self.push(frame, False)
         elif op == Op.CONST_TRUE:
-            self.push(True)
+            self.push(frame, True)
         elif op in [Op.CONST_INT, Op.CONST_INT_BIG, Op.CONST_STRING]:
-            self.push(args[0])
+            self.push(frame, args[0])
 
         elif op == Op.OP_NEG:
-            val = self.pop()
+            val = self.pop(frame)
             check_int(val)
-            self.push(overflow(-val))
+            values.append(overflow(-val))
 
         elif op in [
             Op.OP_ADD,
@@ -215,7 +500,7 @@ class Machine:
             Op.OP_DIV,
             Op.OP_MOD,
         ]:
-            self.handle_arith(op)
+            self.handle_arith(frame, op)
 
         elif op in [
             op.CMP_EQ,
@@ -225,73 +510,77 @@ class Machine:
             op.CMP_GT,
             op.CMP_GTE,
         ]:
-            self.handle_cmp(op)
+            self.handle_cmp(frame, op)
 
         elif op == Op.OP_NOT:
-            val = self.pop()
-            self.push(not val)
+            val = self.pop(frame)
+            values.append(not val)
 
         elif op == op.DUP:
-            val = self.pop()
-            self.push(val)
-            self.push(val)
+            val = self.pop(frame)
+            values.append(val)
+            self.push(frame, val)
 
         elif op == op.DROP:
-            self.pop()
+            self.pop(frame)
 
         elif op == op.LOAD_GLOBAL:
-            name = args[0]
-            if name not in self.globals:
+            name, slot = args
+            val = self.global_values[slot]
+            if val is UNDEFINED:
                 raise MachineError(f'Undefined global name: {name}')
-            self.push(self.globals[name])
+            self.push(frame, val)
 
         elif op == op.STORE_GLOBAL:
-            name = args[0]
-            self.globals[name] = self.pop()
+            name, slot = args
+            self.global_values[slot] = self.pop(frame)
 
         elif op == op.LOAD_LOCAL:
             n = args[0]
-            if not 0 <= n < len(frame.locals):
+            if not 0 <= n < frame.n_vars:
                 raise MachineError(f'Invalid local number: {n}')
-            self.push(frame.locals[n])
+            self.push(frame, values[frame.base + n])
 
         elif op == op.STORE_LOCAL:
             n = args[0]
-            if not 0 <= n < len(frame.locals):
+            if not 0 <= n < frame.n_vars:
                 raise MachineError(f'Invalid local number: {n}')
-            frame.locals[n] = self.pop()
+            values[frame.base + n] = self.pop(frame)
 
         elif op == op.JUMP:
             frame.ip = frame.prev_ip + args[0]
 
         elif op == op.JUMP_IF:
-            val = self.pop()
+            val = self.pop(frame)
             if val:
                 frame.ip = frame.prev_ip + args[0]
 
         elif op == op.CALL:
-            name, n_args = args
-            self.handle_call(name, n_args, void=False)
+            self.call(frame, args[2], void=False)
 
         elif op == op.CALL_VOID:
-            name, n_args = args
-            self.handle_call(name, n_args, void=True)
+            self.call(frame, args[2], void=True)
 
         elif op == op.RET:
             val = None
-            if frame.stack:
-                val = self.pop()
-            frame = self.frames.pop()
+            if len(values) > frame.stack_base:
+                val = values[-1]
+            del values[frame.base:]
+            self.frames.pop()
+            if frame.memo_key is not None:
+                self.memo.store(frame.memo_key, val)
             if self.frames:
+                caller = self.frames[-1]
+                caller.activate()
                 if not frame.void:
-                    self.push(val)
+                    self.push(caller, val)
             else:
                 self.result = val
         else:
             assert False, op
 
-    def handle_arith(self, op):
-        a, b = self.pop_many(2)
+    def handle_arith(self, frame, op):
+        a, b = self.pop_many(frame, 2)
         check_int(a)
         check_int(b)
 
@@ -308,17 +597,17 @@ class Machine:
         elif op == Op.OP_MOD:
             if b == 0:
                 raise MachineError('modulo by 0')
-            result = a + b
+            result = a % b
         else:
             assert False, op
 
-        self.push(overflow(result))
+        self.values.append(overflow(result))
 
-    def handle_cmp(self, op):
-        a, b = self.pop_many(2)
+    def handle_cmp(self, frame, op):
+        a, b = self.pop_many(frame, 2)
 
         if op not in [Op.CMP_EQ, Op.CMP_NE]:
-            if type(a) != type(b):
+            if type(a) != type(b) and not both_strings(a, b):
                 raise MachineError(
                     'incompatible types for comparison: '
                     f'{dump_value(a)} and {dump_value(b)}')
@@ -338,54 +627,94 @@ class Machine:
         else:
             assert False, op
 
-        self.push(result)
-
-    def handle_call(self, name, n_args, *, void):
-        args = self.pop_many(n_args)
+        self.values.append(result)
 
-        if name in self.functions:
-            self.enter_function(name, args, void=void)
-        elif name in NATIVE_FUNCTIONS:
-            n_params, native_func = NATIVE_FUNCTIONS[name]
-            if n_args != n_params:
-                raise MachineError(
-                    f'Function {name} expects {n_params} arguments, not {len(args)}'
-                )
+    def call(self, frame, site, *, void):
+        if len(self.values) - frame.stack_base < site.n_args:
+            raise MachineError('stack underflow')
 
+        func = site.func
+        if func is not None:
+            if site.memo is not None:
+                key = memo_key(site.name, self.values[len(self.values) - site.n_args:])
+                found, result = site.memo.lookup(key)
+                if found:
+                    del self.values[len(self.values) - site.n_args:]
+                    if not void:
+                        self.push(frame, result)
+                    return
+                self.push_frame(func, void=void)
+                self.frames[-1].memo_key = key
+            else:
+                self.push_frame(func, void=void)
+        elif site.native_func is not None:
+            args = self.pop_many(frame, site.n_args)
             try:
-                result = native_func(self, *args)
+                result = site.native_func(self, *args)
             except Exception as e:
-                raise MachineError(f'Error running native function {name}: {e}')
+                raise MachineError(f'Error running native function {site.name}: {e}')
             if not void:
-                self.push(result)
+                self.push(frame, result)
         else:
-            raise MachineError(f'unknown function: {name}')
+            raise MachineError(site.error)
 
-    def push(self, val):
-        frame = self.frames[-1]
-        if len(frame.stack) >= STACK_LIMIT:
+    def push(self, frame, val):
+        if len(self.values) >= frame.limit:
             raise MachineError('stack overflow')
-        frame.stack.append(val)
+        self.values.append(val)
 
-    def pop(self):
-        frame = self.frames[-1]
-        if len(frame.stack) < 1:
+    def pop(self, frame):
+        if len(self.values) <= frame.stack_base:
             raise MachineError('stack underflow')
-        return frame.stack.pop()
+        return self.values.pop()
 
-    def pop_many(self, n):
-        frame = self.frames[-1]
-        if len(frame.stack) < n:
+    def pop_many(self, frame, n):
+        values = self.values
+        if len(values) - frame.stack_base < n:
             raise MachineError('stack underflow')
-
-        result = []
-        for i in range(n):
-            result.append(frame.stack.pop())
-        result.reverse()
+        if n == 0:
+            return []
+        result = values[-n:]
+        del values[-n:]
         return result
 
-    def traceback(self):
-        dis = Disassembler(self.program, color=True, hex=True)
+    def snapshot(self):
+        frames = []
+        for frame in self.frames[:-1]:
+            if frame.saved is None:
+                frame.saved = frame.freeze()
+            frames.append(frame.saved)
+        if self.frames:
+            frames.append(self.frames[-1].freeze())
+
+        return Snapshot(
+            tuple(frames),
+            tuple(self.globals.items()),
+            self.result,
+            self.out.snapshot(),
+        )
+
+    def restore(self, snapshot):
+        # Keep the same lists, they might be referenced by the engines.
+        self.values.clear()
+        self.frames.clear()
+        # Only the top frame is copied. Lower frames are the same as in the
+        # snapshot, until they become the top frame again.
+        for state in snapshot.frames[:-1]:
+            self.frames.append(Frame.thaw(state, self.values, lazy=True))
+        if snapshot.frames:
+            self.frames.append(Frame.thaw(snapshot.frames[-1], self.values))
+        self.global_values[:] = [UNDEFINED] * len(self.global_values)
+        for name, value in snapshot.globals:
+            if name not in self.global_slots:
+                self.global_slots[name] = len(self.global_values)
+                self.global_values.append(UNDEFINED)
+            self.global_values[self.global_slots[name]] = value
+        self.result = snapshot.result
+        self.out.restore(snapshot.output)
+
+    def traceback(self, *, color=True):
+        dis = Disassembler(self.program, color=color, hex=True)
         for frame in self.frames:
             # TODO colors
             yield f'{frame.name} ({frame.prev_ip:04X})'
@@ -394,37 +723,109 @@ class Machine:
             yield '  ' + dump
 
 
+def read_bytecode(input_file, cache=None):
+    """
+    Read a program from file (or - for stdin). Assembly source is assembled,
+    or taken from cache (a BytecodeCache) if given. Bytecode files are
+    memory-mapped, and Program uses them without copying.
+    """
+
+    if input_file == '-':
+        data = sys.stdin.buffer.read()
+    else:
+        data = map_file(input_file)
+
+    if data[:len(HEADER)] == HEADER:
+        return data
+    if data[:len(OBJECT_HEADER)] == OBJECT_HEADER:
+        print(f'error: {input_file} is an object file (see: mini link)',
+              file=sys.stderr)
+        sys.exit(1)
+    if cache is not None:
+        return cache.assemble(data)
+    return run_assembler(str(data, 'ascii'))
+
+
+ENGINES = {
+    'step': Machine.run,
+    'fast': Machine.run_fast,
+    'compiled': Machine.run_compiled,
+}
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         'input_file', metavar='INPUT_FILE',
         help='input file, or - for stdin',
     )
+    parser.add_argument(
+        '--engine', choices=ENGINES, default='step',
+        help='execution engine (default: step)',
+    )
+    parser.add_argument(
+        '--fusion-report', action='store_true',
+        help='report superinstructions used by the fast engine',
+    )
+    parser.add_argument(
+        '--no-checks', action='store_true',
+        help='verify the program, and run it without stack and local checks '
+        '(requires --engine fast)',
+    )
+    parser.add_argument(
+        '--memoize', action='store_true',
+        help='cache results of pure functions',
+    )
+    parser.add_argument(
+        '--memo-size', type=int, default=MEMO_SIZE,
+        help=f'maximum number of cached results (default: {MEMO_SIZE})',
+    )
+    add_cache_arguments(parser)
 
     args = parser.parse_args()
-
-    if args.input_file == '-':
-        data = sys.stdin.buffer.read()
-    else:
-        data = Path(args.input_file).read_bytes()
-
-    if data.startswith(HEADER):
-        bytecode = data
-    else:
-        bytecode = run_assembler(data.decode('ascii'))
-
-    program = Program(bytecode)
-    machine = Machine(program)
-
+    if args.fusion_report and args.engine != 'fast':
+        parser.error('--fusion-report requires --engine fast')
+    if args.no_checks and args.engine != 'fast':
+        parser.error('--no-checks requires --engine fast')
+
+    program = Program(read_bytecode(args.input_file, cache_from_args(args)))
+    memo = MemoCache(args.memo_size) if args.memoize else None
+    machine = Machine(program, output=Output(sys.stdout, capture=False), memo=memo)
+
+    if args.no_checks:
+        from .verify import verify
+        errors = verify(program)
+        if errors:
+            for error in errors:
+                print(f'error: {error}', file=sys.stderr)
+            sys.exit(1)
+
+    stats = None
     try:
-        result = machine.run()
+        if args.fusion_report:
+            from .fast import FusionStats
+            stats = FusionStats()
+            result = machine.run_fast(stats=stats, checks=not args.no_checks)
+        elif args.no_checks:
+            result = machine.run_fast(checks=False)
+        else:
+            result = ENGINES[args.engine](machine)
+        machine.out.flush()
         print(f'result: {dump_value(result)}')
     except MachineError as e:
+        machine.out.flush()
         print('Traceback (most recent frame last):', file=sys.stderr)
         for error_line in machine.traceback():
             print(error_line, file=sys.stderr)
         print(f'error: {e}', file=sys.stderr)
         sys.exit(1)
+    finally:
+        if stats is not None:
+            for line in stats.report():
+                print(line, file=sys.stderr)
+        if memo is not None:
+            for line in memo.report():
+                print(line, file=sys.stderr)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,110 @@
+import json
+import unittest
+
+SNAPSHOT_VERSION = 1
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class Snapshot:
+    """
+    Saved state of a Machine (see Machine.snapshot() and Machine.restore()).
+
+    A snapshot is immutable. Frames are stored as tuples:
+
+        (name, prev_ip, ip, stack, locals, void)
+
+    where stack and locals are tuples as well. Frames that did not change
+    between snapshots are shared, and are only copied when the machine
+    returns to them after restore().
+    """
+
+    def __init__(self, frames, globals, result, output):
+        self.frames = frames
+        self.globals = globals
+        self.result = result
+        # (position, transcript), see Output.snapshot()
+        self.output = output
+
+    def dumps(self):
+        data = {
+            'version': SNAPSHOT_VERSION,
+            'frames': self.frames,
+            'globals': self.globals,
+            'result': self.result,
+            'output': self.output,
+        }
+        # Ropes (see rope.py) are saved as plain strings.
+        return json.dumps(data, default=str).encode('ascii')
+
+    @classmethod
+    def loads(cls, data):
+        data = json.loads(data)
+        if data.get('version') != SNAPSHOT_VERSION:
+            raise SnapshotError(f'unsupported snapshot version: {data.get("version")}')
+
+        frames = tuple(
+            (name, prev_ip, ip, tuple(stack), tuple(lcl), void)
+            for name, prev_ip, ip, stack, lcl, void in data['frames']
+        )
+        globals = tuple((name, value) for name, value in data['globals'])
+        output = tuple(data['output'])
+        return cls(frames, globals, data['result'], output)
+
+
+class SnapshotTest(unittest.TestCase):
+    code = '''\
+FUNC "main" 0 1
+    CONST_INT 0
+    STORE_GLOBAL "tries"
+    CONST_STRING "Password: "
+    CALL_VOID "print" 1
+    CALL "check" 0
+    RET
+
+FUNC "check" 0 0
+    CALL "input" 0
+    CONST_STRING "secret"
+    CMP_EQ
+    RET
+'''
+
+    def test_fork(self):
+        from .assemble import Assembler
+        from .program import Program
+        from .run import Machine
+
+        machine = Machine(Program(Assembler(self.code).assemble()))
+        machine.use_io = False
+        machine.start()
+        # Run until "input" is called
+        while len(machine.frames) < 2 or machine.ip != machine.functions['check'].entry:
+            machine.step()
+
+        snapshot = machine.snapshot()
+        results = {}
+        for guess in ['abc', 'secret', 'xyz']:
+            machine.restore(snapshot)
+            machine.on_input = lambda: guess
+            results[guess] = machine.resume(), machine.output
+        self.assertEqual(results, {
+            'abc': (False, 'Password: abc\n'),
+            'secret': (True, 'Password: secret\n'),
+            'xyz': (False, 'Password: xyz\n'),
+        })
+
+        # Unchanged frames are shared between snapshots
+        machine.restore(snapshot)
+        # Only the top frame ("check", empty) is copied
+        self.assertEqual(machine.values, [])
+        self.assertEqual(machine.frames[0].locals, [None])
+        snapshot2 = machine.snapshot()
+        self.assertIs(snapshot2.frames[0], snapshot.frames[0])
+
+        data = snapshot.dumps()
+        machine.restore(Snapshot.loads(data))
+        machine.on_input = lambda: 'secret'
+        self.assertEqual(machine.resume(), True)
+        self.assertEqual(machine.globals, {'tries': 0})
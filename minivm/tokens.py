@@ -3,6 +3,8 @@ import unittest
 import re
 from collections import namedtuple
 
+from .rope import Rope
+
 
 STRING_ESCAPES = {
     '"': '"',
@@ -19,6 +21,42 @@ STRING_ALLOWED = set(
 ) - set(STRING_ESCAPES)
 
 
+# Translation table for escape_string(), for all characters that need escaping.
+ESCAPE_TABLE = {}
+for n in range(256):
+    c = chr(n)
+    if c in STRING_ESCAPES:
+        ESCAPE_TABLE[n] = "\\" + STRING_ESCAPES[c]
+    elif c not in STRING_ALLOWED:
+        ESCAPE_TABLE[n] = f"\\x{n:02x}"
+
+ALLOWED_CLASS = '[' + re.escape(''.join(sorted(STRING_ALLOWED))) + ']'
+NEEDS_ESCAPE = re.compile('[^' + ALLOWED_CLASS[1:])
+
+# Regexes for the scanner. They are matched at a position in the line, so
+# that the rest of the line is never copied.
+WS_RE = re.compile(r'[ \t]*')
+IDENT_RE = re.compile(r'[a-zA-Z0-9_]+')
+NUMBER_RE = re.compile(r'-?[0-9]+')
+HEX_NUMBER_RE = re.compile(r'\$-?[0-9a-fA-F]+')
+HEX_ESCAPE_RE = re.compile(r'x[a-fA-F0-9]{2}')
+STRING_CHARS_RE = re.compile(ALLOWED_CLASS + '*')
+
+# Whitespace, and the next token (or the end of line, possibly with a
+# comment). Strings with escape sequences, and errors, are left to
+# Scanner.scan().
+TOKEN_RE = re.compile(
+    r'[ \t]*(?:'
+    r'(?P<ident>[a-zA-Z][a-zA-Z0-9_]*)(?P<label>:)?'
+    r'|(?P<int>-?[0-9]+)'
+    r'|\$(?P<hex>-?[0-9a-fA-F]+)'
+    r'|"(?P<string>' + ALLOWED_CLASS + r'*)"'
+    r'|(?P<end>(?:#.*)?\Z)'
+    r')',
+    re.DOTALL,
+)
+
+
 def dump_value(value):
     if value is None:
         return 'null'
@@ -28,24 +66,18 @@ def dump_value(value):
         return 'false'
     if isinstance(value, str):
         return escape_string(value)
+    if isinstance(value, Rope):
+        return escape_string(str(value))
     if isinstance(value, int):
         return str(value)
     assert False, f'wrong type: {value!r}'
 
 
 def escape_string(s):
-    result = '"'
-    for c in s:
-        if c in STRING_ESCAPES:
-            result += "\\" + STRING_ESCAPES[c]
-        elif c in STRING_ALLOWED:
-            result += c
-        else:
-            n = ord(c)
-            assert n <= 255
-            result += f"\\x{n:02x}"
-    result += '"'
-    return result
+    if NEEDS_ESCAPE.search(s) is None:
+        return '"' + s + '"'
+    assert max(map(ord, s)) <= 255
+    return '"' + s.translate(ESCAPE_TABLE) + '"'
 
 
 TLabel = namedtuple('TLabel', ['lineno', 'col', 'value'])
@@ -79,8 +111,7 @@ class Scanner:
         return self.line[self.col]
 
     def scan_ws(self):
-        while not self.end() and self.current() in " \t":
-            self.col += 1
+        self.col = WS_RE.match(self.line, self.col).end()
         if self.current() == "#":
             self.col = len(self.line)
 
@@ -88,42 +119,41 @@ class Scanner:
         raise ParseError(self.lineno, self.col, message)
 
     def scan_regex(self, regex, name):
-        m = re.match(regex, self.line[self.col :])
+        m = regex.match(self.line, self.col)
         if not m:
             self.error(f"expecting {name}")
-        result = m.group(0)
         col = self.col
-        self.col += len(result)
-        return col, result
+        self.col = m.end()
+        return col, m.group(0)
 
     def scan_string(self):
-        result = ""
+        parts = []
         col = self.col
         self.col += 1
         while True:
+            end = STRING_CHARS_RE.match(self.line, self.col).end()
+            parts.append(self.line[self.col:end])
+            self.col = end
             current = self.current()
             if current is None:
                 self.error("unterminated string literal")
-            elif current in STRING_ALLOWED:
-                result += current
-                self.col += 1
             elif current == "\\":
                 self.col += 1
                 current = self.current()
                 if current is None:
                     self.error("unterminated escape sequence")
                 elif current in STRING_UNESCAPES:
-                    result += STRING_UNESCAPES[current]
+                    parts.append(STRING_UNESCAPES[current])
                     self.col += 1
                 elif current == "x":
-                    _col, s = self.scan_regex("x[a-fA-F0-9]{2}", "hex escape sequence")
+                    _col, s = self.scan_regex(HEX_ESCAPE_RE, "hex escape sequence")
                     n = int(s[1:], 16)
-                    result += chr(n)
+                    parts.append(chr(n))
                 else:
                     self.error("unknown escape sequence")
             elif current == '"':
                 self.col += 1
-                return col, result
+                return col, ''.join(parts)
             else:
                 self.error("unknown character in string literal")
 
@@ -134,16 +164,16 @@ class Scanner:
 
         current = self.current()
         if current in string.ascii_letters:
-            col, s = self.scan_regex(r"[a-zA-Z0-9_]+", "identifier")
+            col, s = self.scan_regex(IDENT_RE, "identifier")
             if self.current() == ':':
                 self.col += 1
                 return TLabel(self.lineno, col, s)
             return TIdent(self.lineno, col, s)
         elif current in string.digits or current == "-":
-            col, s = self.scan_regex(r"-?[0-9]+", "number")
+            col, s = self.scan_regex(NUMBER_RE, "number")
             return TInteger(self.lineno, col, int(s))
         elif current == "$":
-            col, s = self.scan_regex(r"\$-?[0-9a-fA-F]+", "hex number")
+            col, s = self.scan_regex(HEX_NUMBER_RE, "hex number")
             return TInteger(self.lineno, col, int(s[1:], 16))
         elif current == '"':
             col, s = self.scan_string()
@@ -152,10 +182,31 @@ class Scanner:
             self.error("unexpected character")
 
     def iter(self):
+        line = self.line
+        lineno = self.lineno
+        match = TOKEN_RE.match
         while True:
-            token = self.scan()
-            if token:
+            m = match(line, self.col)
+            if m is None:
+                # Escape sequence in a string, or an error
+                token = self.scan()
+                if token is None:
+                    break
                 yield token
+                continue
+
+            kind = m.lastgroup
+            self.col = m.end()
+            if kind == 'ident':
+                yield TIdent(lineno, m.start(kind), m.group(kind))
+            elif kind == 'label':
+                yield TLabel(lineno, m.start('ident'), m.group('ident'))
+            elif kind == 'int':
+                yield TInteger(lineno, m.start(kind), int(m.group(kind)))
+            elif kind == 'hex':
+                yield TInteger(lineno, m.start(kind) - 1, int(m.group(kind), 16))
+            elif kind == 'string':
+                yield TString(lineno, m.start(kind) - 1, m.group(kind))
             else:
                 break
 
@@ -166,6 +217,8 @@ class TokensTest(unittest.TestCase):
         self.assertEqual(escape_string(s), '"hello \\n world\\""')
         s = 'hello \x01 world'
         self.assertEqual(escape_string(s), '"hello \\x01 world"')
+        s = 'plain text'
+        self.assertEqual(escape_string(s), '"plain text"')
 
     def scan(self, line):
         t = Scanner(line, 0)
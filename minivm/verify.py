@@ -0,0 +1,293 @@
+import argparse
+import sys
+import unittest
+import weakref
+from collections import namedtuple
+
+from .program import Op, Program, ProgramError
+
+# The verifier checks each function statically, so that it can run without
+# some of the checks done by the interpreter:
+#
+#  - the stack depth at each instruction is the same on every path, never
+#    goes below zero and never exceeds STACK_LIMIT,
+#  - LOAD_LOCAL and STORE_LOCAL use valid local numbers,
+#  - jumps land on an instruction of the same function,
+#  - control never reaches FUNC (or the end of the program).
+#
+# Only instructions reachable from the start of a function are checked.
+# Errors that depend on values (types, undefined globals, unknown functions)
+# are still reported at run time.
+
+# Maximum number of values on the stack of a frame.
+STACK_LIMIT = 256
+
+# Number of values popped and pushed by each instruction (except calls and
+# RET).
+STACK_EFFECTS = {
+    Op.CONST_NULL: (0, 1),
+    Op.CONST_FALSE: (0, 1),
+    Op.CONST_TRUE: (0, 1),
+    Op.CONST_INT: (0, 1),
+    Op.CONST_INT_BIG: (0, 1),
+    Op.CONST_STRING: (0, 1),
+    Op.OP_NEG: (1, 1),
+    Op.OP_ADD: (2, 1),
+    Op.OP_SUB: (2, 1),
+    Op.OP_MUL: (2, 1),
+    Op.OP_DIV: (2, 1),
+    Op.OP_MOD: (2, 1),
+    Op.OP_NOT: (1, 1),
+    Op.CMP_EQ: (2, 1),
+    Op.CMP_NE: (2, 1),
+    Op.CMP_LT: (2, 1),
+    Op.CMP_LTE: (2, 1),
+    Op.CMP_GT: (2, 1),
+    Op.CMP_GTE: (2, 1),
+    Op.DUP: (1, 2),
+    Op.DROP: (1, 0),
+    Op.LOAD_GLOBAL: (0, 1),
+    Op.STORE_GLOBAL: (1, 0),
+    Op.LOAD_LOCAL: (0, 1),
+    Op.STORE_LOCAL: (1, 0),
+    Op.JUMP: (0, 0),
+    Op.JUMP_IF: (1, 0),
+    Op.FUNC: (0, 0),
+}
+
+
+def stack_effect(op, args):
+    if op in [Op.CALL, Op.CALL_VOID]:
+        return args[1], (1 if op == Op.CALL else 0)
+    if op == Op.RET:
+        return 0, 0
+    return STACK_EFFECTS[op]
+
+
+def split_functions(instrs):
+    """
+    Split a list of instructions (as returned by Program.iter()) into
+    functions. Each function is a list starting with its FUNC. Instructions
+    before the first FUNC are skipped.
+    """
+
+    start = None
+    for i, (pos, length, op, args) in enumerate(instrs):
+        if op == Op.FUNC:
+            if start is not None:
+                yield instrs[start:i]
+            start = i
+    if start is not None:
+        yield instrs[start:]
+
+
+# Results for a verified function: stack depth before each reachable
+# instruction, and the maximum depth.
+FunctionInfo = namedtuple(
+    'FunctionInfo', ['name', 'entry', 'n_vars', 'depths', 'max_depth'])
+
+# Programs that passed verification, see check().
+_verified = weakref.WeakKeyDictionary()
+
+
+class Verifier:
+    def __init__(self, program):
+        self.program = program
+        self.errors = []
+        self.functions = {}
+
+    def verify(self):
+        """
+        Check the whole program. Returns True if there were no errors;
+        otherwise, the errors are in self.errors.
+        """
+
+        try:
+            instrs = list(self.program.iter())
+        except ProgramError as e:
+            self.errors.append(e)
+            return False
+
+        for func_instrs in split_functions(instrs):
+            self.verify_function(func_instrs)
+
+        self.errors.sort(key=lambda e: e.pos)
+        return not self.errors
+
+    def error(self, pos, message):
+        # The same error can be found on many paths.
+        if not any(e.pos == pos and e.message == message for e in self.errors):
+            self.errors.append(ProgramError(pos, message))
+
+    def verify_function(self, instrs):
+        func_pos, func_length, func_op, (name, n_params, n_locals) = instrs[0]
+        n_vars = n_params + n_locals
+        entry = func_pos + func_length
+        body = {pos: (length, op, args) for pos, length, op, args in instrs[1:]}
+
+        depths = {}
+        todo = []
+
+        def flow(pos, target, depth):
+            if target not in body:
+                if target == entry + sum(length for length, op, args in body.values()):
+                    self.error(pos, 'control reaches the end of function')
+                else:
+                    self.error(pos, f'jump outside of function {name}: {target:04X}')
+            elif target not in depths:
+                depths[target] = depth
+                todo.append(target)
+            elif depths[target] != depth:
+                self.error(
+                    target,
+                    f'inconsistent stack depth: {depths[target]} or {depth}')
+
+        flow(func_pos, entry, 0)
+        while todo:
+            pos = todo.pop()
+            depth = depths[pos]
+            length, op, args = body[pos]
+
+            n_pop, n_push = stack_effect(op, args)
+            if depth < n_pop:
+                self.error(pos, f'stack underflow: {op.name} needs {n_pop} values, '
+                           f'stack has {depth}')
+                continue
+            depth = depth - n_pop + n_push
+            if depth > STACK_LIMIT:
+                self.error(pos, 'stack overflow')
+                continue
+
+            if op in [Op.LOAD_LOCAL, Op.STORE_LOCAL] and args[0] >= n_vars:
+                self.error(pos, f'invalid local number: {args[0]} '
+                           f'(function has {n_vars})')
+                continue
+
+            if op == Op.RET:
+                continue
+            if op in [Op.JUMP, Op.JUMP_IF]:
+                flow(pos, pos + args[0], depth)
+            if op != Op.JUMP:
+                flow(pos, pos + length, depth)
+
+        max_depth = max(depths.values(), default=0)
+        self.functions[name] = FunctionInfo(name, entry, n_vars, depths, max_depth)
+
+
+def verify(program):
+    """
+    Verify a program. Returns a list of errors (empty if the program is
+    correct).
+    """
+
+    verifier = Verifier(program)
+    verifier.verify()
+    return verifier.errors
+
+
+def check(program):
+    """
+    Make sure the program is verified, or raise the first error. The result
+    is remembered for each Program object.
+    """
+
+    if program not in _verified:
+        errors = verify(program)
+        if errors:
+            raise errors[0]
+        _verified[program] = True
+
+
+class VerifierTest(unittest.TestCase):
+    def verify(self, code):
+        from .assemble import Assembler
+
+        program = Program(Assembler(code).assemble())
+        return [str(e) for e in verify(program)]
+
+    def test_correct(self):
+        from .assemble import Assembler
+
+        code = '''\
+FUNC "main" 0 1
+    CONST_INT 3
+    STORE_LOCAL 0
+LOOP:
+    LOAD_LOCAL 0
+    JUMP_IF BODY
+    CALL "f" 0
+    RET
+BODY:
+    LOAD_LOCAL 0
+    CONST_INT 1
+    OP_SUB
+    STORE_LOCAL 0
+    JUMP LOOP
+
+FUNC "f" 0 0
+    CONST_INT 1
+    DUP
+    RET
+'''
+        self.assertEqual(self.verify(code), [])
+        verifier = Verifier(Program(Assembler(code).assemble()))
+        verifier.verify()
+        self.assertEqual(verifier.functions['main'].max_depth, 2)
+        self.assertEqual(verifier.functions['f'].max_depth, 2)
+
+    def test_errors(self):
+        code = '''\
+FUNC "main" 0 0
+    CONST_INT 1
+    JUMP_IF L
+    CONST_INT 2
+L:  RET
+
+FUNC "f" 0 1
+    LOAD_LOCAL 1
+    RET
+
+FUNC "g" 0 0
+    CONST_TRUE
+    JUMP_IF X
+    DROP
+
+FUNC "h" 0 0
+X:  RET
+
+FUNC "k" 0 0
+    CONST_NULL
+'''
+        self.assertEqual(self.verify(code), [
+            '0016: inconsistent stack depth: 0 or 1',
+            '001C: invalid local number: 1 (function has 1)',
+            '0025: jump outside of function g: 002E',
+            '0028: stack underflow: DROP needs 1 values, stack has 0',
+            '0034: control reaches the end of function',
+        ])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'input_file', metavar='PROGRAM',
+        help='program (bytecode or assembly), or - for stdin',
+    )
+
+    args = parser.parse_args()
+
+    from .run import read_bytecode
+
+    program = Program(read_bytecode(args.input_file))
+    verifier = Verifier(program)
+    if not verifier.verify():
+        for error in verifier.errors:
+            print(f'error: {error}', file=sys.stderr)
+        sys.exit(1)
+
+    for name, info in verifier.functions.items():
+        print(f'{name}: max stack depth {info.max_depth}, {info.n_vars} locals')
+
+
+if __name__ == '__main__':
+    main()